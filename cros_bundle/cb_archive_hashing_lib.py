@@ -5,39 +5,173 @@
 
 """This module contains hashing and compression methods."""
 
+import bz2
+import collections
 import hashlib
 import logging
+import multiprocessing
 import os
 import zipfile
 
-from cb_util import RunCommand
+from cb_digest_cache import StatKey
+from cb_util import RunCommand, StartCommand
 
 
-def CheckMd5(filename, md5filename):
+# Digests computed by a single read pass over a file, see GenerateDigests.
+# Bundles publish and verify MD5 only.
+DIGEST_ALGORITHMS = ('md5',)
+# Digests of downloads added to the artifact store, keyed on SHA-256.
+STORE_DIGEST_ALGORITHMS = ('md5', 'sha256')
+# Size of the buffer reused for every read of a file being hashed.
+READ_BUFFER_SIZE = 1024 * 1024
+# Bytes compressed into each bz2 stream by the built-in compressor used
+# without pbzip2, the block size of bzip2 -9 and of pbzip2 by default.
+COMPRESS_BLOCK_SIZE = 900 * 1000
+# Worker processes of the built-in compressor.
+COMPRESS_JOBS = multiprocessing.cpu_count()
+
+_compress_block_size = COMPRESS_BLOCK_SIZE
+_compress_jobs = COMPRESS_JOBS
+
+# DigestCache consulted before hashing a file, None forces full verification.
+_digest_cache = None
+
+
+def SetDigestCache(cache):
+  """Sets the digest cache consulted by GenerateDigests.
+
+  Args:
+    cache: a cb_digest_cache.DigestCache object, None to always hash files
+  """
+  global _digest_cache
+  _digest_cache = cache
+
+
+def ConfigureCompression(jobs=None, block_size=None):
+  """Sets tunables of the built-in compressor, None leaves one unchanged.
+
+  Args:
+    jobs: worker processes compressing blocks at once
+    block_size: bytes of input compressed into each bz2 stream
+  """
+  global _compress_jobs, _compress_block_size
+  if jobs:
+    _compress_jobs = jobs
+  if block_size:
+    _compress_block_size = block_size
+
+
+class DigestStream(object):
+  """Feed the same data to several hashlib digests at once.
+
+  It contains the following fields:
+  - hashers: a dict mapping algorithm name to its hashlib object
+  - length: number of bytes fed so far
+  """
+
+  def __init__(self, algorithms=DIGEST_ALGORITHMS):
+    self.hashers = dict((name, hashlib.new(name)) for name in algorithms)
+    self.length = 0
+
+  def update(self, data):
+    """Add a chunk of data to every digest.
+
+    Args:
+      data: a string, buffer or memoryview of bytes to hash
+    """
+    for hasher in self.hashers.itervalues():
+      hasher.update(data)
+    self.length += len(data)
+
+  def HexDigests(self):
+    """Returns a dict mapping algorithm name to hexdigest of the data fed."""
+    return dict((name, hasher.hexdigest())
+                for name, hasher in self.hashers.iteritems())
+
+
+def GenerateDigests(filename, algorithms=DIGEST_ALGORITHMS):
+  """Computes several digests of a file in a single read pass.
+
+  The file is read once into a reused buffer and every chunk is fed to all
+  requested digests, so hashing a multi-GB image costs one read of it no
+  matter how many digests are needed. When a digest cache is set, digests
+  of a file unchanged since it was last hashed are returned without reading.
+
+  Args:
+    filename: absolute path name of file to hash
+    algorithms: a sequence of hashlib algorithm names
+  Returns:
+    a dict mapping algorithm name to hexdigest
+  Raises:
+    IOError when the file cannot be read
+  """
+  cache = _digest_cache
+  if cache:
+    digests = cache.Lookup(filename, algorithms)
+    if digests:
+      return digests
+    try:
+      key = StatKey(filename)
+    except OSError:
+      # open below reports the failure
+      cache = None
+  stream = DigestStream(algorithms)
+  read_buffer = bytearray(READ_BUFFER_SIZE)
+  read_view = memoryview(read_buffer)
+  with open(filename, 'rb') as read_file:
+    while True:
+      count = read_file.readinto(read_buffer)
+      if not count:
+        break
+      stream.update(read_view[:count])
+  digests = stream.HexDigests()
+  if cache:
+    cache.Record(filename, digests, key)
+  return digests
+
+
+def RecordDigests(filename, digests):
+  """Records digests computed while a file was written, e.g. downloaded.
+
+  Later GenerateDigests calls on the unchanged file then need not read it.
+
+  Args:
+    filename: name of file whose full contents were hashed
+    digests: a dict mapping algorithm name to hexdigest
+  """
+  cache = _digest_cache
+  if cache:
+    try:
+      cache.Record(filename, digests, StatKey(filename))
+    except OSError:
+      logging.debug('Could not stat %s to cache its digests.', filename)
+
+
+def CheckMd5(filename, md5filename, md5sum=None):
   """Checks the MD5 checksum of file against provided baseline .md5
 
   Args:
     filename: name of file to check MD5 checksum
     md5filename: name of file with reference MD5 checksum
+    md5sum: optional, MD5 hexdigest of filename already computed, e.g. while
+            downloading it, so that the file need not be read again
   Returns:
     a boolean, True when the MD5 checksums agree
   """
   try:
-    hasher = hashlib.md5()
-    with open(filename) as check_file:
-      with open(md5filename) as golden_file:
-        for chunk in iter(lambda: check_file.read(128*hasher.block_size), ''):
-          hasher.update(chunk)
-        md5_contents = golden_file.read()
-        if md5_contents:
-          golden_digest_and_more = md5_contents.split(' ')
-          if golden_digest_and_more:
-            return golden_digest_and_more[0] == hasher.hexdigest()
-        logging.warning('MD5 checksum match failed for %s', filename)
-        return False
+    with open(md5filename) as golden_file:
+      md5_contents = golden_file.read()
+    if not md5sum:
+      md5sum = GenerateDigests(filename, algorithms=('md5',))['md5']
   except IOError:
     logging.warning('MD5 hasher read failed for %s', filename)
     return False
+  if md5_contents:
+    golden_digest_and_more = md5_contents.split(' ')
+    if golden_digest_and_more:
+      return golden_digest_and_more[0] == md5sum
+  logging.warning('MD5 checksum match failed for %s', filename)
+  return False
 
 
 def MakeMd5(filename, md5filename):
@@ -52,13 +186,10 @@ def MakeMd5(filename, md5filename):
     a boolean, True when md5checksum file is successfully created
   """
   try:
-    with open(filename, 'r') as read_file:
-      with open(md5filename, 'w') as hash_file:
-        hasher = hashlib.md5()
-        for chunk in iter(lambda: read_file.read(128*hasher.block_size), ''):
-          hasher.update(chunk)
-        hash_file.write(hasher.hexdigest())
-        return True
+    md5sum = GenerateDigests(filename, algorithms=('md5',))['md5']
+    with open(md5filename, 'w') as hash_file:
+      hash_file.write(md5sum)
+      return True
   except IOError:
     logging.error('Failed to compute md5 checksum for file %s.',
                   filename)
@@ -74,11 +205,7 @@ def GenerateMd5(filename):
     a string, the hexdigest form of the MD5 checksum, empty on failure
   """
   try:
-    with open(filename, 'r') as read_file:
-      hasher = hashlib.md5()
-      for chunk in iter(lambda: read_file.read(128*hasher.block_size), ''):
-        hasher.update(chunk)
-      return hasher.hexdigest()
+    return GenerateDigests(filename, algorithms=('md5',))['md5']
   except IOError:
     logging.error('Failed to compute md5 checksum for file %s.',
                   filename)
@@ -108,13 +235,97 @@ def ZipExtract(zipname, filename, path=os.getcwd()):
     return False
 
 
-def MakeTar(target_dir, destination_dir, name=None):
+def ParallelBzip2(source, out, jobs=None, block_size=None):
+  """Compress a stream into a multi-stream bz2 file across processes.
+
+  The input is cut into blocks compressed independently by a process pool
+  into consecutive bz2 streams, as pbzip2 does, so bzip2 and pbzip2 both
+  decompress the output. At most two blocks per worker are held at once.
+
+  Args:
+    source: a file object to read from until EOF
+    out: a file object to write the compressed streams to
+    jobs: optional, worker processes, defaults to the configured number
+    block_size: optional, bytes per bz2 stream, defaults to the configured
+                size
+  Returns:
+    a tuple (bytes read, bytes written)
+  Raises:
+    IOError on read or write failure
+  """
+  jobs = jobs or _compress_jobs
+  block_size = block_size or _compress_block_size
+  pool = multiprocessing.Pool(jobs)
+  (read, written) = (0, 0)
+  try:
+    pending = collections.deque()
+    done = False
+    while pending or not done:
+      while not done and len(pending) < 2 * jobs:
+        block = source.read(block_size)
+        if not block:
+          done = True
+          if not read:
+            # an empty input is still one valid bz2 stream
+            pending.append(pool.apply_async(bz2.compress, ('', 9)))
+          break
+        read += len(block)
+        pending.append(pool.apply_async(bz2.compress, (block, 9)))
+      compressed = pending.popleft().get()
+      out.write(compressed)
+      written += len(compressed)
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+  return (read, written)
+
+
+def _BuiltinTar(tar_options, folder_name, cwd, name):
+  """Run tar, compressing its output with ParallelBzip2.
+
+  Args:
+    tar_options: a list of tar options, e.g. ['--sparse']
+    folder_name: directory to archive, relative to cwd
+    cwd: working directory of tar
+    name: name of the tar.bz2 file to write
+  Returns:
+    a boolean, True when the archive was written
+  """
+  proc = StartCommand(['tar', '-c'] + tar_options + [folder_name, '-f', '-'],
+                      cwd=cwd)
+  try:
+    with open(name, 'wb') as out:
+      (read, written) = ParallelBzip2(proc.stdout, out)
+  except (IOError, OSError) as e:
+    logging.error('Could not compress %s: %s', name, e)
+    proc.kill()
+    return False
+  finally:
+    proc.stdout.close()
+    proc.wait()
+  if proc.returncode:
+    logging.error('tar failed with status %d.', proc.returncode)
+    return False
+  logging.info('Compressed %d MB of tar into %d MB.', read / 1024 ** 2,
+               written / 1024 ** 2)
+  return True
+
+
+def MakeTar(target_dir, destination_dir, name=None, dereference=False,
+            sparse=False):
   """Creates a tar.bz2 archive of a target directory.
 
   Args:
     target_dir: absolute path to directory with contents to tar
     destination_dir: directory in which to put tar file
     name: filename without directory path of tar file to create
+    dereference: optional, True to archive the files symlinks point to under
+                 the names of the symlinks, rather than the symlinks
+    sparse: optional, True to archive files as GNU sparse members, so that
+            their holes are neither read nor compressed. tar only finds
+            holes, a file written in full has none: see PunchZeroBlocks in
+            cb_image_lib. Files are never modified.
   Returns:
     a string, the basename of the tar created or None on failure
   """
@@ -129,15 +340,27 @@ def MakeTar(target_dir, destination_dir, name=None):
                   destination_dir)
     return None
   cmd_result = RunCommand(['which', 'pbzip2'], redirect_stdout=True)
-  output_string = cmd_result.output
-  if not output_string:
-    logging.error('\nMissing pbzip2. Please run sudo apt-get install pbzip2\n')
-    return None
+  have_pbzip2 = bool(cmd_result.output)
+  if not have_pbzip2:
+    logging.warning('Missing pbzip2, compressing with %d built-in workers. '
+                    'For speed, run sudo apt-get install pbzip2',
+                    _compress_jobs)
   folder_name = os.path.basename(target_dir)
   if not name:
     name = folder_name + '.tar.bz2'
-  # use pbzip2 for speed
   name = os.path.join(destination_dir, name)
-  RunCommand(['tar', '-c', '-I', 'pbzip2', folder_name, '-f', name],
+  tar_options = []
+  if sparse:
+    tar_options.append('--sparse')
+  if dereference:
+    tar_options.append('--dereference')
+  if not have_pbzip2:
+    if not _BuiltinTar(tar_options, folder_name, os.path.dirname(target_dir),
+                       name):
+      return None
+    return name
+  # use pbzip2 for speed
+  RunCommand(['tar', '-c'] + tar_options + ['-I', 'pbzip2', folder_name,
+                                            '-f', name],
              cwd=os.path.dirname(target_dir))
   return name
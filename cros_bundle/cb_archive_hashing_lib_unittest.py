@@ -16,6 +16,8 @@ import zipfile
 
 import cb_archive_hashing_lib
 import cb_command_lib
+import cb_digest_cache
+from cb_util import CommandResult, RunCommand
 
 
 def _CleanUp(obj):
@@ -95,6 +97,17 @@ class TestCheckMd5(unittest.TestCase):
     self.assertFalse(cb_archive_hashing_lib.CheckMd5(filename, md5filename))
     self.clean_files = [filename, md5filename]
 
+  def testMd5GivenSkipsRead(self):
+    """Verify a precomputed checksum is compared without reading the file."""
+    golden_file = tempfile.NamedTemporaryFile()
+    golden_file.write('0123abcd  image.bin')
+    golden_file.flush()
+    self.assertTrue(cb_archive_hashing_lib.CheckMd5('', golden_file.name,
+                                                    md5sum='0123abcd'))
+    self.assertFalse(cb_archive_hashing_lib.CheckMd5('', golden_file.name,
+                                                     md5sum='0123abce'))
+    self.clean_files = []
+
   def testNoCheckFile(self):
     """Verify return value when file to check does not exist."""
     filename = ''
@@ -147,6 +160,105 @@ class TestMakeMd5(unittest.TestCase):
     self.clean_files = [filename]
 
 
+class TestGenerateDigests(unittest.TestCase):
+  """Unit tests related to GenerateDigests."""
+
+  def setUp(self):
+    self.clean_dirs = []
+    self.content = 'sample file content inserted here to be hashed'
+    self.read_file = tempfile.NamedTemporaryFile()
+    self.read_file.write(self.content)
+    self.read_file.flush()
+    self.clean_files = []
+
+  def tearDown(self):
+    _CleanUp(self)
+
+  def testAllDigestsFromOneRead(self):
+    """Verify every digest of one read agrees with hashlib."""
+    algorithms = cb_archive_hashing_lib.STORE_DIGEST_ALGORITHMS
+    expected = dict((name, hashlib.new(name, self.content).hexdigest())
+                    for name in algorithms)
+    actual = cb_archive_hashing_lib.GenerateDigests(self.read_file.name,
+                                                    algorithms)
+    self.assertEqual(expected, actual)
+
+  def testChosenAlgorithms(self):
+    """Verify only the requested digests are returned."""
+    expected = {'sha256': hashlib.sha256(self.content).hexdigest()}
+    actual = cb_archive_hashing_lib.GenerateDigests(self.read_file.name,
+                                                    algorithms=['sha256'])
+    self.assertEqual(expected, actual)
+
+  def testContentLargerThanBuffer(self):
+    """Verify digests are correct when the buffer is reused across reads."""
+    content = os.urandom(3 * cb_archive_hashing_lib.READ_BUFFER_SIZE + 17)
+    self.read_file.seek(0)
+    self.read_file.write(content)
+    self.read_file.truncate()
+    self.read_file.flush()
+    expected = hashlib.md5(content).hexdigest()
+    actual = cb_archive_hashing_lib.GenerateDigests(self.read_file.name)
+    self.assertEqual(expected, actual['md5'])
+
+  def testNoReadFile(self):
+    """Verify IOError is raised when file to read does not exist."""
+    self.assertRaises(IOError, cb_archive_hashing_lib.GenerateDigests, '')
+
+  def testCachedDigestsSkipRead(self):
+    """Verify a cached file is not hashed again while it is unchanged."""
+    cache_dir = tempfile.mkdtemp()
+    self.clean_dirs = [cache_dir]
+    cache = cb_digest_cache.DigestCache(os.path.join(cache_dir, 'cache'))
+    digest_stream = cb_archive_hashing_lib.DigestStream
+    cb_archive_hashing_lib.SetDigestCache(cache)
+    try:
+      expected = cb_archive_hashing_lib.GenerateDigests(self.read_file.name)
+      # any attempt to hash the file again now fails
+      cb_archive_hashing_lib.DigestStream = None
+      actual = cb_archive_hashing_lib.GenerateDigests(self.read_file.name)
+      self.assertEqual(expected, actual)
+    finally:
+      cb_archive_hashing_lib.DigestStream = digest_stream
+      cb_archive_hashing_lib.SetDigestCache(None)
+
+
+class TestGenerateMd5(unittest.TestCase):
+  """Unit tests related to GenerateMd5."""
+
+  def testMd5Good(self):
+    """Verify MD5 hexdigest returned when file is readable."""
+    read_file = tempfile.NamedTemporaryFile()
+    read_file.write('sample file content inserted here to be hashed')
+    read_file.flush()
+    expected = hashlib.md5(
+        'sample file content inserted here to be hashed').hexdigest()
+    self.assertEqual(expected,
+                     cb_archive_hashing_lib.GenerateMd5(read_file.name))
+
+  def testNoReadFile(self):
+    """Verify empty string returned when file to read does not exist."""
+    self.assertEqual('', cb_archive_hashing_lib.GenerateMd5(''))
+
+  def testMd5Only(self):
+    """Verify no digest but MD5 is computed."""
+    read_file = tempfile.NamedTemporaryFile()
+    read_file.write('sample file content inserted here to be hashed')
+    read_file.flush()
+    digest_stream = cb_archive_hashing_lib.DigestStream
+    algorithms = []
+
+    def RecordingStream(names):
+      algorithms.extend(names)
+      return digest_stream(names)
+    cb_archive_hashing_lib.DigestStream = RecordingStream
+    try:
+      cb_archive_hashing_lib.GenerateMd5(read_file.name)
+    finally:
+      cb_archive_hashing_lib.DigestStream = digest_stream
+    self.assertEqual(['md5'], algorithms)
+
+
 class ZipExtract(unittest.TestCase):
   """Unit tests related to ZipExtract."""
 
@@ -281,6 +393,117 @@ class TestMakeTar(unittest.TestCase):
     self.clean_dirs = [self.test_dir]
 
 
+class TestMakeTarOptions(mox.MoxTestBase):
+  """Unit tests related to the tar options MakeTar passes."""
+
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.mox.StubOutWithMock(cb_archive_hashing_lib, 'RunCommand')
+    self.test_dir = tempfile.mkdtemp()
+    self.bundle_dir = os.path.join(self.test_dir, 'bundle')
+    os.mkdir(self.bundle_dir)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    shutil.rmtree(self.test_dir)
+
+  def testDereference(self):
+    """Verify tar is asked to follow symlinks."""
+    which_result = CommandResult()
+    which_result.output = '/usr/bin/pbzip2'
+    cb_archive_hashing_lib.RunCommand(
+        ['which', 'pbzip2'], redirect_stdout=True).AndReturn(which_result)
+    name = os.path.join(self.test_dir, 'bundle.tar.bz2')
+    cb_archive_hashing_lib.RunCommand(
+        ['tar', '-c', '--dereference', '-I', 'pbzip2', 'bundle', '-f', name],
+        cwd=self.test_dir)
+    self.mox.ReplayAll()
+    self.assertEqual(name, cb_archive_hashing_lib.MakeTar(
+        self.bundle_dir, self.test_dir, dereference=True))
+    self.mox.VerifyAll()
+
+  def testSparse(self):
+    """Verify tar is asked for sparse members, the files left untouched."""
+    image = os.path.join(self.bundle_dir, 'image.bin')
+    content = os.urandom(1024) + '\0' * 1024 * 1024
+    with open(image, 'wb') as image_file:
+      image_file.write(content)
+    blocks = os.stat(image).st_blocks
+    which_result = CommandResult()
+    which_result.output = '/usr/bin/pbzip2'
+    cb_archive_hashing_lib.RunCommand(
+        ['which', 'pbzip2'], redirect_stdout=True).AndReturn(which_result)
+    name = os.path.join(self.test_dir, 'bundle.tar.bz2')
+    cb_archive_hashing_lib.RunCommand(
+        ['tar', '-c', '--sparse', '-I', 'pbzip2', 'bundle', '-f', name],
+        cwd=self.test_dir)
+    self.mox.ReplayAll()
+    self.assertEqual(name, cb_archive_hashing_lib.MakeTar(
+        self.bundle_dir, self.test_dir, sparse=True))
+    self.mox.VerifyAll()
+    self.assertEqual(blocks, os.stat(image).st_blocks)
+    with open(image, 'rb') as image_file:
+      self.assertEqual(content, image_file.read())
+
+
+class TestParallelBzip2(mox.MoxTestBase):
+  """Unit tests related to ParallelBzip2 and the MakeTar fallback to it."""
+
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.test_dir = tempfile.mkdtemp()
+    self.name = os.path.join(self.test_dir, 'out.bz2')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    shutil.rmtree(self.test_dir)
+
+  def _Compress(self, content, jobs, block_size):
+    source = os.path.join(self.test_dir, 'in')
+    with open(source, 'wb') as source_file:
+      source_file.write(content)
+    with open(source, 'rb') as source_file:
+      with open(self.name, 'wb') as out:
+        return cb_archive_hashing_lib.ParallelBzip2(source_file, out, jobs,
+                                                    block_size)
+
+  def _Decompress(self):
+    return RunCommand(['bzip2', '-dc', self.name],
+                      redirect_stdout=True).output
+
+  def testMultiStream(self):
+    """Verify one stream per block, in order, which bzip2 decompresses."""
+    content = os.urandom(10000) + '\0' * 20000 + os.urandom(5000)
+    (read, written) = self._Compress(content, 2, 4096)
+    self.assertEqual(len(content), read)
+    self.assertEqual(os.path.getsize(self.name), written)
+    with open(self.name, 'rb') as out:
+      self.assertEqual(9, out.read().count('BZh9'))
+    self.assertEqual(content, self._Decompress())
+
+  def testEmpty(self):
+    """Verify an empty input still gives a valid bz2 file."""
+    self.assertEqual(0, self._Compress('', 1, 4096)[0])
+    self.assertEqual('', self._Decompress())
+
+  def testMakeTarWithoutPbzip2(self):
+    """Verify MakeTar compresses in-process when pbzip2 is missing."""
+    bundle_dir = os.path.join(self.test_dir, 'bundle')
+    os.mkdir(bundle_dir)
+    with open(os.path.join(bundle_dir, 'image.bin'), 'wb') as image:
+      image.write(os.urandom(3000))
+    self.mox.StubOutWithMock(cb_archive_hashing_lib, 'RunCommand')
+    cb_archive_hashing_lib.RunCommand(
+        ['which', 'pbzip2'], redirect_stdout=True).AndReturn(CommandResult())
+    self.mox.ReplayAll()
+    name = cb_archive_hashing_lib.MakeTar(bundle_dir, self.test_dir)
+    self.mox.VerifyAll()
+    self.assertEqual(os.path.join(self.test_dir, 'bundle.tar.bz2'), name)
+    listing = RunCommand(['tar', '-tjf', name],
+                         redirect_stdout=True).output
+    self.assertEqual(['bundle/', 'bundle/image.bin'], listing.split())
+
+
 if __name__ == "__main__":
   logging.basicConfig(level=logging.CRITICAL)
   unittest.main()
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains a content-addressed store of downloaded artifacts.
+
+Images are kept once per content, under their SHA-256, with an index from
+the URLs they were downloaded from, so bundle runs of any user on a builder
+share them rather than downloading each into their own WORKDIR.
+"""
+
+import ctypes
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from cb_archive_hashing_lib import GenerateDigests, RecordDigests, \
+    STORE_DIGEST_ALGORITHMS
+from cb_util import LibcFunction, LoadJson, SaveJson
+
+# Bytes of artifacts kept before the least recently used are evicted.
+QUOTA = 50 * 1024 * 1024 * 1024
+# Linux ioctl sharing the extents of one file with another.
+FICLONE = 0x40049409
+# Bytes asked of the kernel per copy_file_range or sendfile call.
+KERNEL_COPY_CHUNK = 1024 * 1024 * 1024
+# Directories are shared by every user of the builder.
+_DIR_MODE = 02775
+_INDEX_MODE = 0664
+# Objects are never written once stored.
+_OBJECT_MODE = 0444
+
+
+def _Reflink(source, dest):
+  """Make dest a copy-on-write clone of source.
+
+  Args:
+    source: name of an existing file
+    dest: name of a file to create
+  Raises:
+    IOError when the file system cannot clone, dest is then not left behind
+  """
+  with open(source, 'rb') as source_file:
+    with open(dest, 'wb') as dest_file:
+      try:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+      except IOError:
+        os.remove(dest)
+        raise
+
+
+_copy_file_range = LibcFunction(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+     ctypes.c_size_t, ctypes.c_uint])
+_sendfile = LibcFunction(
+    'sendfile64', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+# (name, function copying up to a count of bytes from one fd to another)
+# of in-kernel copies, in the order they are tried.
+_KERNEL_COPIES = [
+    ('copy_file_range', _copy_file_range and (
+        lambda in_fd, out_fd, count: _copy_file_range(in_fd, None, out_fd,
+                                                      None, count, 0))),
+    ('sendfile', _sendfile and (
+        lambda in_fd, out_fd, count: _sendfile(out_fd, in_fd, None, count)))]
+# errno of a first call meaning the kernel cannot copy these files that way.
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP)
+
+
+def _KernelCopy(source, dest):
+  """Copy a file without its contents passing through user space.
+
+  copy_file_range is tried first, which file systems may turn into shared
+  extents or a server side copy, e.g. NFS 4.2, then sendfile.
+
+  Args:
+    source: name of an existing file
+    dest: name of a file to create
+  Returns:
+    a string, the name of the system call that copied the file
+  Raises:
+    IOError when neither is available or the copy fails, dest is then not
+    left behind
+  """
+  with open(source, 'rb') as source_file:
+    with open(dest, 'wb') as dest_file:
+      (in_fd, out_fd) = (source_file.fileno(), dest_file.fileno())
+      try:
+        for (name, copy) in _KERNEL_COPIES:
+          if not copy:
+            continue
+          copied = 0
+          while True:
+            count = copy(in_fd, out_fd, KERNEL_COPY_CHUNK)
+            if count < 0:
+              err = ctypes.get_errno()
+              if not copied and err in _UNSUPPORTED_ERRNOS:
+                break
+              raise IOError(err, os.strerror(err), source)
+            if not count:
+              return name
+            copied += count
+        raise IOError(errno.ENOSYS, 'No in-kernel copy of %s' % source)
+      except IOError:
+        os.remove(dest)
+        raise
+
+
+def PlaceFile(source, dest, hardlink=True):
+  """Put the contents of a file at a new name without copying it if possible.
+
+  The cheapest way that works is used: a reflink, as its copy is
+  independent of the source, then a hardlink, unless disallowed, then an
+  in-kernel copy, see _KernelCopy, and last a copy through Python. dest is
+  replaced atomically.
+
+  Args:
+    source: name of an existing file
+    dest: name the contents are placed at
+    hardlink: optional, False when dest must not share the inode of source
+  Returns:
+    a string, how the file was placed: 'reflink', 'hardlink',
+    'copy_file_range', 'sendfile' or 'copy'
+  Raises:
+    IOError or OSError when the file cannot be placed
+  """
+  fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)),
+                                   prefix='.' + os.path.basename(dest))
+  os.close(fd)
+  os.remove(temp_name)
+  try:
+    try:
+      _Reflink(source, temp_name)
+      method = 'reflink'
+    except IOError:
+      method = None
+    if not method and hardlink:
+      try:
+        os.link(source, temp_name)
+        method = 'hardlink'
+      except OSError:
+        pass
+    if not method:
+      try:
+        method = _KernelCopy(source, temp_name)
+      except IOError:
+        shutil.copyfile(source, temp_name)
+        method = 'copy'
+    os.rename(temp_name, dest)
+  except (IOError, OSError):
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+    raise
+  logging.debug('Placed %s at %s by %s.', source, dest, method)
+  return method
+
+
+def _MakeDirs(path):
+  """Create a directory and its missing parents, writable by every user.
+
+  os.makedirs applies the umask to the mode it is given, so the mode of
+  each directory created is set afterwards.
+
+  Args:
+    path: name of the directory
+  Raises:
+    OSError when a directory cannot be created
+  """
+  missing = []
+  while path and not os.path.isdir(path):
+    missing.append(path)
+    path = os.path.dirname(path)
+  for path in reversed(missing):
+    try:
+      os.mkdir(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      # created by another run, which set its mode
+      continue
+    os.chmod(path, _DIR_MODE)
+
+
+class ArtifactStore(object):
+
+  """A shared directory of files named after their SHA-256.
+
+  It contains the following fields:
+  - root: directory holding objects/<first 2 hex digits>/<sha256> and
+      index.json
+  - quota: bytes of objects kept, least recently used evicted first
+
+  The JSON index holds 'urls', mapping URL to the SHA-256 of its contents,
+  and 'objects', mapping SHA-256 to a dict with keys 'size', 'used' and
+  'digests'. It is re-read before every change so concurrent runs rarely
+  lose an update, and a lost update only costs a download. Objects are
+  read-only and placed in and out of the store by reflink or copy, never
+  hardlinked, so no change to a WORKDIR file reaches them. They are still
+  verified against their SHA-256 before being handed out; the digest cache
+  makes this free for unchanged objects. Files on disk but not in the index
+  count towards the quota and are evicted first.
+  """
+
+  def __init__(self, root, quota=QUOTA):
+    self.root = root
+    self.quota = quota
+    self._index_path = os.path.join(root, 'index.json')
+    self._lock = threading.Lock()
+
+  def _ObjectPath(self, sha256):
+    """Returns the name of the object holding contents of a SHA-256."""
+    return os.path.join(self.root, 'objects', sha256[:2], sha256)
+
+  def _LoadIndex(self):
+    """Returns the index stored on disk, empty if none or unreadable."""
+    index = LoadJson(self._index_path, 'artifact index')
+    index.setdefault('urls', {})
+    index.setdefault('objects', {})
+    return index
+
+  def _SaveIndex(self, index):
+    """Atomically rewrite the index, readable by every user."""
+    SaveJson(self._index_path, index, 'artifact index', mode=_INDEX_MODE)
+
+  def _Forget(self, index, sha256):
+    """Remove an object and every URL pointing at it from the index."""
+    index['objects'].pop(sha256, None)
+    for url in [u for u, s in index['urls'].iteritems() if s == sha256]:
+      del index['urls'][url]
+
+  def _Evict(self, index, keep=None):
+    """Delete least recently used objects until the store fits its quota.
+
+    Args:
+      index: the index, updated in place
+      keep: optional, SHA-256 of an object never to evict
+    """
+    objects_dir = os.path.join(self.root, 'objects')
+    on_disk = []
+    for subdir in os.listdir(objects_dir):
+      for sha256 in os.listdir(os.path.join(objects_dir, subdir)):
+        if sha256.startswith('.'):
+          # being placed by PlaceFile
+          continue
+        try:
+          st = os.stat(self._ObjectPath(sha256))
+        except OSError:
+          continue
+        used = index['objects'].get(sha256, {}).get('used', 0)
+        on_disk.append((used, sha256, st.st_size))
+    present = set(sha256 for _, sha256, _ in on_disk)
+    for sha256 in index['objects'].keys():
+      if sha256 not in present:
+        self._Forget(index, sha256)
+    total = sum(size for _, _, size in on_disk)
+    for used, sha256, size in sorted(on_disk):
+      if total <= self.quota:
+        break
+      if sha256 == keep:
+        continue
+      logging.info('Evicting artifact %s of %d bytes.', sha256, size)
+      try:
+        os.remove(self._ObjectPath(sha256))
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          logging.warning('Could not evict artifact %s: %s', sha256, e)
+          continue
+      self._Forget(index, sha256)
+      total -= size
+
+  def _Drop(self, sha256):
+    """Delete an object found corrupt or unreadable."""
+    with self._lock:
+      index = self._LoadIndex()
+      try:
+        os.remove(self._ObjectPath(sha256))
+      except OSError:
+        pass
+      self._Forget(index, sha256)
+      self._SaveIndex(index)
+
+  def Fetch(self, url, dest, md5=None):
+    """Place the stored contents of a URL at a local name.
+
+    Args:
+      url: URL the artifact was downloaded from
+      dest: name to place the artifact at, replaced if it exists
+      md5: optional, MD5 hexdigest the URL is published with now; a stored
+           artifact with another MD5 is forgotten for the URL
+    Returns:
+      a dict mapping algorithm name to hexdigest of the artifact, None if
+      the store does not hold it
+    """
+    with self._lock:
+      index = self._LoadIndex()
+      sha256 = index['urls'].get(url)
+      entry = index['objects'].get(sha256) if sha256 else None
+      if not entry:
+        return None
+      if md5 and entry.get('digests', {}).get('md5') != md5:
+        logging.info('%s was republished, not reusing artifact %s.', url,
+                     sha256)
+        del index['urls'][url]
+        self._SaveIndex(index)
+        return None
+      entry['used'] = time.time()
+      self._SaveIndex(index)
+    path = self._ObjectPath(sha256)
+    try:
+      digests = GenerateDigests(path, STORE_DIGEST_ALGORITHMS)
+    except IOError:
+      logging.info('Artifact %s of %s is gone.', sha256, url)
+      self._Drop(sha256)
+      return None
+    if digests.get('sha256') != sha256:
+      logging.warning('Dropping corrupt artifact %s of %s.', sha256, url)
+      self._Drop(sha256)
+      return None
+    try:
+      method = PlaceFile(path, dest, hardlink=False)
+    except (IOError, OSError) as e:
+      logging.warning('Could not place artifact %s at %s: %s', sha256, dest, e)
+      return None
+    RecordDigests(dest, digests)
+    logging.info('Reused %s from the artifact store by %s.', url, method)
+    return digests
+
+  def Add(self, url, filename, digests):
+    """Store a verified download, then evict to fit the quota.
+
+    Args:
+      url: URL the file was downloaded from
+      filename: name of the downloaded file
+      digests: a dict mapping algorithm name to hexdigest of the file, with
+               at least 'sha256'
+    Returns:
+      a boolean, True when the store holds the file
+    """
+    sha256 = digests.get('sha256')
+    if not sha256:
+      return False
+    path = self._ObjectPath(sha256)
+    with self._lock:
+      index = self._LoadIndex()
+      if not os.path.exists(path):
+        try:
+          _MakeDirs(os.path.dirname(path))
+          PlaceFile(filename, path, hardlink=False)
+          os.chmod(path, _OBJECT_MODE)
+        except (IOError, OSError) as e:
+          logging.warning('Could not store %s: %s', filename, e)
+          return False
+        RecordDigests(filename, digests)
+        RecordDigests(path, digests)
+      index['objects'][sha256] = {'size': os.path.getsize(path),
+                                  'used': time.time(), 'digests': digests}
+      index['urls'][url] = sha256
+      self._Evict(index, keep=sha256)
+      self._SaveIndex(index)
+    return True
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_artifact_store module."""
+
+import hashlib
+import json
+import logging
+import mox
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import cb_artifact_store
+import cb_url_lib
+from cb_archive_hashing_lib import GenerateDigests, STORE_DIGEST_ALGORITHMS
+from cb_test_http_server import StandInServer
+
+
+class _StoreTestCase(unittest.TestCase):
+  """Creates a store and a work directory in a temporary directory."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.root = os.path.join(self.test_dir, 'store')
+    self.work_dir = os.path.join(self.test_dir, 'work')
+    os.makedirs(self.work_dir)
+    self.store = cb_artifact_store.ArtifactStore(self.root, quota=1000)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _WriteFile(self, name, content):
+    filename = os.path.join(self.work_dir, name)
+    with open(filename, 'wb') as new_file:
+      new_file.write(content)
+    return (filename, GenerateDigests(filename, STORE_DIGEST_ALGORITHMS))
+
+
+class TestPlaceFile(_StoreTestCase):
+  """Unit tests related to PlaceFile."""
+
+  def setUp(self):
+    _StoreTestCase.setUp(self)
+    self.mox = mox.Mox()
+    (self.source, _) = self._WriteFile('source', 'contents')
+    self.dest = os.path.join(self.work_dir, 'dest')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    _StoreTestCase.tearDown(self)
+
+  def testLinkedOrCloned(self):
+    """Verify the contents are placed without a copy on one file system."""
+    method = cb_artifact_store.PlaceFile(self.source, self.dest)
+    self.assertTrue(method in ('reflink', 'hardlink'))
+    with open(self.dest) as dest:
+      self.assertEqual('contents', dest.read())
+
+  def testKernelCopy(self):
+    """Verify an in-kernel copy is made when hardlinks are disallowed."""
+    self.mox.StubOutWithMock(cb_artifact_store, '_Reflink')
+    cb_artifact_store._Reflink(self.source, mox.IgnoreArg()).AndRaise(IOError)
+    self.mox.ReplayAll()
+    method = cb_artifact_store.PlaceFile(self.source, self.dest,
+                                        hardlink=False)
+    self.mox.VerifyAll()
+    self.assertTrue(method in ('copy_file_range', 'sendfile'))
+    self.assertNotEqual(os.stat(self.source).st_ino,
+                        os.stat(self.dest).st_ino)
+    with open(self.dest) as dest:
+      self.assertEqual('contents', dest.read())
+
+  def testKernelCopyOfLargeFile(self):
+    """Verify an in-kernel copy takes as many calls as needed."""
+    saved_chunk = cb_artifact_store.KERNEL_COPY_CHUNK
+    cb_artifact_store.KERNEL_COPY_CHUNK = 1000
+    content = os.urandom(4500)
+    with open(self.source, 'wb') as source:
+      source.write(content)
+    try:
+      cb_artifact_store._KernelCopy(self.source, self.dest)
+    finally:
+      cb_artifact_store.KERNEL_COPY_CHUNK = saved_chunk
+    with open(self.dest, 'rb') as dest:
+      self.assertEqual(content, dest.read())
+
+  def testCopyFallback(self):
+    """Verify a copy is made when no cheaper way works."""
+    self.mox.StubOutWithMock(cb_artifact_store, '_Reflink')
+    self.mox.StubOutWithMock(os, 'link')
+    self.mox.StubOutWithMock(cb_artifact_store, '_KernelCopy')
+    cb_artifact_store._Reflink(self.source, mox.IgnoreArg()).AndRaise(IOError)
+    os.link(self.source, mox.IgnoreArg()).AndRaise(OSError)
+    cb_artifact_store._KernelCopy(self.source,
+                                  mox.IgnoreArg()).AndRaise(IOError)
+    self.mox.ReplayAll()
+    with open(self.dest, 'w') as dest:
+      dest.write('old')
+    self.assertEqual('copy', cb_artifact_store.PlaceFile(self.source,
+                                                          self.dest))
+    self.mox.VerifyAll()
+    with open(self.dest) as dest:
+      self.assertEqual('contents', dest.read())
+    self.assertEqual(['dest', 'source'], sorted(os.listdir(self.work_dir)))
+
+
+class TestArtifactStore(_StoreTestCase):
+  """Unit tests related to ArtifactStore."""
+
+  def testRoundTrip(self):
+    """Verify a stored download is handed out by URL."""
+    (filename, digests) = self._WriteFile('image.bin', 'a' * 100)
+    self.assertTrue(self.store.Add('http://x/image.bin', filename, digests))
+    os.remove(filename)
+    dest = os.path.join(self.work_dir, 'copy.bin')
+    self.assertEqual(digests, self.store.Fetch('http://x/image.bin', dest))
+    with open(dest) as dest_file:
+      self.assertEqual('a' * 100, dest_file.read())
+
+  def testSharedBetweenStores(self):
+    """Verify another store on the same root, e.g. of another run, sees it."""
+    (filename, digests) = self._WriteFile('image.bin', 'a' * 100)
+    self.store.Add('http://x/image.bin', filename, digests)
+    other = cb_artifact_store.ArtifactStore(self.root)
+    self.assertEqual(digests, other.Fetch(
+        'http://x/image.bin', os.path.join(self.work_dir, 'copy.bin')))
+
+  def testUnknownUrl(self):
+    """Verify None for a URL never stored."""
+    self.assertEqual(None, self.store.Fetch(
+        'http://x/image.bin', os.path.join(self.work_dir, 'image.bin')))
+
+  def testSameContentStoredOnce(self):
+    """Verify two URLs with identical contents share one object."""
+    (filename, digests) = self._WriteFile('a.bin', 'same')
+    self.store.Add('http://x/a.bin', filename, digests)
+    (filename, digests) = self._WriteFile('b.bin', 'same')
+    self.store.Add('http://y/b.bin', filename, digests)
+    objects = os.path.join(self.root, 'objects', digests['sha256'][:2])
+    self.assertEqual([digests['sha256']], os.listdir(objects))
+
+  def testDirectoriesShared(self):
+    """Verify directories are group writable whatever the umask."""
+    (filename, digests) = self._WriteFile('image.bin', 'a' * 100)
+    umask = os.umask(022)
+    try:
+      self.store.Add('http://x/image.bin', filename, digests)
+    finally:
+      os.umask(umask)
+    objects = os.path.join(self.root, 'objects')
+    for path in [self.root, objects,
+                 os.path.join(objects, digests['sha256'][:2])]:
+      self.assertEqual(02775, stat.S_IMODE(os.stat(path).st_mode))
+
+  def testCorruptObjectDropped(self):
+    """Verify an object changed since stored is not handed out."""
+    (filename, digests) = self._WriteFile('image.bin', 'a' * 100)
+    self.store.Add('http://x/image.bin', filename, digests)
+    path = self.store._ObjectPath(digests['sha256'])
+    os.chmod(path, 0644)
+    with open(path, 'wb') as corrupt:
+      corrupt.write('b' * 100)
+    self.assertEqual(None, self.store.Fetch(
+        'http://x/image.bin', os.path.join(self.work_dir, 'copy.bin')))
+    self.assertFalse(os.path.exists(path))
+
+  def testLeastRecentlyUsedEvicted(self):
+    """Verify the least recently used objects go once over quota."""
+    stored = []
+    for name in ['a', 'b', 'c']:
+      (filename, digests) = self._WriteFile(name, name * 400)
+      self.store.Add('http://x/' + name, filename, digests)
+      stored.append(digests['sha256'])
+      if name == 'b':
+        # 'a' used after 'b' was stored
+        self.store.Fetch('http://x/a', os.path.join(self.work_dir, 'a2'))
+    self.assertTrue(os.path.exists(self.store._ObjectPath(stored[0])))
+    self.assertFalse(os.path.exists(self.store._ObjectPath(stored[1])))
+    self.assertTrue(os.path.exists(self.store._ObjectPath(stored[2])))
+    self.assertEqual(None, self.store.Fetch(
+        'http://x/b', os.path.join(self.work_dir, 'b2')))
+
+  def testNewObjectKept(self):
+    """Verify an object larger than the quota is still kept once added."""
+    (filename, digests) = self._WriteFile('big', 'x' * 2000)
+    self.assertTrue(self.store.Add('http://x/big', filename, digests))
+    self.assertTrue(os.path.exists(self.store._ObjectPath(digests['sha256'])))
+
+  def testUnindexedFilesEvictedFirst(self):
+    """Verify objects missing from the index count and are evicted first."""
+    (filename, digests) = self._WriteFile('a', 'a' * 400)
+    self.store.Add('http://x/a', filename, digests)
+    with open(os.path.join(self.root, 'index.json'), 'w') as index:
+      json.dump({}, index)
+    (filename, digests) = self._WriteFile('b', 'b' * 700)
+    self.store.Add('http://x/b', filename, digests)
+    self.assertEqual(
+        [hashlib.sha256('b' * 700).hexdigest()],
+        [sha for subdir in os.listdir(os.path.join(self.root, 'objects'))
+         for sha in os.listdir(os.path.join(self.root, 'objects', subdir))])
+
+
+class TestDownloadWithStore(_StoreTestCase):
+  """Unit tests related to DownloadWithDigests sharing an artifact store."""
+
+  def setUp(self):
+    _StoreTestCase.setUp(self)
+    self.saved_workdir = cb_url_lib.WORKDIR
+    cb_url_lib.WORKDIR = self.work_dir
+    cb_url_lib.SetArtifactStore(self.store)
+    self.content = os.urandom(500)
+    self.server = StandInServer(
+        {'/image.bin': self.content,
+         '/image.bin.md5': hashlib.md5(self.content).hexdigest()}).Start()
+    self.url = self.server.url + '/image.bin'
+
+  def _ImageRequests(self):
+    return [path for (_, path, _) in self.server.requests
+            if path == '/image.bin']
+
+  def tearDown(self):
+    self.server.Stop()
+    cb_url_lib.SetArtifactStore(None)
+    cb_url_lib.WORKDIR = self.saved_workdir
+    _StoreTestCase.tearDown(self)
+
+  def testDownloadedOnce(self):
+    """Verify a second download of a URL is served from the store."""
+    first = cb_url_lib.DownloadWithDigests(self.url)
+    os.remove(os.path.join(self.work_dir, 'image.bin'))
+    self.assertEqual(first, cb_url_lib.DownloadWithDigests(self.url))
+    self.assertEqual(1, len(self._ImageRequests()))
+    with open(os.path.join(self.work_dir, 'image.bin'), 'rb') as image:
+      self.assertEqual(self.content, image.read())
+
+  def testRepublishedDownloadedAgain(self):
+    """Verify an artifact whose published MD5 changed is not reused."""
+    cb_url_lib.DownloadWithDigests(self.url)
+    self.content = os.urandom(500)
+    self.server.files['/image.bin'] = self.content
+    self.server.files['/image.bin.md5'] = hashlib.md5(self.content).hexdigest()
+    cb_url_lib.DownloadWithDigests(self.url)
+    self.assertEqual(2, len(self._ImageRequests()))
+    with open(os.path.join(self.work_dir, 'image.bin'), 'rb') as image:
+      self.assertEqual(self.content, image.read())
+
+  def testNotReusedWithoutMd5(self):
+    """Verify an artifact is not reused when its MD5 cannot be fetched."""
+    cb_url_lib.DownloadWithDigests(self.url)
+    del self.server.files['/image.bin.md5']
+    cb_url_lib.DownloadWithDigests(self.url)
+    self.assertEqual(2, len(self._ImageRequests()))
+
+  def testObjectsNotShared(self):
+    """Verify a download never shares its inode with a read-only object."""
+    cb_url_lib.DownloadWithDigests(self.url)
+    local = os.path.join(self.work_dir, 'image.bin')
+    digests = cb_url_lib.DownloadWithDigests(self.url)
+    stored = self.store._ObjectPath(digests['sha256'])
+    self.assertNotEqual(os.stat(local).st_ino, os.stat(stored).st_ino)
+    self.assertEqual(0444, stat.S_IMODE(os.stat(stored).st_mode))
+
+  def testSha256OnlyWithStore(self):
+    """Verify downloads are hashed with SHA-256 only while a store is set."""
+    self.assertEqual(['md5', 'sha256'],
+                     sorted(cb_url_lib.DownloadWithDigests(self.url)))
+    cb_url_lib.SetArtifactStore(None)
+    os.remove(os.path.join(self.work_dir, 'image.bin'))
+    self.assertEqual(['md5'], sorted(cb_url_lib.DownloadWithDigests(self.url)))
+
+  def testUnpromotedDownloadNotStored(self):
+    """Verify a download left for its caller to verify is not stored."""
+    cb_url_lib.DownloadWithDigests(self.url, promote=False)
+    self.assertEqual(None, self.store.Fetch(
+        self.url, os.path.join(self.work_dir, 'copy.bin')))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
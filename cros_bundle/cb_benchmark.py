@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Micro-benchmarks for the factory bundle script.
+
+Usage: ./cb_benchmark.py [--links N] [--compress_mb N [--jobs N]
+                           [--block_kb N]]
+
+links: parses a synthetic index page of N links with the htmllib parser the
+       link extractor replaced, then with cb_url_lib.UrlLister fed the whole
+       page, fed in LISTING_CHUNK_SIZE chunks, and stopping at the first
+       links matching a token list.
+match: matches the N links against a few token lists, one MatchUrl call
+       per token list, then all at once with one cb_url_lib.UrlMatcher pass.
+compress: compresses N MB of image-like data, runs of random bytes, text
+          and zeros, with one bz2 stream, with the built-in ParallelBzip2
+          and, when installed, with pbzip2 given the same jobs and blocks.
+"""
+
+import bz2
+import formatter
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from cb_archive_hashing_lib import COMPRESS_BLOCK_SIZE, COMPRESS_JOBS, \
+    ParallelBzip2
+from cb_url_lib import LISTING_CHUNK_SIZE, MatchUrl, UrlLister, UrlMatcher
+from htmllib import HTMLParser
+from cb_util import RunCommand
+from optparse import OptionParser
+
+NUM_LINKS = 100000
+
+
+class _HtmllibLister(HTMLParser):
+  """The htmllib based link lister UrlLister replaced, for comparison."""
+
+  def __init__(self):
+    HTMLParser.__init__(self, formatter.NullFormatter())
+    self.urls = []
+
+  def start_a(self, attrs):
+    self.urls.extend([v for k, v in attrs if k == 'href'])
+
+
+def SyntheticListing(num_links):
+  """Returns an index page like those of busy channels.
+
+  Args:
+    num_links: an integer, number of links listed
+  Returns:
+    a string, the html page
+  """
+  rows = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">',
+          '<html><head><title>Index of /dev-channel/board</title></head>',
+          '<body><table><tr><th><a href="?C=N;O=D">Name</a></th></tr>',
+          '<tr><td><a href="/dev-channel/">Parent Directory</a></td></tr>']
+  for index in xrange(num_links):
+    name = 'chromeos_%d.%d.0_board_recovery_dev-channel_mp-v2.bin' % (
+        index / 100, index % 100)
+    rows.append('<tr><td><img src="/icons/binary.gif" alt="[   ]"></td>'
+                '<td><a href="%s">%s</a></td><td align="right">'
+                '12-Oct-2011 10:00  </td><td align="right">1.1G</td></tr>' %
+                (name, name))
+  rows.append('</table></body></html>')
+  return '\n'.join(rows)
+
+
+def _Time(parse, page):
+  """Returns (seconds, number of links) of one parse of a page."""
+  start = time.time()
+  urls = parse(page)
+  return (time.time() - start, len(urls))
+
+
+def _ParseHtmllib(page):
+  parser = _HtmllibLister()
+  parser.feed(page)
+  parser.close()
+  return parser.urls
+
+
+def _ParseWhole(page):
+  parser = UrlLister()
+  parser.feed(page)
+  parser.close()
+  return parser.urls
+
+
+def _ParseChunked(page):
+  parser = UrlLister()
+  for start in xrange(0, len(page), LISTING_CHUNK_SIZE):
+    parser.feed(page[start:start + LISTING_CHUNK_SIZE])
+  parser.close()
+  return parser.urls
+
+
+def _ParseEarlyStop(page):
+  token_list = ['chromeos', '5.0.0', 'recovery', '.bin']
+  parser = UrlLister(accept=UrlMatcher([token_list]).Accepts, limit=2)
+  for start in xrange(0, len(page), LISTING_CHUNK_SIZE):
+    if parser.done:
+      break
+    parser.feed(page[start:start + LISTING_CHUNK_SIZE])
+  parser.close()
+  return parser.urls
+
+
+def BenchmarkLinks(num_links):
+  """Times link extraction from a synthetic index page.
+
+  Args:
+    num_links: an integer, number of links listed on the page
+  Returns:
+    a list of (description, seconds, number of links found) tuples
+  """
+  page = SyntheticListing(num_links)
+  results = []
+  for desc, parse in [('htmllib UrlLister', _ParseHtmllib),
+                      ('streaming, whole page', _ParseWhole),
+                      ('streaming, %d KB chunks' % (LISTING_CHUNK_SIZE / 1024),
+                       _ParseChunked),
+                      ('streaming, stop at match', _ParseEarlyStop)]:
+    (seconds, found) = _Time(parse, page)
+    results.append((desc, seconds, found))
+  return results
+
+
+def BenchmarkMatch(num_links, num_token_lists=4):
+  """Times matching token lists against a synthetic listing.
+
+  Args:
+    num_links: an integer, number of links listed
+    num_token_lists: an integer, number of token lists to match
+  Returns:
+    a list of (description, seconds, number of token lists matched) tuples
+  """
+  parser = UrlLister()
+  parser.feed(SyntheticListing(num_links))
+  parser.close()
+  links = parser.urls
+  # spread the versions looked for over the listing, like releases of
+  # several boards looked up in one channel
+  step = max(1, num_links / num_token_lists)
+  token_lists = [['chromeos_%d.%d.0_' % (index / 100, index % 100),
+                  'recovery', '.bin']
+                 for index in xrange(0, num_links, step)][:num_token_lists]
+  start = time.time()
+  found = [MatchUrl(links, token_list) for token_list in token_lists]
+  results = [('MatchUrl per token list', time.time() - start,
+              len(filter(None, found)))]
+  start = time.time()
+  found = UrlMatcher(token_lists).Match(links)
+  results.append(('UrlMatcher, one pass', time.time() - start,
+                  len(filter(None, found))))
+  return results
+
+
+def SyntheticImage(name, size_mb):
+  """Write a file compressing about as well as a disk image.
+
+  Args:
+    name: name of the file to write
+    size_mb: an integer, MB to write
+  """
+  text = ''.join('/usr/lib/libfoo.so.%d\n' % index for index in xrange(2048))
+  with open(name, 'wb') as image:
+    for _ in xrange(size_mb):
+      # a third of each MB random, as compressed files, the rest text and
+      # zeros
+      image.write(os.urandom(340 * 1024) + text[:340 * 1024] +
+                  '\0' * (344 * 1024))
+
+
+def _CompressSerially(source, out, jobs, block_size):
+  compressor = bz2.BZ2Compressor(9)
+  while True:
+    data = source.read(block_size)
+    if not data:
+      break
+    out.write(compressor.compress(data))
+  out.write(compressor.flush())
+
+
+def _CompressPbzip2(source, out, jobs, block_size):
+  subprocess.check_call(['pbzip2', '-c', '-9', '-p%d' % jobs,
+                         '-b%d' % max(1, block_size / 100000)],
+                        stdin=source, stdout=out)
+
+
+def BenchmarkCompression(size_mb, jobs=COMPRESS_JOBS,
+                         block_size=COMPRESS_BLOCK_SIZE):
+  """Times bz2 compressors on the same synthetic image.
+
+  Args:
+    size_mb: an integer, MB of input
+    jobs: an integer, processes of the parallel compressors
+    block_size: an integer, bytes per block of the parallel compressors
+  Returns:
+    a list of (description, seconds, compressed bytes) tuples
+  """
+  compressors = [('bz2, one stream', _CompressSerially),
+                 ('ParallelBzip2, %d jobs' % jobs, ParallelBzip2)]
+  if RunCommand(['which', 'pbzip2'], redirect_stdout=True).output:
+    compressors.append(('pbzip2, %d jobs' % jobs, _CompressPbzip2))
+  work_dir = tempfile.mkdtemp()
+  try:
+    image = os.path.join(work_dir, 'image.bin')
+    SyntheticImage(image, size_mb)
+    compressed = os.path.join(work_dir, 'image.bin.bz2')
+    results = []
+    for desc, compress in compressors:
+      with open(image, 'rb') as source:
+        with open(compressed, 'wb') as out:
+          start = time.time()
+          compress(source, out, jobs, block_size)
+          seconds = time.time() - start
+      results.append((desc, seconds, os.path.getsize(compressed)))
+    return results
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def main():
+  parser = OptionParser(usage=__doc__)
+  parser.add_option('--links', action='store', type='int', dest='links',
+                    default=NUM_LINKS, help='links on the synthetic page')
+  parser.add_option('--compress_mb', action='store', type='int',
+                    dest='compress_mb', default=0,
+                    help='MB of synthetic image to compress, 0 to skip')
+  parser.add_option('--jobs', action='store', type='int', dest='jobs',
+                    default=COMPRESS_JOBS,
+                    help='processes of the parallel compressors')
+  parser.add_option('--block_kb', action='store', type='int',
+                    dest='block_kb', default=COMPRESS_BLOCK_SIZE / 1000,
+                    help='KB per block of the parallel compressors')
+  (options, _) = parser.parse_args()
+  print 'Extracting links from a page of %d links:' % options.links
+  for desc, seconds, found in BenchmarkLinks(options.links):
+    print '  %-28s %8.3f s  %7d links' % (desc, seconds, found)
+  for num_token_lists in [4, 40]:
+    print 'Matching %d token lists against %d links:' % (num_token_lists,
+                                                        options.links)
+    for desc, seconds, found in BenchmarkMatch(options.links, num_token_lists):
+      print '  %-28s %8.3f s  %7d matched' % (desc, seconds, found)
+  if options.compress_mb:
+    print 'Compressing %d MB of synthetic image:' % options.compress_mb
+    for desc, seconds, size in BenchmarkCompression(
+        options.compress_mb, options.jobs, options.block_kb * 1000):
+      print '  %-28s %8.3f s  %7.1f MB/s  %7d KB' % (
+          desc, seconds, options.compress_mb / max(seconds, 1e-6), size / 1024)
+
+
+if __name__ == "__main__":
+  main()
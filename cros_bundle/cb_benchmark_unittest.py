@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_benchmark module."""
+
+import logging
+import unittest
+
+import cb_benchmark
+
+
+class TestBenchmarkLinks(unittest.TestCase):
+  """Unit tests related to BenchmarkLinks."""
+
+  def testParsersAgree(self):
+    """Verify the streaming lister finds what the htmllib parser finds."""
+    page = cb_benchmark.SyntheticListing(500)
+    self.assertEqual(cb_benchmark._ParseHtmllib(page),
+                     cb_benchmark._ParseChunked(page))
+
+  def testLinksCounted(self):
+    """Verify every parser but the early stopping one sees every link."""
+    results = cb_benchmark.BenchmarkLinks(600)
+    self.assertEqual([602, 602, 602, 1], [found for _, _, found in results])
+
+
+class TestBenchmarkMatch(unittest.TestCase):
+  """Unit tests related to BenchmarkMatch."""
+
+  def testMatchersAgree(self):
+    """Verify MatchUrl and UrlMatcher resolve every token list."""
+    results = cb_benchmark.BenchmarkMatch(600, 8)
+    self.assertEqual([8, 8], [found for _, _, found in results])
+
+
+class TestBenchmarkCompression(unittest.TestCase):
+  """Unit tests related to BenchmarkCompression."""
+
+  def testParallelCompressesAsWell(self):
+    """Verify blocks cost little ratio over a single bz2 stream."""
+    results = cb_benchmark.BenchmarkCompression(2, jobs=2)
+    (serial, parallel) = [size for _, _, size in results[:2]]
+    self.assertTrue(parallel < serial * 1.05)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
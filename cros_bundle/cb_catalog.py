@@ -0,0 +1,394 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains a local SQLite catalog of known image artifacts.
+
+The catalog records the files of each release directory crawled, with their
+board, version, channel, signing key and type, so images are resolved with
+indexed queries rather than by listing index pages on every run.
+
+Usage: ./cb_catalog.py -b BOARD -c CHANNEL [-c CHANNEL ...] [--recrawl]
+       ./cb_catalog.py -b BOARD -c CHANNEL --latest [--type TYPE] [--key KEY]
+
+The first form crawls the release directories of each board and channel
+under every naming scheme into the catalog, skipping directories already
+catalogued. The second prints the latest version catalogued.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from cb_constants import CATALOG, IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX
+from cb_gs_index import GsIndex
+from cb_name_lib import GetBoardUrl, NUM_NAMING_SCHEMES
+from cb_transport import Rewrite
+from cb_url_lib import ListUrls
+from optparse import OptionParser
+
+# Bumped whenever the tables change, an older catalog is rebuilt.
+SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+  index_url TEXT PRIMARY KEY,
+  board TEXT,
+  channel TEXT,
+  version TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+  url TEXT PRIMARY KEY,
+  index_url TEXT NOT NULL,
+  name TEXT NOT NULL,
+  board TEXT,
+  version TEXT,
+  channel TEXT,
+  key TEXT,
+  type TEXT,
+  size INTEGER,
+  md5 TEXT
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_listing ON artifacts (index_url);
+CREATE INDEX IF NOT EXISTS artifacts_by_release
+    ON artifacts (board, channel, type, version);
+"""
+
+# Artifact types, named after the bundle input each one is fetched for.
+FACTORY = 'factory'
+RECOVERY = 'recovery'
+RELEASE = 'release'
+SHIM = 'shim'
+ARTIFACT_TYPES = [FACTORY, RECOVERY, RELEASE, SHIM]
+# Lower-cased file name patterns of each type, the signing key grouped.
+_ARTIFACT_RES = [
+    (RECOVERY, re.compile(r'^chromeos_.*_recovery_[^_]+-channel_([^_]+)\.bin$')),
+    (RELEASE, re.compile(r'^chromeos_.*_ssd_[^_]+-channel_([^_]+)\.bin$')),
+    (SHIM, re.compile(r'^chromeos_.*_factory_[^_]+-channel_([^_]+)\.bin$')),
+    (FACTORY, re.compile(r'^chromeos-factory-.*\.zip()$'))]
+
+
+def ParseReleaseUrl(index_url):
+  """Determine board, channel and version of a release directory URL.
+
+  Every naming scheme hosts releases under .../<channel>/<board>/<version>.
+
+  Args:
+    index_url: URL of a release directory
+  Returns:
+    a tuple (board, channel, version), channel as given in version strings,
+    e.g. dev; (None, None, None) if the URL is too short
+  """
+  parts = index_url.rstrip('/').split('/')
+  if len(parts) < 3:
+    return (None, None, None)
+  (channel, board, version) = parts[-3:]
+  if board.endswith('-rc'):
+    board = board[:-len('-rc')]
+  if channel.endswith('-channel'):
+    channel = channel[:-len('-channel')]
+  return (board, channel, version)
+
+
+def ClassifyName(name):
+  """Determine the type and signing key of an artifact from its file name.
+
+  Args:
+    name: file name of the artifact
+  Returns:
+    a tuple (type, key), type one of ARTIFACT_TYPES, key a string or None;
+    (None, None) for other files, e.g. checksums
+  """
+  name = name.lower()
+  for artifact_type, regex in _ARTIFACT_RES:
+    match = regex.match(name)
+    if match:
+      return (artifact_type, match.group(1) or None)
+  return (None, None)
+
+
+def _VersionKey(version):
+  """Returns a key sorting version strings by their numeric components."""
+  return [int(number) for number in re.findall(r'\d+', version)]
+
+
+class ArtifactCatalog(object):
+
+  """A SQLite catalog of the files of release directories.
+
+  It contains the following fields:
+  - path: name of the SQLite database file
+
+  A release directory is catalogued as a whole, each listing replacing the
+  previous one. A corrupt catalog, or one of an older schema, is rebuilt
+  empty. Queries from several threads are serialized on one connection.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    try:
+      self._db = self._Open()
+    except sqlite3.DatabaseError as e:
+      logging.warning('Rebuilding unreadable catalog %s: %s', path, e)
+      os.remove(path)
+      self._db = self._Open()
+
+  def _Open(self):
+    """Returns a connection to the catalog, creating its tables if needed."""
+    db = sqlite3.connect(self.path, check_same_thread=False)
+    try:
+      version = db.execute('PRAGMA user_version').fetchone()[0]
+      if version not in (0, SCHEMA_VERSION):
+        logging.info('Rebuilding catalog %s of schema %d.', self.path, version)
+        db.executescript('DROP TABLE IF EXISTS listings;'
+                         'DROP TABLE IF EXISTS artifacts;')
+      db.executescript(_SCHEMA)
+      db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    except sqlite3.DatabaseError:
+      db.close()
+      raise
+    return db
+
+  def Close(self):
+    """Close the connection to the catalog."""
+    with self._lock:
+      self._db.close()
+
+  def Listing(self, index_url):
+    """Returns the URLs of the files catalogued in a release directory.
+
+    Args:
+      index_url: URL of the release directory, as given to DetermineUrl
+    Returns:
+      a list of strings, full URLs, None if the directory is not catalogued
+    """
+    with self._lock:
+      if not self._db.execute('SELECT 1 FROM listings WHERE index_url = ?',
+                              (index_url,)).fetchone():
+        return None
+      return [row[0] for row in self._db.execute(
+          'SELECT url FROM artifacts WHERE index_url = ? ORDER BY rowid',
+          (index_url,))]
+
+  def AddListing(self, index_url, urls):
+    """Catalog the files of a release directory, replacing any previous list.
+
+    Subdirectories, sorting links and other query URLs are skipped. Size and
+    MD5 recorded for files still listed are kept.
+
+    Args:
+      index_url: URL of the release directory, as given to DetermineUrl
+      urls: a list of strings, full URLs of the files listed
+    """
+    (board, channel, version) = ParseReleaseUrl(index_url)
+    rows = []
+    for url in urls:
+      name = os.path.basename(url)
+      if not name or '?' in url:
+        continue
+      (artifact_type, key) = ClassifyName(name)
+      rows.append((url, index_url, name, board, version, channel, key,
+                   artifact_type))
+    with self._lock:
+      with self._db:
+        checksums = dict(
+            (url, (size, md5)) for url, size, md5 in self._db.execute(
+                'SELECT url, size, md5 FROM artifacts WHERE index_url = ?',
+                (index_url,)))
+        self._db.execute('DELETE FROM artifacts WHERE index_url = ?',
+                         (index_url,))
+        self._db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                         (index_url, board, channel, version))
+        self._db.executemany(
+            'INSERT OR REPLACE INTO artifacts VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [row + checksums.get(row[0], (None, None)) for row in rows])
+    logging.debug('Catalogued %d files of %s.', len(rows), index_url)
+
+  def RecordChecksum(self, url, size, md5):
+    """Record size and MD5 of a catalogued file, e.g. once downloaded.
+
+    Args:
+      url: full URL of the file
+      size: an integer, size of the file in bytes
+      md5: a string, hex MD5 digest of the file
+    """
+    with self._lock:
+      with self._db:
+        self._db.execute('UPDATE artifacts SET size = ?, md5 = ? WHERE url = ?',
+                         (size, md5, url))
+
+  def Find(self, board, channel, artifact_type, version=None, key=None):
+    """Returns the catalogued artifacts of a type.
+
+    Args:
+      board: target board
+      channel: image channel, e.g. dev
+      artifact_type: one of ARTIFACT_TYPES
+      version: optional, only return artifacts of this version
+      key: optional, only return artifacts signed with this key
+    Returns:
+      a list of dicts with keys url, version, key, size and md5, latest
+      version first
+    """
+    query = ('SELECT url, version, key, size, md5 FROM artifacts '
+             'WHERE board = ? AND channel = ? AND type = ?')
+    args = [board, channel, artifact_type]
+    if version:
+      query += ' AND version = ?'
+      args.append(version)
+    if key:
+      query += ' AND key = ?'
+      args.append(key)
+    with self._lock:
+      rows = self._db.execute(query, args).fetchall()
+    artifacts = [dict(zip(['url', 'version', 'key', 'size', 'md5'], row))
+                 for row in rows]
+    artifacts.sort(key=lambda a: _VersionKey(a['version']), reverse=True)
+    return artifacts
+
+  def LatestVersion(self, board, channel, artifact_type=RECOVERY, key=None):
+    """Returns the latest version catalogued for a board and channel.
+
+    Args:
+      board: target board
+      channel: image channel, e.g. dev
+      artifact_type: optional, one of ARTIFACT_TYPES the version must have
+      key: optional, signing key the artifact must have
+    Returns:
+      a string, the version, None if none is catalogued
+    """
+    artifacts = self.Find(board, channel, artifact_type, key=key)
+    return artifacts[0]['version'] if artifacts else None
+
+
+def _CrawlGs(catalog, board_url):
+  """Catalog every release directory of a GSD board with one listing.
+
+  Args:
+    catalog: an ArtifactCatalog
+    board_url: IMAGE_GSD_PREFIX URL of the board directory
+  Returns:
+    an integer, number of release directories catalogued or updated
+  Raises:
+    IOError when the board cannot be listed
+  """
+  prefix = board_url.replace(IMAGE_GSD_PREFIX, IMAGE_GSD_BUCKET)
+  updated = 0
+  for directory, urls in sorted(GsIndex().Directories(prefix).iteritems()):
+    if os.path.dirname(directory) != prefix:
+      continue
+    index_url = directory.replace(IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX)
+    if catalog.Listing(index_url) != urls:
+      catalog.AddListing(index_url, urls)
+      updated += 1
+  return updated
+
+
+def _CrawlHttp(catalog, board_url, recrawl):
+  """Catalog the release directories of a board on an image server.
+
+  Args:
+    catalog: an ArtifactCatalog
+    board_url: URL of the board index page
+    recrawl: a boolean, True to list directories already catalogued again
+  Returns:
+    an integer, number of release directories catalogued or updated
+  Raises:
+    IOError when the board index page cannot be listed
+  """
+  updated = 0
+  for link in ListUrls(board_url):
+    version = link.rstrip('/')
+    if (not link.endswith('/') or not version or '?' in link or
+        '/' in version or version.startswith('.')):
+      continue
+    index_url = os.path.join(board_url, version)
+    if catalog.Listing(index_url) and not recrawl:
+      continue
+    try:
+      links = ListUrls(index_url)
+    except IOError:
+      logging.warning('Could not list %s.', index_url)
+      continue
+    catalog.AddListing(index_url,
+                       [os.path.join(index_url, link) for link in links])
+    updated += 1
+  return updated
+
+
+def RefreshCatalog(catalog, board, channel, recrawl=False):
+  """Crawl the release directories of a board and channel into a catalog.
+
+  The board directory is listed under every naming scheme. Release
+  directories already catalogued with files are only listed again when
+  recrawl is set, except on GSD where a single listing covers them all.
+
+  Args:
+    catalog: an ArtifactCatalog
+    board: target board
+    channel: image channel, e.g. dev
+    recrawl: optional, True to list every release directory again
+  Returns:
+    an integer, number of release directories catalogued or updated
+  """
+  updated = 0
+  for alt_naming in range(NUM_NAMING_SCHEMES):
+    board_url = GetBoardUrl(board, channel, alt_naming)
+    try:
+      if board_url.startswith(IMAGE_GSD_PREFIX) and (
+          Rewrite(board_url) == board_url):
+        updated += _CrawlGs(catalog, board_url)
+      else:
+        updated += _CrawlHttp(catalog, board_url, recrawl)
+    except IOError as e:
+      logging.info('Naming scheme %d lists nothing for %s/%s: %s', alt_naming,
+                   board, channel, e)
+  logging.info('Catalogued %d release directories of %s/%s.', updated, board,
+               channel)
+  return updated
+
+
+def main():
+  parser = OptionParser(usage=__doc__)
+  parser.add_option('-b', '--board', action='append', dest='boards',
+                    default=[], help='board to crawl, may be repeated')
+  parser.add_option('-c', '--channel', action='append', dest='channels',
+                    default=[], help='channel to crawl, e.g. dev, may be '
+                                     'repeated')
+  parser.add_option('--catalog', action='store', dest='catalog',
+                    default=CATALOG, help='SQLite catalog file')
+  parser.add_option('--recrawl', action='store_true', dest='recrawl',
+                    default=False,
+                    help='list release directories already catalogued again')
+  parser.add_option('--latest', action='store_true', dest='latest',
+                    default=False,
+                    help='print the latest version catalogued, do not crawl')
+  parser.add_option('--type', action='store', type='choice', dest='type',
+                    choices=ARTIFACT_TYPES, default=RECOVERY,
+                    help='artifact type --latest looks for')
+  parser.add_option('--key', action='store', dest='key',
+                    help='signing key --latest looks for, e.g. mp-v2')
+  (options, _) = parser.parse_args()
+  if not options.boards or not options.channels:
+    parser.error('at least one board and one channel are required')
+  logging.basicConfig(level=logging.INFO)
+  catalog_dir = os.path.dirname(os.path.abspath(options.catalog))
+  if not os.path.exists(catalog_dir):
+    os.makedirs(catalog_dir)
+  catalog = ArtifactCatalog(options.catalog)
+  for board in options.boards:
+    for channel in options.channels:
+      if options.latest:
+        print '%s/%s: %s' % (board, channel, catalog.LatestVersion(
+            board, channel, options.type, options.key))
+      else:
+        RefreshCatalog(catalog, board, channel, options.recrawl)
+  catalog.Close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_catalog module."""
+
+import logging
+import mox
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import cb_catalog
+import cb_url_lib
+from cb_constants import IMAGE_GSD_PREFIX, IMAGE_SERVER_PREFIX
+from cb_test_http_server import StandInServer
+
+_TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'testdata')
+_STUMPY = 'gs://chromeos-releases/dev-channel/stumpy'
+_STUMPY_HTTP = IMAGE_GSD_PREFIX + '/dev-channel/stumpy'
+_RECOVERY = 'chromeos_%s_stumpy_recovery_dev-channel_mp-v2.bin'
+
+
+class TestParseReleaseUrl(unittest.TestCase):
+  """Unit tests related to ParseReleaseUrl."""
+
+  def testNamingSchemes(self):
+    """Verify board, channel and version under each naming scheme."""
+    expected = ('stumpy', 'dev', '1235.3.0')
+    self.assertEqual(expected, cb_catalog.ParseReleaseUrl(
+        IMAGE_SERVER_PREFIX + '/dev-channel/stumpy/1235.3.0'))
+    self.assertEqual(expected, cb_catalog.ParseReleaseUrl(
+        IMAGE_SERVER_PREFIX + '/dev-channel/stumpy-rc/1235.3.0/'))
+    self.assertEqual(expected, cb_catalog.ParseReleaseUrl(
+        _STUMPY_HTTP + '/1235.3.0'))
+
+  def testShortUrl(self):
+    """Verify Nones for a URL too short to hold a release."""
+    self.assertEqual((None, None, None), cb_catalog.ParseReleaseUrl('a/b'))
+
+
+class TestClassifyName(unittest.TestCase):
+  """Unit tests related to ClassifyName."""
+
+  def testArtifactTypes(self):
+    """Verify type and signing key of each kind of image."""
+    self.assertEqual(('recovery', 'mp-v2'),
+                     cb_catalog.ClassifyName(_RECOVERY % '1235.3.0'))
+    self.assertEqual(('release', 'mp'), cb_catalog.ClassifyName(
+        'chromeos_0.12.433.269_x86-alex_ssd_stable-channel_mp.bin'))
+    self.assertEqual(('shim', 'mp-v2'), cb_catalog.ClassifyName(
+        'chromeos_1235.4.0_stumpy_factory_dev-channel_mp-v2.bin'))
+    self.assertEqual(('factory', None), cb_catalog.ClassifyName(
+        'ChromeOS-factory-R17-1235.3.0-a1-b2-stumpy.zip'))
+
+  def testOtherFiles(self):
+    """Verify checksums and other files have no type."""
+    self.assertEqual((None, None),
+                     cb_catalog.ClassifyName(_RECOVERY % '1.0' + '.md5'))
+    self.assertEqual((None, None), cb_catalog.ClassifyName('au-generator.zip'))
+
+
+class _CatalogTestCase(unittest.TestCase):
+  """Opens a catalog in a temporary directory."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.test_dir, 'catalog.sqlite')
+    self.catalog = cb_catalog.ArtifactCatalog(self.path)
+
+  def tearDown(self):
+    self.catalog.Close()
+    shutil.rmtree(self.test_dir)
+
+  def _AddRelease(self, version, names=None, board_url=_STUMPY_HTTP):
+    index_url = board_url + '/' + version
+    if names is None:
+      names = [_RECOVERY % version, _RECOVERY % version + '.md5']
+    self.catalog.AddListing(index_url,
+                            [index_url + '/' + name for name in names])
+    return index_url
+
+
+class TestArtifactCatalog(_CatalogTestCase):
+  """Unit tests related to ArtifactCatalog."""
+
+  def testListing(self):
+    """Verify a catalogued directory lists its files, others None."""
+    index_url = self._AddRelease('1.0', ['b.bin', 'a.bin', '', '?C=N;O=D'])
+    self.assertEqual([index_url + '/b.bin', index_url + '/a.bin'],
+                     self.catalog.Listing(index_url))
+    self.assertEqual(None, self.catalog.Listing(_STUMPY_HTTP + '/2.0'))
+
+  def testEmptyListing(self):
+    """Verify a directory catalogued without files lists empty."""
+    index_url = self._AddRelease('1.0', [])
+    self.assertEqual([], self.catalog.Listing(index_url))
+
+  def testPersistent(self):
+    """Verify the catalog is read back from disk."""
+    index_url = self._AddRelease('1.0')
+    self.catalog.Close()
+    self.catalog = cb_catalog.ArtifactCatalog(self.path)
+    self.assertEqual(2, len(self.catalog.Listing(index_url)))
+
+  def testListingReplaced(self):
+    """Verify a new listing replaces the old one, keeping checksums."""
+    index_url = self._AddRelease('1.0')
+    url = index_url + '/' + _RECOVERY % '1.0'
+    self.catalog.RecordChecksum(url, 42, 'abc')
+    self._AddRelease('1.0', [_RECOVERY % '1.0', 'new.zip'])
+    self.assertEqual([url, index_url + '/new.zip'],
+                     self.catalog.Listing(index_url))
+    artifact = self.catalog.Find('stumpy', 'dev', cb_catalog.RECOVERY)[0]
+    self.assertEqual((42, 'abc'), (artifact['size'], artifact['md5']))
+
+  def testFind(self):
+    """Verify artifacts of a type are found, latest version first."""
+    self._AddRelease('1235.9.0')
+    self._AddRelease('1235.10.0')
+    self._AddRelease('1235.11.0', ['chromeos_1235.11.0_stumpy_recovery_'
+                                   'dev-channel_premp.bin'])
+    found = self.catalog.Find('stumpy', 'dev', cb_catalog.RECOVERY)
+    self.assertEqual(['1235.11.0', '1235.10.0', '1235.9.0'],
+                     [artifact['version'] for artifact in found])
+    found = self.catalog.Find('stumpy', 'dev', cb_catalog.RECOVERY,
+                              version='1235.9.0', key='mp-v2')
+    self.assertEqual([_STUMPY_HTTP + '/1235.9.0/' + _RECOVERY % '1235.9.0'],
+                     [artifact['url'] for artifact in found])
+    self.assertEqual([], self.catalog.Find('stumpy', 'beta',
+                                           cb_catalog.RECOVERY))
+
+  def testLatestVersion(self):
+    """Verify the latest version is compared numerically."""
+    self._AddRelease('1235.9.0')
+    self._AddRelease('1235.10.0')
+    self._AddRelease('1236.0.0', ['ChromeOS-factory-R17-1236.0.0-stumpy.zip'])
+    self.assertEqual('1235.10.0',
+                     self.catalog.LatestVersion('stumpy', 'dev'))
+    self.assertEqual('1236.0.0', self.catalog.LatestVersion(
+        'stumpy', 'dev', cb_catalog.FACTORY))
+    self.assertEqual(None, self.catalog.LatestVersion('stumpy', 'dev',
+                                                      key='premp'))
+
+  def testCorruptCatalogRebuilt(self):
+    """Verify an unreadable catalog file is rebuilt empty."""
+    self.catalog.Close()
+    with open(self.path, 'w') as catalog_file:
+      catalog_file.write('not a database' * 100)
+    self.catalog = cb_catalog.ArtifactCatalog(self.path)
+    self.assertEqual(None, self.catalog.Listing(_STUMPY_HTTP + '/1.0'))
+    self._AddRelease('1.0')
+
+  def testConcurrentUse(self):
+    """Verify the catalog can be used from several threads."""
+    threads = [threading.Thread(target=self._AddRelease, args=('1.%d' % i,))
+               for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(8, len(self.catalog.Find('stumpy', 'dev',
+                                              cb_catalog.RECOVERY)))
+
+
+class TestRefreshCatalog(_CatalogTestCase):
+  """Unit tests related to RefreshCatalog, against a fake gsutil."""
+
+  def setUp(self):
+    _CatalogTestCase.setUp(self)
+    self.mox = mox.Mox()
+    self.mox.StubOutWithMock(cb_catalog, 'ListUrls')
+    os.symlink(os.path.join(_TESTDATA, 'fake_gsutil'),
+               os.path.join(self.test_dir, 'gsutil'))
+    self.saved_env = dict(os.environ)
+    os.environ['PATH'] = self.test_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_GSUTIL_LOG'] = os.path.join(self.test_dir, 'gsutil.log')
+    os.environ['FAKE_GSUTIL_LISTING'] = os.path.join(
+        _TESTDATA, 'gsutil_ls_recursive.txt')
+    self.board_url = IMAGE_SERVER_PREFIX + '/dev-channel/stumpy'
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    os.environ.clear()
+    os.environ.update(self.saved_env)
+    _CatalogTestCase.tearDown(self)
+
+  def _ExpectBoardPages(self, versions):
+    cb_catalog.ListUrls(self.board_url).AndReturn(
+        ['/dev-channel/', '?C=N;O=D'] + [v + '/' for v in versions] +
+        ['notes.txt'])
+    for version in versions:
+      cb_catalog.ListUrls(self.board_url + '/' + version).AndReturn(
+          [_RECOVERY % version])
+    cb_catalog.ListUrls(self.board_url + '-rc').AndRaise(IOError)
+    cb_catalog.ListUrls(mox.StrContains('/dev-channel/stumpy')).AndRaise(
+        IOError)
+
+  def testCrawl(self):
+    """Verify release directories of every naming scheme are catalogued."""
+    self._ExpectBoardPages(['1.0', '2.0'])
+    self.mox.ReplayAll()
+    self.assertEqual(4, cb_catalog.RefreshCatalog(self.catalog, 'stumpy',
+                                                  'dev'))
+    self.mox.VerifyAll()
+    self.assertEqual([self.board_url + '/1.0/' + _RECOVERY % '1.0'],
+                     self.catalog.Listing(self.board_url + '/1.0'))
+    self.assertEqual(5, len(self.catalog.Listing(_STUMPY_HTTP + '/1235.3.0')))
+    self.assertEqual('1235.4.0', self.catalog.LatestVersion('stumpy', 'dev'))
+
+  def testIncremental(self):
+    """Verify directories already catalogued are not listed again."""
+    self._AddRelease('1.0', [_RECOVERY % '1.0'], board_url=self.board_url)
+    self._ExpectBoardPages(['2.0'])
+    cb_catalog.ListUrls(self.board_url).AndReturn(['1.0/', '2.0/', '3.0/'])
+    cb_catalog.ListUrls(self.board_url + '/3.0').AndReturn([])
+    cb_catalog.ListUrls(self.board_url + '-rc').AndRaise(IOError)
+    cb_catalog.ListUrls(mox.StrContains('/dev-channel/stumpy')).AndRaise(
+        IOError)
+    self.mox.ReplayAll()
+    cb_catalog.RefreshCatalog(self.catalog, 'stumpy', 'dev')
+    # on GSD the unchanged release directories are left alone
+    self.assertEqual(1, cb_catalog.RefreshCatalog(self.catalog, 'stumpy',
+                                                  'dev'))
+    self.mox.VerifyAll()
+
+
+class TestDetermineUrlWithCatalog(_CatalogTestCase):
+  """Unit tests related to DetermineUrl resolving from a catalog."""
+
+  def setUp(self):
+    _CatalogTestCase.setUp(self)
+    with open('testdata/test_page_many_links.html', 'r') as test_page:
+      self.page = test_page.read()
+    self.server = StandInServer({'/dev-channel/x86-alex/1.0': self.page},
+                                etag='"v1"').Start()
+    self.url = self.server.url + '/dev-channel/x86-alex/1.0'
+    cb_url_lib.SetCatalog(self.catalog)
+
+  def tearDown(self):
+    cb_url_lib.SetCatalog(None)
+    self.server.Stop()
+    _CatalogTestCase.tearDown(self)
+
+  def testListedOnceThenCatalogued(self):
+    """Verify a directory listed once is then resolved from the catalog."""
+    expected = self.url + '/ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip'
+    self.assertEqual(expected,
+                     cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(expected,
+                     cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(1, len(self.server.requests))
+    self.assertTrue(expected in self.catalog.Listing(self.url))
+
+  def testMissListedAgain(self):
+    """Verify a file missing from the catalog is looked up online."""
+    self._AddRelease('1.0', ['old.zip'], board_url=os.path.dirname(self.url))
+    self.assertEqual(
+        self.url + '/ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip',
+        cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(1, len(self.server.requests))
+    self.assertFalse(self.url + '/old.zip' in self.catalog.Listing(self.url))
+
+  def testNoNetworkWhenCatalogued(self):
+    """Verify a catalogued release resolves without listing it."""
+    self._AddRelease('1.0', [_RECOVERY % '1.0'],
+                     board_url=os.path.dirname(self.url))
+    self.assertEqual(self.url + '/' + _RECOVERY % '1.0',
+                     cb_url_lib.DetermineUrl(self.url, ['chromeos', 'recovery',
+                                                        '.bin']))
+    self.assertEqual([], self.server.requests)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
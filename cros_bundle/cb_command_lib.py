@@ -6,14 +6,16 @@
 """This module contains methods interfacing with pre-existing tools."""
 
 import cb_constants
+import filecmp
 import logging
 import re
 import os
 import shutil
 
-from cb_archive_hashing_lib import CheckMd5, ZipExtract
-from cb_name_lib import ResolveRecoveryUrl, RunWithNamingRetries
-from cb_url_lib import DetermineUrl, Download
+from cb_archive_hashing_lib import CheckMd5
+from cb_lock_lib import FileLock
+from cb_name_lib import NamingKey, ResolveRecoveryUrl, RunWithNamingRetries
+from cb_url_lib import DetermineUrl, Download, ZipExtractUrl
 from cb_util import RunCommand
 
 USER = os.environ['USER']
@@ -21,6 +23,7 @@ HOME_DIR = '/home/%s/trunk/src' % USER
 IMG_SIGN_DIR = HOME_DIR + '/platform/vboot_reference/scripts/image_signing'
 CHROOT_ROOT = '/home/%s/chromiumos/chroot' % USER
 CHROOT_REL_DIR = 'tmp/bundle_tmp'
+CGPT_DEST = os.path.join(cb_constants.SUDO_DIR, 'cgpt')
 
 # Mapping of firmware internal name to regular expression patterns.
 FIRMWARE_MAP = {
@@ -341,39 +344,71 @@ def MoveCgpt(cgpt_file, dest_file):
   RunCommand(['sudo', 'chmod', '760', dest_file])
 
 
+def _SameContents(filename, other_filename):
+  """Returns True when two files exist and hold the same bytes."""
+  try:
+    return filecmp.cmp(filename, other_filename, shallow=False)
+  except (IOError, OSError):
+    return False
+
+
 def InstallCgpt(index_page, force):
   """Install necessary cgpt utility on the sudo path.
 
+  The installed cgpt is locked while replaced, and left alone when it is
+  already the one needed, e.g. as installed by a concurrent run. Callers
+  running cgpt afterwards should hold FileLock(CGPT_DEST) throughout.
+
   Args:
-    index_page: html page to download au-generator containing correct cgpt
+    index_page: html page of the au-generator zip containing correct cgpt
     force: a boolean, True when all existing bundle files can be deleted
   Raises:
     BundlingError when resource fetch and extract fails or overwrite is denied
   """
   au_gen_url = os.path.join(index_page, cb_constants.AU_GEN)
-  if not Download(au_gen_url):
-    raise cb_constants.BundlingError(
-        'Necessary resource %s could not be fetched.' % au_gen_url)
-  au_gen_name = os.path.join(cb_constants.WORKDIR, cb_constants.AU_GEN)
   cgpt_name = os.path.join(cb_constants.WORKDIR, 'cgpt')
-  if not ZipExtract(au_gen_name, 'cgpt', path=cb_constants.WORKDIR):
-    raise cb_constants.BundlingError(
-        'Could not extract necesary resource %s from %s.' %
-        (cgpt_name, au_gen_name))
-  cgpt_dest = os.path.join(cb_constants.SUDO_DIR, 'cgpt')
-  if os.path.exists(cgpt_dest):
-    if force:
-      MoveCgpt(cgpt_name, cgpt_dest)
-    else:
-      msg = 'cgpt exists at %s, please confirm update' % cgpt_dest
-      if AskUserConfirmation(msg):
+  cgpt_dest = CGPT_DEST
+  with FileLock(cgpt_dest):
+    if not ZipExtractUrl(au_gen_url, 'cgpt', path=cb_constants.WORKDIR):
+      raise cb_constants.BundlingError(
+          'Could not fetch necessary resource %s from %s.' %
+          (cgpt_name, au_gen_url))
+    if os.path.exists(cgpt_dest):
+      if _SameContents(cgpt_name, cgpt_dest):
+        logging.info('cgpt at %s is up to date.', cgpt_dest)
+      elif force:
         MoveCgpt(cgpt_name, cgpt_dest)
       else:
-        raise cb_constants.BundlingError(
-            'Necessary utility cgpt already exists at %s, use -f to overwrite '
-            'with newest version.' % cgpt_dest)
-  else:
-    MoveCgpt(cgpt_name, cgpt_dest)
+        msg = 'cgpt exists at %s, please confirm update' % cgpt_dest
+        if AskUserConfirmation(msg):
+          MoveCgpt(cgpt_name, cgpt_dest)
+        else:
+          raise cb_constants.BundlingError(
+              'Necessary utility cgpt already exists at %s, use -f to '
+              'overwrite with newest version.' % cgpt_dest)
+    else:
+      MoveCgpt(cgpt_name, cgpt_dest)
+
+
+def CloneVbootReference(force):
+  """Clone the vboot_reference repo into GITDIR.
+
+  The checkout is locked while cloned. A run that waited for another to
+  clone it uses that checkout. Callers running scripts from the checkout
+  should hold a shared FileLock(GITDIR) meanwhile.
+
+  Args:
+    force: a boolean, True when all existing bundle files can be deleted
+  Raises:
+    BundlingError when the existing checkout may not be replaced
+  """
+  with FileLock(cb_constants.GITDIR) as lock:
+    if lock.waited and os.path.isdir(os.path.join(cb_constants.GITDIR,
+                                                  '.git')):
+      logging.info('Using %s as cloned by another run.', cb_constants.GITDIR)
+      return
+    HandleGitExists(force)
+    RunCommand(['git', 'clone', cb_constants.GITURL, cb_constants.GITDIR])
 
 
 def ConvertRecoveryToSsd(image_name, options):
@@ -414,11 +449,11 @@ def RecoveryToFullSsdNoChroot(image_name, options):
   ssd_name = image_name.replace('recovery', 'ssd')
   HandleSsdExists(ssd_name, force)
   # fetch convert_recovery_to_full_ssd.sh
-  HandleGitExists(force)
-  RunCommand(['git', 'clone', cb_constants.GITURL, cb_constants.GITDIR])
+  CloneVbootReference(force)
   # fetch zip containing chromiumos_base_image
   (rec_url, index_page) = RunWithNamingRetries(
-      None, ResolveRecoveryUrl, board, recovery)
+      None, ResolveRecoveryUrl, board, recovery, probe=ResolveRecoveryUrl,
+      key=NamingKey(board, recovery))
   if not index_page:
     raise cb_constants.BundlingError(
         'All naming schemes failed attempting to resolve recovery URL '
@@ -437,12 +472,15 @@ def RecoveryToFullSsdNoChroot(image_name, options):
   if not Download(zip_url):
     raise cb_constants.BundlingError('Failed to download %s.' % zip_url)
   zip_name = os.path.join(cb_constants.WORKDIR, os.path.basename(zip_url))
-  InstallCgpt(index_page, force)
   script_name = os.path.join(cb_constants.GITDIR,
                              'scripts',
                              'image_signing',
                              'convert_recovery_to_full_ssd.sh')
-  RunCommand([script_name, image_name, zip_name, ssd_name])
+  # keep other runs from replacing cgpt or the checkout while in use
+  with FileLock(CGPT_DEST):
+    InstallCgpt(index_page, force)
+    with FileLock(cb_constants.GITDIR, shared=True):
+      RunCommand([script_name, image_name, zip_name, ssd_name])
   # TODO(benwin) consider cleaning up resources based on command line flag
   return ssd_name
 
@@ -486,21 +524,23 @@ def RecoveryToStandardSsd(image_name, options):
     raise cb_constants.BundlingError(
         'Chroot environment could not be inferred, failed to create link %s.' %
         chroot_work_dir)
-  if not(chroot_work_dir and os.path.isdir(chroot_work_dir)):
-    os.mkdir(chroot_work_dir)
-  ssd_chroot_name = ssd_name.replace(image_dir, chroot_work_dir)
-  shutil.copy(image_name, ssd_chroot_name)
-  cmd = (['cros_sdk',
-          '--',
-          os.path.join(IMG_SIGN_DIR, 'convert_recovery_to_ssd.sh'),
-          ssd_name.replace(image_dir,
-                           ReinterpretPathForChroot(chroot_work_dir))])
-  if options.force:
-    cmd.insert(5, '--force')
-  RunCommand(cmd)
-  # move ssd out, clean up folder
-  shutil.move(ssd_chroot_name, ssd_name)
-  shutil.rmtree(chroot_work_dir)
+  # the chroot work directory is removed once done, one run at a time
+  with FileLock(chroot_work_dir):
+    if not(chroot_work_dir and os.path.isdir(chroot_work_dir)):
+      os.mkdir(chroot_work_dir)
+    ssd_chroot_name = ssd_name.replace(image_dir, chroot_work_dir)
+    shutil.copy(image_name, ssd_chroot_name)
+    cmd = (['cros_sdk',
+            '--',
+            os.path.join(IMG_SIGN_DIR, 'convert_recovery_to_ssd.sh'),
+            ssd_name.replace(image_dir,
+                             ReinterpretPathForChroot(chroot_work_dir))])
+    if options.force:
+      cmd.insert(5, '--force')
+    RunCommand(cmd)
+    # move ssd out, clean up folder
+    shutil.move(ssd_chroot_name, ssd_name)
+    shutil.rmtree(chroot_work_dir)
   return ssd_name
 
 
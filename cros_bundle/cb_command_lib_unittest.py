@@ -608,30 +608,22 @@ class TestInstallCgpt(mox.MoxTestBase):
     self.mox = mox.Mox()
     self.index_page = 'index_page'
     self.force = False
-    self.mox.StubOutWithMock(cb_command_lib, 'Download')
-    self.mox.StubOutWithMock(cb_command_lib, 'ZipExtract')
+    self.mox.StubOutWithMock(cb_command_lib, 'ZipExtractUrl')
     self.mox.StubOutWithMock(os.path, 'exists')
     self.mox.StubOutWithMock(cb_command_lib, 'AskUserConfirmation')
     self.mox.StubOutWithMock(cb_command_lib, 'MoveCgpt')
 
-  def testAuGenDownloadFails(self):
-    """Verify error when download of au-generator zip fails."""
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(False)
-    _AssertInstallCgptError(self)
-
   def testExtractCgptFails(self):
-    """Verify error when cgpt is not extracted from au-generator zip."""
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(True)
-    cb_command_lib.ZipExtract(
-      mox.IsA(str),
+    """Verify error when cgpt is not fetched from au-generator zip."""
+    cb_command_lib.ZipExtractUrl(
+      'index_page/au-generator.zip',
       'cgpt',
       path=cb_constants.WORKDIR).AndReturn(False)
     _AssertInstallCgptError(self)
 
   def testCgptExistsNoForceNoConfirm(self):
     """Verify error when cgpt already exists at desired location."""
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(True)
-    cb_command_lib.ZipExtract(
+    cb_command_lib.ZipExtractUrl(
       mox.IsA(str),
       'cgpt',
       path=cb_constants.WORKDIR).AndReturn(True)
@@ -641,8 +633,7 @@ class TestInstallCgpt(mox.MoxTestBase):
 
   def testCgptExistsNoForceUserConfirmsOverwrite(self):
     """Verify behavior when cgpt already exists and user confirms overwrite."""
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(True)
-    cb_command_lib.ZipExtract(
+    cb_command_lib.ZipExtractUrl(
       mox.IsA(str),
       'cgpt',
       path=cb_constants.WORKDIR).AndReturn(True)
@@ -655,8 +646,7 @@ class TestInstallCgpt(mox.MoxTestBase):
   def testCgptExistsForceOverwrite(self):
     """Verify behavior when cgpt exists and script input allows overwrite."""
     self.force = True
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(True)
-    cb_command_lib.ZipExtract(
+    cb_command_lib.ZipExtractUrl(
       mox.IsA(str),
       'cgpt',
       path=cb_constants.WORKDIR).AndReturn(True)
@@ -667,8 +657,7 @@ class TestInstallCgpt(mox.MoxTestBase):
 
   def testCgptDoesNotExist(self):
     """Verify behavior when cgpt can be installed fresh."""
-    cb_command_lib.Download(mox.IsA(str)).AndReturn(True)
-    cb_command_lib.ZipExtract(
+    cb_command_lib.ZipExtractUrl(
       mox.IsA(str),
       'cgpt',
       path=cb_constants.WORKDIR).AndReturn(True)
@@ -14,17 +14,28 @@ AU_GEN = 'au-generator.zip'
 BIOS_NAME = {'x86-alex': 'bios.bin', 'stumpy': 'bios.bin'}
 EC_NAME = {'x86-alex': 'ec.bin'}
 EC2_NAME = {'x86-alex': 'Alex_EC_VFA616M.bin'}
+FETCH_JOBS = 3
 GITURL = 'https://chromium.googlesource.com/chromiumos/platform/vboot_reference.git'
 # TODO(benwin) update to production value once it is determined
 GSD_BUCKET = 'gs://chromeos-download-test'
 IMAGE_GSD_BUCKET = 'gs://chromeos-releases'
 IMAGE_GSD_PREFIX = 'https://sandbox.google.com/storage/chromeos-releases'
 IMAGE_SERVER_PREFIX = 'http://chromeos-images/chromeos-official'
+MD5_JOBS = 4
 MOUNT_POINT = '/tmp/m'
 SUDO_DIR = '/usr/local/sbin'
 WORKDIR = '/usr/local/google/cros_bundle/tmp'
-# GITDIR should be defined after WORKDIR
+# ARTIFACT_STORE, CATALOG, DIGEST_CACHE, GITDIR, LISTING_CACHE, LOCK_DIR
+# and NAMING_CACHE should be defined after WORKDIR
+# shared by every user of the builder and kept by --clean
+ARTIFACT_STORE = os.path.join(os.path.dirname(WORKDIR), 'store')
+CATALOG = os.path.join(WORKDIR, 'catalog.sqlite')
+DIGEST_CACHE = os.path.join(WORKDIR, 'digest_cache.json')
 GITDIR = os.path.join(WORKDIR, 'vboot_reference')
+LISTING_CACHE = os.path.join(WORKDIR, 'listing_cache.json')
+# as ARTIFACT_STORE
+LOCK_DIR = os.path.join(os.path.dirname(WORKDIR), 'locks')
+NAMING_CACHE = os.path.join(WORKDIR, 'naming_cache.json')
 
 
 class BundlingError(Exception):
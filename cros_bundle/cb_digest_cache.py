@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains a persistent cache of file digests keyed on stat."""
+
+import logging
+import os
+import threading
+import time
+
+from cb_util import LoadJson, SaveJson
+
+# Keep the cache file small, it is rewritten after every new digest.
+MAX_ENTRIES = 256
+
+
+def _Nanoseconds(stat_result, field):
+  """Returns a stat timestamp in integer nanoseconds.
+
+  Args:
+    stat_result: an os.stat_result object
+    field: a string, 'mtime' or 'ctime'
+  Returns:
+    an integer, the timestamp in nanoseconds
+  """
+  ns = getattr(stat_result, 'st_%s_ns' % field, None)
+  if ns is None:
+    ns = int(round(getattr(stat_result, 'st_' + field) * 1e9))
+  return ns
+
+
+def StatKey(filename):
+  """Returns the cache key of a file's current on-disk state.
+
+  The key is (device, inode, size, mtime_ns, ctime_ns). Any write, truncate,
+  rename over or replacement of the file changes at least one of them.
+
+  Args:
+    filename: name of file to stat
+  Returns:
+    a string, the cache key
+  Raises:
+    OSError when the file cannot be stat'ed
+  """
+  st = os.stat(filename)
+  return '%d:%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size,
+                             _Nanoseconds(st, 'mtime'),
+                             _Nanoseconds(st, 'ctime'))
+
+
+class DigestCache(object):
+
+  """An on-disk record of digests of files that have not changed since.
+
+  It contains the following fields:
+  - path: name of the JSON file holding the cache
+  - max_entries: number of entries kept, least recently used dropped first
+  - entries: a dict mapping StatKey to a dict with keys
+      'path': absolute name of the hashed file
+      'digests': a dict mapping algorithm name to hexdigest
+      'used': time of last lookup or record
+
+  A corrupt or unreadable cache file is treated as empty. Writes go to a
+  temporary file renamed over the cache, so readers never see a partial
+  cache, and entries saved concurrently by other processes are merged in.
+  """
+
+  def __init__(self, path, max_entries=MAX_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self.entries = self._Load()
+
+  def _Load(self):
+    """Returns the entries stored on disk, empty if none or unreadable."""
+    return LoadJson(self.path, 'digest cache')
+
+  def _Save(self, path, key):
+    """Merge entries with those on disk and atomically rewrite the cache.
+
+    Args:
+      path: absolute name of the file just recorded
+      key: StatKey it was recorded under, other entries for path are stale
+    """
+    merged = self._Load()
+    for other_key, entry in self.entries.iteritems():
+      if (other_key not in merged or
+          merged[other_key].get('used', 0) <= entry['used']):
+        merged[other_key] = entry
+    for other_key in merged.keys():
+      if merged[other_key].get('path') == path and other_key != key:
+        del merged[other_key]
+    if len(merged) > self.max_entries:
+      by_use = sorted(merged, key=lambda k: merged[k].get('used', 0))
+      for old_key in by_use[:len(merged) - self.max_entries]:
+        del merged[old_key]
+    self.entries = merged
+    SaveJson(self.path, merged, 'digest cache')
+
+  def Lookup(self, filename, algorithms):
+    """Returns cached digests of a file if it is unchanged since recorded.
+
+    Args:
+      filename: name of file to look up
+      algorithms: a sequence of hashlib algorithm names needed
+    Returns:
+      a dict mapping each algorithm to its hexdigest, None on cache miss
+    """
+    try:
+      key = StatKey(filename)
+    except OSError:
+      return None
+    with self._lock:
+      entry = self.entries.get(key)
+      if not entry or entry.get('path') != os.path.abspath(filename):
+        return None
+      digests = entry.get('digests', {})
+      if not all(name in digests for name in algorithms):
+        return None
+      entry['used'] = time.time()
+      logging.debug('Digest cache hit for %s.', filename)
+      return dict((name, digests[name]) for name in algorithms)
+
+  def Record(self, filename, digests, key):
+    """Record digests computed for a file.
+
+    Nothing is recorded when the file changed since key was taken, since
+    the digests might then describe neither the old nor the new contents.
+
+    Args:
+      filename: name of file that was hashed
+      digests: a dict mapping algorithm name to hexdigest
+      key: StatKey of the file taken before it was hashed
+    """
+    try:
+      if StatKey(filename) != key:
+        logging.debug('%s changed while hashing, not caching.', filename)
+        return
+    except OSError:
+      return
+    path = os.path.abspath(filename)
+    with self._lock:
+      entry = self.entries.setdefault(key, {'digests': {}})
+      entry['path'] = path
+      entry['digests'].update(digests)
+      entry['used'] = time.time()
+      self._Save(path, key)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_digest_cache module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import cb_digest_cache
+
+
+class TestStatKey(unittest.TestCase):
+  """Unit tests related to StatKey."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.test_dir, 'image.bin')
+    with open(self.filename, 'w') as f:
+      f.write('image contents')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testKeyStable(self):
+    """Verify key is unchanged when file is untouched."""
+    self.assertEqual(cb_digest_cache.StatKey(self.filename),
+                     cb_digest_cache.StatKey(self.filename))
+
+  def testKeyChangesOnReplace(self):
+    """Verify key changes when file is replaced with same size contents."""
+    before = cb_digest_cache.StatKey(self.filename)
+    other = os.path.join(self.test_dir, 'other')
+    with open(other, 'w') as f:
+      f.write('IMAGE CONTENTS')
+    os.rename(other, self.filename)
+    self.assertNotEqual(before, cb_digest_cache.StatKey(self.filename))
+
+  def testMissingFile(self):
+    """Verify OSError raised when file does not exist."""
+    self.assertRaises(OSError, cb_digest_cache.StatKey,
+                      os.path.join(self.test_dir, 'missing'))
+
+
+class TestDigestCache(unittest.TestCase):
+  """Unit tests related to DigestCache."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache_name = os.path.join(self.test_dir, 'digest_cache.json')
+    self.filename = os.path.join(self.test_dir, 'image.bin')
+    with open(self.filename, 'w') as f:
+      f.write('image contents')
+    self.digests = {'md5': 'abc', 'sha1': 'def'}
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Record(self, cache, filename=None):
+    filename = filename or self.filename
+    cache.Record(filename, self.digests, cb_digest_cache.StatKey(filename))
+
+  def testHitAcrossInstances(self):
+    """Verify digests recorded by one run are found by the next."""
+    self._Record(cb_digest_cache.DigestCache(self.cache_name))
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    self.assertEqual({'md5': 'abc'}, cache.Lookup(self.filename, ['md5']))
+
+  def testMissingAlgorithm(self):
+    """Verify miss when a requested digest was never recorded."""
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    self._Record(cache)
+    self.assertEqual(None, cache.Lookup(self.filename, ['md5', 'sha256']))
+
+  def testMissAfterModification(self):
+    """Verify miss after the file is rewritten."""
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    self._Record(cache)
+    with open(self.filename, 'a') as f:
+      f.write('more')
+    self.assertEqual(None, cache.Lookup(self.filename, ['md5']))
+
+  def testNotRecordedWhenChangedWhileHashing(self):
+    """Verify nothing is recorded when the stat key moved during hashing."""
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    key = cb_digest_cache.StatKey(self.filename)
+    with open(self.filename, 'a') as f:
+      f.write('more')
+    cache.Record(self.filename, self.digests, key)
+    self.assertEqual({}, cache.entries)
+    self.assertFalse(os.path.exists(self.cache_name))
+
+  def testStaleEntryReplaced(self):
+    """Verify re-recording a changed file drops its old entry."""
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    self._Record(cache)
+    with open(self.filename, 'a') as f:
+      f.write('more')
+    self._Record(cache)
+    self.assertEqual(1, len(cb_digest_cache.DigestCache(self.cache_name).entries))
+
+  def testBoundedSize(self):
+    """Verify least recently used entries are dropped past max_entries."""
+    cache = cb_digest_cache.DigestCache(self.cache_name, max_entries=2)
+    names = []
+    for index in range(3):
+      names.append(os.path.join(self.test_dir, 'file%d' % index))
+      with open(names[-1], 'w') as f:
+        f.write(str(index))
+      self._Record(cache, names[-1])
+    cache = cb_digest_cache.DigestCache(self.cache_name, max_entries=2)
+    self.assertEqual(2, len(cache.entries))
+    self.assertEqual(None, cache.Lookup(names[0], ['md5']))
+    self.assertTrue(cache.Lookup(names[2], ['md5']))
+
+  def testCorruptCacheIgnored(self):
+    """Verify an unparseable cache file is treated as empty."""
+    with open(self.cache_name, 'w') as f:
+      f.write('{not json')
+    cache = cb_digest_cache.DigestCache(self.cache_name)
+    self.assertEqual(None, cache.Lookup(self.filename, ['md5']))
+    self._Record(cache)
+    self.assertTrue(cache.Lookup(self.filename, ['md5']))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
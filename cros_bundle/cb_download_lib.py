@@ -0,0 +1,845 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains the streaming engine used to download images."""
+
+import contextlib
+import ctypes
+import json
+import logging
+import os
+import Queue
+import re
+import tempfile
+import threading
+import urllib2
+import zipfile
+
+from cb_archive_hashing_lib import DIGEST_ALGORITHMS, DigestStream, \
+    GenerateDigests
+from cb_transport import OpenUrl
+from cb_util import LibcFunction
+
+# Bytes held in memory at a time while copying a download to disk. Memory
+# used by a download is bounded by this, whatever the size of the image.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Concurrent connections used to fetch the byte ranges of one large file.
+DOWNLOAD_CONNECTIONS = 4
+# Size of each byte range; files smaller than two segments use one stream.
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Bytes of a single stream download written between journal updates.
+JOURNAL_INTERVAL = 32 * 1024 * 1024
+# Downloads are written to <name>.partial, described by <name>.partial.journal
+PARTIAL_SUFFIX = '.partial'
+JOURNAL_SUFFIX = '.journal'
+# Bytes read from the end of a remote zip archive up front, enough for its
+# end of central directory record with the longest comment allowed.
+ZIP_TAIL_SIZE = 22 + 64 * 1024
+
+_chunk_size = DOWNLOAD_CHUNK_SIZE
+_connections = DOWNLOAD_CONNECTIONS
+_segment_size = SEGMENT_SIZE
+_digest_algorithms = DIGEST_ALGORITHMS
+
+# File mode of downloads, as open() would create them under current umask.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE = 0666 & ~_UMASK
+
+
+class RangeUnsupportedError(IOError):
+  """Error raised when a server ignores HTTP Range requests."""
+
+
+def ConfigureDownloads(chunk_size=None, connections=None, segment_size=None,
+                       algorithms=None):
+  """Sets tunables of the download engine, None leaves a setting unchanged.
+
+  Args:
+    chunk_size: bytes to read and write at a time
+    connections: concurrent connections used for one segmented download
+    segment_size: bytes fetched per HTTP range request
+    algorithms: a sequence of hashlib algorithm names downloads are hashed
+                with as they are written
+  """
+  global _chunk_size, _connections, _segment_size, _digest_algorithms
+  if chunk_size:
+    _chunk_size = chunk_size
+  if connections:
+    _connections = connections
+  if segment_size:
+    _segment_size = segment_size
+  if algorithms:
+    _digest_algorithms = tuple(algorithms)
+
+
+def DownloadDigests():
+  """Returns the names of the algorithms downloads are hashed with."""
+  return _digest_algorithms
+
+
+def Preallocate(fd, size):
+  """Reserve disk blocks for a file of known size.
+
+  Preallocating keeps a multi-GB image contiguous on disk and makes running
+  out of space fail up front instead of part way through a download.
+
+  Args:
+    fd: an integer, file descriptor open for writing
+    size: an integer, final size of the file in bytes
+  Returns:
+    a boolean, True when the space was reserved
+  """
+  if size <= 0:
+    return False
+  try:
+    if hasattr(os, 'posix_fallocate'):
+      os.posix_fallocate(fd, 0, size)
+      return True
+    # posix_fallocate writes zeros where the file system cannot allocate,
+    # and returns an error number rather than setting errno
+    fallocate = LibcFunction('posix_fallocate64', ctypes.c_int,
+                             [ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+    if fallocate and not fallocate(fd, 0, size):
+      return True
+  except OSError:
+    pass
+  logging.debug('Could not preallocate %d bytes, continuing without.', size)
+  return False
+
+
+def ContentLength(web_file):
+  """Returns the size announced for an opened URL, None when unknown.
+
+  Args:
+    web_file: a file object returned by OpenUrl
+  """
+  info = getattr(web_file, 'info', None)
+  if not info:
+    return None
+  length = info().getheader('Content-Length')
+  try:
+    return int(length)
+  except (TypeError, ValueError):
+    return None
+
+
+@contextlib.contextmanager
+def AtomicOutput(name, size=None):
+  """Open a file to be written under a temporary name and renamed into place.
+
+  The temporary file lives next to name, so the final rename is atomic and
+  a reader never sees a partially written file under name. If the block
+  raises, the temporary file is removed and name is left untouched.
+
+  Args:
+    name: final name of the file
+    size: optional, expected size in bytes, used to preallocate the file
+  Yields:
+    a file object open for binary writing, its name is the temporary file
+  Raises:
+    IOError or OSError when the file cannot be created or renamed
+  """
+  dirname, basename = os.path.split(os.path.abspath(name))
+  fd, temp_name = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+  try:
+    os.fchmod(fd, _FILE_MODE)
+    os.close(fd)
+    # opened by name so that out.name can be reopened, e.g. per segment
+    with open(temp_name, 'wb') as out:
+      if size:
+        Preallocate(out.fileno(), size)
+      yield out
+      out.flush()
+      os.fsync(out.fileno())
+    os.rename(temp_name, name)
+  except:
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+    raise
+
+
+def CopyStream(source, out, stream=None, size=None, chunk_size=None,
+               limit=None):
+  """Copy a file object to another one chunk by chunk.
+
+  Args:
+    source: a file object to read from until EOF
+    out: a file object to write to
+    stream: optional object whose update method is fed every chunk
+    size: optional, number of bytes expected from source
+    chunk_size: optional, bytes per read, defaults to the configured size
+    limit: optional, stop after copying this many bytes instead of at EOF
+  Returns:
+    an integer, the number of bytes copied
+  Raises:
+    IOError on read or write failure, or when fewer or more than size bytes
+    were read
+  """
+  chunk_size = chunk_size or _chunk_size
+  copied = 0
+  while limit is None or copied < limit:
+    want = chunk_size if limit is None else min(chunk_size, limit - copied)
+    chunk = source.read(want)
+    if not chunk:
+      break
+    out.write(chunk)
+    if stream:
+      stream.update(chunk)
+    copied += len(chunk)
+  if size is not None and copied != size:
+    raise IOError('Expected %d bytes but read %d.' % (size, copied))
+  return copied
+
+
+def AcceptsRanges(web_file):
+  """Returns True when an opened URL announces support for byte ranges.
+
+  Args:
+    web_file: a file object returned by OpenUrl
+  """
+  info = getattr(web_file, 'info', None)
+  if not info:
+    return False
+  return (info().getheader('Accept-Ranges') or '').strip().lower() == 'bytes'
+
+
+def UseSegments(size):
+  """Returns True when a file of the given size is worth segmenting.
+
+  Args:
+    size: an integer, file size in bytes, None when unknown
+  """
+  return bool(size and _connections > 1 and size >= 2 * _segment_size)
+
+
+def _OpenRange(url, start, end=None, validator=None):
+  """Open a byte range of a URL.
+
+  Args:
+    url: online location of file
+    start: an integer, first byte of the range
+    end: optional integer, last byte of the range, inclusive, None for EOF
+    validator: optional ETag or Last-Modified the remote file must still have
+  Returns:
+    a file object, the opened URL
+  Raises:
+    IOError on network failure
+  """
+  headers = {'Range': 'bytes=%d-%s' % (start, '' if end is None else end)}
+  if validator:
+    headers['If-Range'] = validator
+  return OpenUrl(url, headers=headers)
+
+
+def _IsRangeResponse(web_file, start, size=None):
+  """Returns True when an opened URL holds the requested range.
+
+  Args:
+    web_file: a file object returned by _OpenRange
+    start: an integer, first byte of the range requested
+    size: optional integer, total size the file must have
+  """
+  content_range = web_file.info().getheader('Content-Range') or ''
+  if web_file.getcode() != 206 or not content_range.startswith(
+      'bytes %d-' % start):
+    return False
+  return size is None or content_range.endswith('/%d' % size)
+
+
+def _FetchSegment(url, name, start, end, journal=None):
+  """Fetch one byte range of a URL into the same range of a local file.
+
+  Args:
+    url: online location of file to download
+    name: name of the local file, already created
+    start: an integer, first byte of the range
+    end: an integer, last byte of the range, inclusive
+    journal: optional DownloadJournal to record the range in once on disk
+  Raises:
+    RangeUnsupportedError when the server answers with the whole file
+    IOError on network or write failure
+  """
+  validator = journal.validator if journal else None
+  with contextlib.closing(_OpenRange(url, start, end, validator)) as web_file:
+    if not _IsRangeResponse(web_file, start):
+      raise RangeUnsupportedError('Range request ignored by server for %s.' %
+                                  url)
+    with open(name, 'r+b') as out:
+      out.seek(start)
+      CopyStream(web_file, out, size=end - start + 1)
+      if journal:
+        out.flush()
+        os.fsync(out.fileno())
+  if journal:
+    journal.Add(start, end + 1)
+
+
+def _SegmentWorker(url, name, work_queue, done, errors, condition,
+                   journal=None):
+  """Fetch segments taken from a queue until it is empty or a fetch fails.
+
+  Args:
+    url: online location of file to download
+    name: name of the local file to write segments into
+    work_queue: a Queue of (index, start, end) tuples
+    done: a list of booleans, set at index when a segment is complete
+    errors: a list, any exception a worker raises is appended to it
+    condition: a threading.Condition notified when a segment completes
+    journal: optional DownloadJournal recording completed segments
+  """
+  while not errors:
+    try:
+      index, start, end = work_queue.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      _FetchSegment(url, name, start, end, journal)
+    except Exception as e:
+      # whatever the error, the waiting thread must hear of it
+      with condition:
+        errors.append(e)
+        condition.notify_all()
+      return
+    with condition:
+      done[index] = True
+      condition.notify_all()
+
+
+class _NullWriter(object):
+  """A file object discarding everything written to it."""
+
+  def write(self, data):
+    pass
+
+
+def SegmentedDownload(url, out, size, stream=None, journal=None):
+  """Fetch a URL as byte ranges over several concurrent connections.
+
+  Segments are written in place into out, which should be preallocated.
+  While they arrive, the calling thread feeds the contiguous completed
+  prefix of the file to stream, reading it back while it is still in the
+  page cache, so that digests are ready as soon as the last segment lands.
+  Segments a journal already records as complete are not fetched again.
+
+  Args:
+    url: online location of file to download
+    out: a file object open for writing, with a name that can be reopened
+    size: an integer, total size of the file in bytes
+    stream: optional object whose update method is fed the file in order
+    journal: optional DownloadJournal of out, updated as segments complete
+  Raises:
+    RangeUnsupportedError when the server does not honour range requests
+    IOError on network or write failure
+    any other exception a segment fetch raised, e.g. BundlingError
+  """
+  segments = [(start, min(start + _segment_size, size) - 1)
+              for start in xrange(0, size, _segment_size)]
+  work_queue = Queue.Queue()
+  done = [False] * len(segments)
+  for index, (start, end) in enumerate(segments):
+    if journal and journal.Covers(start, end + 1):
+      done[index] = True
+    else:
+      work_queue.put((index, start, end))
+  errors = []
+  condition = threading.Condition()
+  out.truncate(size)
+  out.flush()
+  workers = [threading.Thread(target=_SegmentWorker,
+                              args=(url, out.name, work_queue, done, errors,
+                                    condition, journal))
+             for _ in range(min(_connections, work_queue.qsize()))]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  logging.info('Fetching %s: %d of %d segments over %d connections.', url,
+               work_queue.qsize(), len(segments), len(workers))
+  try:
+    with open(out.name, 'rb') as reader:
+      for index, (start, end) in enumerate(segments):
+        with condition:
+          while not done[index] and not errors:
+            condition.wait(1)
+          if errors:
+            break
+        if stream:
+          reader.seek(start)
+          CopyStream(reader, _NullWriter(), stream=stream,
+                     size=end - start + 1, limit=end - start + 1)
+  finally:
+    if not all(done):
+      # let workers stop after their current segment
+      errors.append(None)
+    for worker in workers:
+      worker.join()
+  failures = [e for e in errors if e]
+  if failures:
+    raise failures[0]
+
+
+def PartialName(name):
+  """Returns the name a download is written to until it is promoted.
+
+  Args:
+    name: final name of the downloaded file
+  """
+  return name + PARTIAL_SUFFIX
+
+
+class DownloadJournal(object):
+
+  """Sidecar record of the byte ranges of a .partial download on disk.
+
+  It contains the following fields:
+  - partial_name: name of the partial file the download is written to
+  - path: name of the journal file, next to the partial file
+  - url: location the partial file is downloaded from
+  - size: expected total size in bytes, None when unknown
+  - validator: ETag or Last-Modified of the remote file, None when unknown
+  - ranges: a sorted list of disjoint [start, end) byte ranges on disk
+
+  Ranges are only recorded once their data is flushed to disk, so after a
+  crash the journal may understate, never overstate, what is complete.
+  A journal for another URL or without its partial file is ignored.
+  """
+
+  def __init__(self, name, url):
+    self.partial_name = PartialName(name)
+    self.path = self.partial_name + JOURNAL_SUFFIX
+    self.url = url
+    self.size = None
+    self.validator = None
+    self.ranges = []
+    self._lock = threading.Lock()
+    self._Load()
+
+  def _Load(self):
+    """Read the journal from disk, if it describes this download."""
+    try:
+      with open(self.path) as journal_file:
+        record = json.load(journal_file)
+      if (record.get('url') != self.url or
+          not os.path.exists(self.partial_name)):
+        return
+      self.size = record.get('size')
+      self.validator = record.get('validator')
+      self.ranges = [tuple(r) for r in record.get('ranges', [])]
+    except (IOError, ValueError, TypeError, AttributeError):
+      self.size, self.validator, self.ranges = None, None, []
+
+  def _Save(self):
+    """Atomically rewrite the journal file."""
+    with AtomicOutput(self.path) as out:
+      json.dump({'url': self.url, 'size': self.size,
+                 'validator': self.validator, 'ranges': self.ranges}, out)
+
+  def Reset(self, size, validator):
+    """Start the download over, discarding any partial data.
+
+    Args:
+      size: expected total size in bytes, None when unknown
+      validator: ETag or Last-Modified of the remote file, None when unknown
+    """
+    with self._lock:
+      if os.path.exists(self.partial_name):
+        os.remove(self.partial_name)
+      self.size, self.validator, self.ranges = size, validator, []
+      self._Save()
+
+  def Add(self, start, end):
+    """Record that bytes [start, end) are on disk.
+
+    Args:
+      start: an integer, first byte of the range
+      end: an integer, byte after the last of the range
+    """
+    with self._lock:
+      merged = []
+      for range_start, range_end in sorted(self.ranges + [(start, end)]):
+        if merged and range_start <= merged[-1][1]:
+          merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+          merged.append((range_start, range_end))
+      self.ranges = merged
+      self._Save()
+
+  def SetSize(self, size):
+    """Record the total size once known, e.g. at the end of a stream."""
+    with self._lock:
+      self.size = size
+      self._Save()
+
+  def Covers(self, start, end):
+    """Returns True when bytes [start, end) are all on disk."""
+    return any(s <= start and end <= e for s, e in self.ranges)
+
+  def Prefix(self):
+    """Returns the number of bytes on disk from the start of the file."""
+    if self.ranges and self.ranges[0][0] == 0:
+      return self.ranges[0][1]
+    return 0
+
+  def Complete(self):
+    """Returns True when the whole file is on disk."""
+    return self.size is not None and (self.size == 0 or
+                                      self.Covers(0, self.size))
+
+  def Discard(self):
+    """Remove the partial file and the journal."""
+    for name in [self.partial_name, self.path]:
+      if os.path.exists(name):
+        os.remove(name)
+
+
+def PromoteDownload(name):
+  """Move a completed download from its partial file to its final name.
+
+  Args:
+    name: final name of the downloaded file
+  Raises:
+    OSError when the partial file cannot be renamed
+  """
+  os.rename(PartialName(name), name)
+  journal_name = PartialName(name) + JOURNAL_SUFFIX
+  if os.path.exists(journal_name):
+    os.remove(journal_name)
+
+
+def DiscardDownload(name):
+  """Remove the partial file and journal of a download, e.g. when corrupt.
+
+  Args:
+    name: final name of the downloaded file
+  """
+  for partial in [PartialName(name), PartialName(name) + JOURNAL_SUFFIX]:
+    if os.path.exists(partial):
+      os.remove(partial)
+
+
+def _OpenPartial(journal):
+  """Open the partial file of a journal for writing without truncating it.
+
+  Args:
+    journal: a DownloadJournal
+  Returns:
+    a file object open for binary reading and writing
+  """
+  if not os.path.exists(journal.partial_name):
+    with open(journal.partial_name, 'wb') as out:
+      os.fchmod(out.fileno(), _FILE_MODE)
+      if journal.size:
+        Preallocate(out.fileno(), journal.size)
+  return open(journal.partial_name, 'r+b')
+
+
+def _Validator(web_file):
+  """Returns the ETag or Last-Modified of an opened URL, None if neither."""
+  info = getattr(web_file, 'info', None)
+  if not info:
+    return None
+  headers = info()
+  return headers.getheader('ETag') or headers.getheader('Last-Modified')
+
+
+class HttpRangeFile(object):
+
+  """A read-only file object over HTTP range requests, e.g. for zipfile.
+
+  It contains the following fields:
+  - url: location of the file, over a transport honouring ranges
+  - size: an integer, size of the file in bytes
+  - validator: ETag or Last-Modified of the file, None if the server sends
+      neither; every later range is conditional on it
+
+  The last tail_size bytes are fetched when opened and kept in memory.
+  Reads before them stream a range up to the tail, which later reads from
+  where the last one stopped carry on with; reading elsewhere starts a new
+  range. So an archive's directory costs one request and a member one more.
+  """
+
+  def __init__(self, url, tail_size=ZIP_TAIL_SIZE):
+    """Fetch the tail of a remote file.
+
+    Raises:
+      RangeUnsupportedError when the server does not honour range requests
+      IOError on network failure
+    """
+    self.url = url
+    self._stream = None
+    self._stream_pos = None
+    self._pos = 0
+    headers = {'Range': 'bytes=-%d' % tail_size}
+    with contextlib.closing(OpenUrl(url, headers=headers)) as web_file:
+      match = re.match(r'bytes (\d+)-\d+/(\d+)$',
+                       web_file.info().getheader('Content-Range') or '')
+      if web_file.getcode() == 206 and match:
+        (self._tail_start, self.size) = map(int, match.groups())
+        self._tail = web_file.read()
+      elif web_file.getcode() == 200:
+        # a whole small file is fine, a whole large one not
+        self._tail_start = 0
+        self._tail = web_file.read(tail_size + 1)
+        self.size = len(self._tail)
+        if self.size > tail_size:
+          raise RangeUnsupportedError('Range request ignored by server for '
+                                      '%s.' % url)
+      else:
+        raise RangeUnsupportedError('No size in range response for %s.' % url)
+      self.validator = _Validator(web_file)
+    if len(self._tail) != self.size - self._tail_start:
+      raise IOError('Expected %d bytes of %s but read %d.' %
+                    (self.size - self._tail_start, url, len(self._tail)))
+
+  def _CloseStream(self):
+    if self._stream:
+      self._stream.close()
+      self._stream = None
+
+  def _ReadStream(self, size):
+    """Read up to size bytes before the tail, at the current position."""
+    if not self._stream or self._stream_pos != self._pos:
+      self._CloseStream()
+      web_file = _OpenRange(self.url, self._pos, self._tail_start - 1,
+                            self.validator)
+      if not _IsRangeResponse(web_file, self._pos, self.size):
+        web_file.close()
+        raise RangeUnsupportedError('%s changed or ignored a range request.' %
+                                    self.url)
+      self._stream = web_file
+      self._stream_pos = self._pos
+    data = self._stream.read(size)
+    self._stream_pos += len(data)
+    return data
+
+  def read(self, size=-1):
+    """Returns the next size bytes, fewer only at the end of the file.
+
+    Raises:
+      RangeUnsupportedError when the file changed since opened
+      IOError on network failure
+    """
+    if size is None or size < 0:
+      size = self.size
+    size = min(size, self.size - self._pos)
+    chunks = []
+    while size > 0:
+      if self._pos >= self._tail_start:
+        offset = self._pos - self._tail_start
+        chunk = self._tail[offset:offset + size]
+      else:
+        chunk = self._ReadStream(min(size, self._tail_start - self._pos))
+        if not chunk:
+          raise IOError('Unexpected end of %s at byte %d.' %
+                        (self.url, self._pos))
+      chunks.append(chunk)
+      self._pos += len(chunk)
+      size -= len(chunk)
+    return ''.join(chunks)
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._pos
+    elif whence == os.SEEK_END:
+      offset += self.size
+    if offset < 0:
+      raise IOError('Invalid seek to %d in %s.' % (offset, self.url))
+    self._pos = offset
+
+  def tell(self):
+    return self._pos
+
+  def close(self):
+    self._CloseStream()
+
+
+def FetchZipMember(url, member, name):
+  """Extract one member of a zip archive online, reading only what it needs.
+
+  The end of central directory record and central directory are read with
+  range requests, then the member alone is streamed, inflated and checked
+  against its CRC-32. It is written atomically, see AtomicOutput.
+
+  Args:
+    url: location of a zip archive, over a transport honouring ranges
+    member: name of the member within the archive
+    name: local file name to extract the member to
+  Returns:
+    a boolean, False when the archive has no such member
+  Raises:
+    RangeUnsupportedError when the server does not honour range requests
+    IOError or OSError on network or write failure
+    zipfile.BadZipfile when the archive or member is corrupt
+  """
+  with contextlib.closing(HttpRangeFile(url)) as remote:
+    archive = zipfile.ZipFile(remote)
+    try:
+      info = archive.getinfo(member)
+    except KeyError:
+      logging.warning('Could not find %s to extract from %s.', member, url)
+      return False
+    with contextlib.closing(archive.open(info)) as source:
+      with AtomicOutput(name, size=info.file_size) as out:
+        CopyStream(source, out, size=info.file_size)
+  logging.info('Extracted %s of %d bytes from %s by range requests.', member,
+               info.compress_size, url)
+  return True
+
+
+def _HashPrefix(journal, length, stream):
+  """Feed the first bytes of a partial file to a stream, e.g. on resume."""
+  if length:
+    with open(journal.partial_name, 'rb') as reader:
+      CopyStream(reader, _NullWriter(), stream=stream, size=length,
+                 limit=length)
+
+
+def _StreamToPartial(source, journal, offset):
+  """Append a stream to a partial file from offset, journaling progress.
+
+  Progress is journaled every JOURNAL_INTERVAL bytes and when the copy
+  fails, after the data is flushed to disk, so that a later attempt can
+  resume where this one stopped.
+
+  Args:
+    source: a file object positioned at byte offset of the remote file
+    journal: the DownloadJournal of the partial file
+    offset: an integer, bytes of the file already on disk
+  Returns:
+    a dict mapping algorithm name to hexdigest of the whole file
+  Raises:
+    IOError on read or write failure, or when the stream is short
+  """
+  stream = DigestStream(_digest_algorithms)
+  _HashPrefix(journal, offset, stream)
+  position = offset
+  with _OpenPartial(journal) as out:
+    out.seek(offset)
+    try:
+      while True:
+        copied = CopyStream(source, out, stream=stream,
+                            limit=JOURNAL_INTERVAL)
+        if copied:
+          out.flush()
+          os.fsync(out.fileno())
+          journal.Add(position, position + copied)
+          position += copied
+        if copied < JOURNAL_INTERVAL:
+          break
+    except (IOError, OSError):
+      out.flush()
+      os.fsync(out.fileno())
+      if out.tell() > position:
+        journal.Add(position, out.tell())
+      raise
+    if journal.size is None:
+      out.truncate(position)
+      journal.SetSize(position)
+  if position != journal.size:
+    raise IOError('Expected %s bytes but read %d.' % (journal.size, position))
+  return stream.HexDigests()
+
+
+def _FetchSegmented(url, journal):
+  """Fetch the missing segments of a partial file of known size.
+
+  Args:
+    url: online location of file to download
+    journal: the DownloadJournal of the partial file, size must be known
+  Returns:
+    a dict mapping algorithm name to hexdigest of the whole file
+  Raises:
+    RangeUnsupportedError when the server does not honour range requests
+    IOError on network or write failure
+  """
+  stream = DigestStream(_digest_algorithms)
+  with _OpenPartial(journal) as out:
+    SegmentedDownload(url, out, journal.size, stream=stream, journal=journal)
+  return stream.HexDigests()
+
+
+def FetchHttp(url, name):
+  """Download a URL to the partial file of name, resuming if possible.
+
+  A previous attempt's partial file is resumed from where its journal says
+  it stopped, with a Range request conditional on the remote file being
+  unchanged. Large files from servers announcing byte range support are
+  fetched in segments over several connections, falling back to a single
+  stream if the server ignores range requests. The file is hashed as it is
+  written. The caller promotes or discards the completed partial file.
+
+  Args:
+    url: http(s)://, or mirrored to file://, location of file to download
+    name: final name of the local file
+  Returns:
+    a dict mapping algorithm name to hexdigest of the file
+  Raises:
+    IOError or OSError on failure, leaving a partial file to resume
+  """
+  journal = DownloadJournal(name, url)
+  if journal.Complete():
+    logging.info('Reusing complete partial download %s.', journal.partial_name)
+    return GenerateDigests(journal.partial_name, _digest_algorithms)
+  if journal.ranges and UseSegments(journal.size):
+    try:
+      return _FetchSegmented(url, journal)
+    except RangeUnsupportedError:
+      logging.info('%s can no longer be resumed, starting over.', url)
+  offset = journal.Prefix() if journal.size else 0
+  web_file = None
+  if offset:
+    try:
+      web_file = _OpenRange(url, offset, validator=journal.validator)
+    except urllib2.HTTPError as e:
+      logging.info('%s can no longer be resumed (%s), starting over.', url, e)
+  if not web_file:
+    offset = 0
+    web_file = OpenUrl(url)
+  with contextlib.closing(web_file):
+    if offset and _IsRangeResponse(web_file, offset, journal.size):
+      logging.info('Resuming %s at byte %d.', url, offset)
+      return _StreamToPartial(web_file, journal, offset)
+    size = ContentLength(web_file)
+    journal.Reset(size, _Validator(web_file))
+    if not (AcceptsRanges(web_file) and UseSegments(size)):
+      return _StreamToPartial(web_file, journal, 0)
+  try:
+    return _FetchSegmented(url, journal)
+  except RangeUnsupportedError:
+    logging.info('%s ignores range requests, using a single stream.', url)
+  with contextlib.closing(OpenUrl(url)) as web_file:
+    journal.Reset(ContentLength(web_file), _Validator(web_file))
+    return _StreamToPartial(web_file, journal, 0)
+
+
+def FetchGs(url, name):
+  """Download a Google Storage URL to the partial file of name.
+
+  The file is streamed through a 'gsutil cat' pipe, see GsTransport, and
+  hashed as it is written. A previous attempt is resumed with a range from
+  where it stopped. The caller promotes or discards the completed partial
+  file.
+
+  Args:
+    url: gs:// location of file to download
+    name: final name of the local file
+  Returns:
+    a dict mapping algorithm name to hexdigest of the file
+  Raises:
+    IOError or OSError on failure, leaving a partial file to resume
+  """
+  journal = DownloadJournal(name, url)
+  if journal.Complete():
+    logging.info('Reusing complete partial download %s.', journal.partial_name)
+    return GenerateDigests(journal.partial_name, _digest_algorithms)
+  offset = journal.Prefix()
+  if offset:
+    logging.info('Resuming %s at byte %d.', url, offset)
+    web_file = OpenUrl(url, headers={'Range': 'bytes=%d-' % offset})
+  else:
+    journal.Reset(None, None)
+    web_file = OpenUrl(url)
+  with contextlib.closing(web_file):
+    return _StreamToPartial(web_file, journal, offset)
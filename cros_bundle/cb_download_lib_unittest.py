@@ -0,0 +1,420 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_download_lib module."""
+
+import contextlib
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+import zipfile
+
+import cb_download_lib
+from cb_archive_hashing_lib import DigestStream
+from cb_test_http_server import StandInServer
+
+
+class _RecordingReader(object):
+  """A file object that records the size of every read requested."""
+
+  def __init__(self, content):
+    self.source = StringIO.StringIO(content)
+    self.read_sizes = []
+
+  def read(self, size=-1):
+    self.read_sizes.append(size)
+    return self.source.read(size)
+
+
+class _FakeInfo(object):
+  """Stands in for the headers of an opened URL."""
+
+  def __init__(self, headers):
+    self.headers = headers
+
+  def getheader(self, name):
+    return self.headers.get(name)
+
+
+class TestPreallocate(unittest.TestCase):
+  """Unit tests related to Preallocate."""
+
+  def testPreallocateExtendsFile(self):
+    """Verify the file is extended to the requested size."""
+    with tempfile.TemporaryFile() as test_file:
+      if cb_download_lib.Preallocate(test_file.fileno(), 12345):
+        self.assertEqual(12345, os.fstat(test_file.fileno()).st_size)
+
+  def testUnsupportedFileSystem(self):
+    """Verify a file system refusing to allocate is not an error."""
+    libc_function = cb_download_lib.LibcFunction
+    cb_download_lib.LibcFunction = (
+        lambda *args: lambda fd, offset, size: errno.EOPNOTSUPP)
+    try:
+      with tempfile.TemporaryFile() as test_file:
+        self.assertFalse(cb_download_lib.Preallocate(test_file.fileno(),
+                                                     12345))
+    finally:
+      cb_download_lib.LibcFunction = libc_function
+
+  def testNothingToPreallocate(self):
+    """Verify nothing is done for an empty or unknown size."""
+    with tempfile.TemporaryFile() as test_file:
+      self.assertFalse(cb_download_lib.Preallocate(test_file.fileno(), 0))
+
+
+class TestContentLength(unittest.TestCase):
+  """Unit tests related to ContentLength."""
+
+  def testLengthKnown(self):
+    """Verify the announced length is returned as an integer."""
+    web_file = StringIO.StringIO()
+    web_file.info = lambda: _FakeInfo({'Content-Length': '42'})
+    self.assertEqual(42, cb_download_lib.ContentLength(web_file))
+
+  def testLengthMissing(self):
+    """Verify None when no length is announced."""
+    web_file = StringIO.StringIO()
+    web_file.info = lambda: _FakeInfo({})
+    self.assertEqual(None, cb_download_lib.ContentLength(web_file))
+
+  def testNoHeaders(self):
+    """Verify None when the file object has no headers at all."""
+    self.assertEqual(None,
+                     cb_download_lib.ContentLength(StringIO.StringIO()))
+
+
+class TestAtomicOutput(unittest.TestCase):
+  """Unit tests related to AtomicOutput."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.name = os.path.join(self.test_dir, 'image.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testCommit(self):
+    """Verify the file appears under its name only once complete."""
+    with cb_download_lib.AtomicOutput(self.name, size=11) as out:
+      out.write('new content')
+      self.assertFalse(os.path.exists(self.name))
+    with open(self.name) as result:
+      self.assertEqual('new content', result.read())
+    self.assertEqual(['image.bin'], os.listdir(self.test_dir))
+
+  def testAbortKeepsOldFile(self):
+    """Verify a failed write leaves the previous file and no temporary."""
+    with open(self.name, 'w') as old:
+      old.write('old content')
+    try:
+      with cb_download_lib.AtomicOutput(self.name) as out:
+        out.write('partial')
+        raise IOError('connection reset')
+    except IOError:
+      pass
+    with open(self.name) as result:
+      self.assertEqual('old content', result.read())
+    self.assertEqual(['image.bin'], os.listdir(self.test_dir))
+
+
+class TestCopyStream(unittest.TestCase):
+  """Unit tests related to CopyStream."""
+
+  def testReadsBoundedByChunkSize(self):
+    """Verify content is copied without reading more than a chunk at once."""
+    content = 'x' * 1000
+    source = _RecordingReader(content)
+    out = StringIO.StringIO()
+    self.assertEqual(1000, cb_download_lib.CopyStream(source, out,
+                                                      chunk_size=64))
+    self.assertEqual(content, out.getvalue())
+    self.assertEqual(set([64]), set(source.read_sizes))
+
+  def testStreamFed(self):
+    """Verify every byte copied is fed to the given stream."""
+    fed = StringIO.StringIO()
+    fed.update = fed.write
+    cb_download_lib.CopyStream(StringIO.StringIO('abcdef'),
+                               StringIO.StringIO(), stream=fed, chunk_size=4)
+    self.assertEqual('abcdef', fed.getvalue())
+
+  def testTruncatedSource(self):
+    """Verify IOError when the source ends before the expected size."""
+    self.assertRaises(IOError, cb_download_lib.CopyStream,
+                      StringIO.StringIO('abc'), StringIO.StringIO(), size=4)
+
+
+class TestSegmentedDownload(unittest.TestCase):
+  """Unit tests related to SegmentedDownload against a local server."""
+
+  def setUp(self):
+    self.saved = (cb_download_lib._connections, cb_download_lib._segment_size)
+    cb_download_lib.ConfigureDownloads(connections=4, segment_size=16 * 1024)
+    self.content = os.urandom(8 * 16 * 1024 - 100)
+    self.test_dir = tempfile.mkdtemp()
+    self.name = os.path.join(self.test_dir, 'image.bin')
+
+  def tearDown(self):
+    (cb_download_lib._connections, cb_download_lib._segment_size) = self.saved
+    shutil.rmtree(self.test_dir)
+
+  def _Download(self, server, stream=None):
+    with cb_download_lib.AtomicOutput(self.name,
+                                      size=len(self.content)) as out:
+      cb_download_lib.SegmentedDownload(server.url + '/image.bin', out,
+                                        len(self.content), stream=stream)
+
+  def testSegmentsAssembled(self):
+    """Verify the file is reassembled from ranges and hashed in order."""
+    server = StandInServer({'/image.bin': self.content}).Start()
+    try:
+      stream = DigestStream(['md5'])
+      self._Download(server, stream)
+    finally:
+      server.Stop()
+    with open(self.name, 'rb') as result:
+      self.assertEqual(self.content, result.read())
+    self.assertEqual(hashlib.md5(self.content).hexdigest(),
+                     stream.HexDigests()['md5'])
+    ranges = sorted(r for _, _, r in server.requests)
+    self.assertEqual(8, len(ranges))
+    self.assertTrue('bytes=0-16383' in ranges)
+
+  def testSegmentsFetchedConcurrently(self):
+    """Verify latency is overlapped across connections."""
+    latency = 0.2
+    server = StandInServer({'/image.bin': self.content},
+                           latency=latency).Start()
+    try:
+      start = time.time()
+      self._Download(server)
+      elapsed = time.time() - start
+    finally:
+      server.Stop()
+    # 8 segments over 4 connections pay about 2 latencies, not 8
+    self.assertTrue(elapsed < 5 * latency, elapsed)
+
+  def testRangesIgnored(self):
+    """Verify RangeUnsupportedError when the server ignores Range."""
+    server = StandInServer({'/image.bin': self.content}, ranges=False).Start()
+    try:
+      self.assertRaises(cb_download_lib.RangeUnsupportedError,
+                        self._Download, server)
+    finally:
+      server.Stop()
+    self.assertEqual([], os.listdir(self.test_dir))
+
+  def testMissingFile(self):
+    """Verify IOError when the server does not have the file."""
+    server = StandInServer({}).Start()
+    try:
+      self.assertRaises(IOError, self._Download, server)
+    finally:
+      server.Stop()
+
+  def testWorkerErrorRaised(self):
+    """Verify an error other than IOError in a worker ends the download."""
+    fetch_segment = cb_download_lib._FetchSegment
+
+    def FailingFetch(url, name, start, end, journal):
+      if start:
+        raise ValueError('Bad Content-Range')
+      fetch_segment(url, name, start, end, journal)
+    server = StandInServer({'/image.bin': self.content}).Start()
+    cb_download_lib._FetchSegment = FailingFetch
+    try:
+      self.assertRaises(ValueError, self._Download, server)
+    finally:
+      cb_download_lib._FetchSegment = fetch_segment
+      server.Stop()
+
+
+def _MakeZip(members, compression=zipfile.ZIP_DEFLATED):
+  """Returns the contents of a zip archive of a dict of member contents."""
+  archive = StringIO.StringIO()
+  with contextlib.closing(zipfile.ZipFile(archive, 'w', compression)) as zpf:
+    for name in sorted(members):
+      zpf.writestr(name, members[name])
+  return archive.getvalue()
+
+
+class TestHttpRangeFile(unittest.TestCase):
+  """Unit tests related to HttpRangeFile against a local server."""
+
+  def setUp(self):
+    self.content = os.urandom(10000)
+    self.server = StandInServer({'/image.bin': self.content},
+                                etag='"v1"').Start()
+    self.url = self.server.url + '/image.bin'
+
+  def tearDown(self):
+    self.server.Stop()
+
+  def testTailFetchedOnOpen(self):
+    """Verify only the tail is fetched on open and reads served from it."""
+    remote = cb_download_lib.HttpRangeFile(self.url, tail_size=100)
+    self.assertEqual(10000, remote.size)
+    remote.seek(-50, os.SEEK_END)
+    self.assertEqual(self.content[-50:], remote.read())
+    self.assertEqual([('GET', '/image.bin', 'bytes=-100')],
+                     self.server.requests)
+
+  def testSequentialReadsShareRange(self):
+    """Verify reads carrying on from the last one reuse its range."""
+    remote = cb_download_lib.HttpRangeFile(self.url, tail_size=100)
+    remote.seek(1000)
+    data = ''.join(remote.read(size) for size in [10, 500, 8990])
+    self.assertEqual(self.content[1000:], data)
+    remote.seek(0)
+    self.assertEqual(self.content[:10], remote.read(10))
+    remote.close()
+    self.assertEqual(['bytes=-100', 'bytes=1000-9899', 'bytes=0-9899'],
+                     [r for _, _, r in self.server.requests])
+
+  def testSmallFileWhole(self):
+    """Verify a file shorter than the tail is read in one request."""
+    remote = cb_download_lib.HttpRangeFile(self.url, tail_size=20000)
+    self.assertEqual(self.content, remote.read())
+    self.assertEqual(1, len(self.server.requests))
+
+  def testRangesIgnored(self):
+    """Verify RangeUnsupportedError when the server ignores Range."""
+    self.server.ranges = False
+    self.assertRaises(cb_download_lib.RangeUnsupportedError,
+                      cb_download_lib.HttpRangeFile, self.url, 100)
+
+  def testChangedFile(self):
+    """Verify RangeUnsupportedError when the file changes while read."""
+    remote = cb_download_lib.HttpRangeFile(self.url, tail_size=100)
+    self.server.etag = '"v2"'
+    self.assertRaises(cb_download_lib.RangeUnsupportedError, remote.read, 10)
+
+
+class TestFetchZipMember(unittest.TestCase):
+  """Unit tests related to FetchZipMember against a local server."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.name = os.path.join(self.test_dir, 'cgpt')
+    self.members = {'cgpt': os.urandom(2000) + 'x' * 5000,
+                    'large.bin': os.urandom(200 * 1024)}
+
+  def tearDown(self):
+    self.server.Stop()
+    shutil.rmtree(self.test_dir)
+
+  def _Fetch(self, member, compression=zipfile.ZIP_DEFLATED):
+    self.archive = _MakeZip(self.members, compression)
+    self.server = StandInServer({'/au.zip': self.archive}).Start()
+    return cb_download_lib.FetchZipMember(self.server.url + '/au.zip', member,
+                                          self.name)
+
+  def testOnlyMemberFetched(self):
+    """Verify one member is extracted without fetching the others."""
+    self.assertTrue(self._Fetch('cgpt'))
+    with open(self.name, 'rb') as cgpt:
+      self.assertEqual(self.members['cgpt'], cgpt.read())
+    # the directory with the tail, then cgpt, abandoning the range once read
+    self.assertEqual(2, len(self.server.requests))
+    self.assertEqual(['cgpt'], os.listdir(self.test_dir))
+
+  def testStoredMember(self):
+    """Verify an uncompressed member is extracted."""
+    self.assertTrue(self._Fetch('large.bin', zipfile.ZIP_STORED))
+    with open(self.name, 'rb') as member:
+      self.assertEqual(self.members['large.bin'], member.read())
+
+  def testMissingMember(self):
+    """Verify False for a member the archive lacks."""
+    self.assertFalse(self._Fetch('missing'))
+    self.assertEqual([], os.listdir(self.test_dir))
+
+  def testCorruptMember(self):
+    """Verify BadZipfile when the member fails its CRC, leaving no file."""
+    self.archive = _MakeZip(self.members, zipfile.ZIP_STORED)
+    offset = self.archive.index(self.members['cgpt'][:100])
+    self.archive = (self.archive[:offset] + 'y' +
+                    self.archive[offset + 1:])
+    self.server = StandInServer({'/au.zip': self.archive}).Start()
+    self.assertRaises(zipfile.BadZipfile, cb_download_lib.FetchZipMember,
+                      self.server.url + '/au.zip', 'cgpt', self.name)
+    self.assertEqual([], os.listdir(self.test_dir))
+
+
+class TestDownloadJournal(unittest.TestCase):
+  """Unit tests related to DownloadJournal."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.name = os.path.join(self.test_dir, 'image.bin')
+    self.url = 'http://server/image.bin'
+    self.journal = cb_download_lib.DownloadJournal(self.name, self.url)
+    self.journal.Reset(100, '"v1"')
+    with open(self.journal.partial_name, 'wb') as partial:
+      partial.write('x' * 100)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testRangesMerged(self):
+    """Verify adjacent and overlapping ranges are merged."""
+    for start, end in [(50, 60), (0, 10), (10, 20), (15, 30)]:
+      self.journal.Add(start, end)
+    self.assertEqual([(0, 30), (50, 60)], self.journal.ranges)
+    self.assertEqual(30, self.journal.Prefix())
+    self.assertTrue(self.journal.Covers(52, 60))
+    self.assertFalse(self.journal.Covers(25, 55))
+    self.assertFalse(self.journal.Complete())
+    self.journal.Add(30, 100)
+    self.assertTrue(self.journal.Complete())
+
+  def testReloaded(self):
+    """Verify the journal is read back by a later attempt."""
+    self.journal.Add(0, 40)
+    journal = cb_download_lib.DownloadJournal(self.name, self.url)
+    self.assertEqual((100, '"v1"', [(0, 40)]),
+                     (journal.size, journal.validator, journal.ranges))
+
+  def testOtherUrlIgnored(self):
+    """Verify a journal of a download from another URL is ignored."""
+    self.journal.Add(0, 40)
+    journal = cb_download_lib.DownloadJournal(self.name, self.url + '.md5')
+    self.assertEqual(0, journal.Prefix())
+
+  def testMissingPartialIgnored(self):
+    """Verify a journal whose partial file is gone is ignored."""
+    self.journal.Add(0, 40)
+    os.remove(self.journal.partial_name)
+    journal = cb_download_lib.DownloadJournal(self.name, self.url)
+    self.assertEqual([], journal.ranges)
+
+  def testCorruptJournalIgnored(self):
+    """Verify an unparseable journal is treated as empty."""
+    with open(self.journal.path, 'w') as journal_file:
+      journal_file.write('{not json')
+    journal = cb_download_lib.DownloadJournal(self.name, self.url)
+    self.assertEqual((None, []), (journal.size, journal.ranges))
+
+  def testPromoteAndDiscard(self):
+    """Verify promotion renames the partial file and drops the journal."""
+    cb_download_lib.PromoteDownload(self.name)
+    self.assertEqual(['image.bin'], os.listdir(self.test_dir))
+    self.journal.Reset(100, None)
+    with open(self.journal.partial_name, 'wb') as partial:
+      partial.write('x')
+    cb_download_lib.DiscardDownload(self.name)
+    self.assertEqual(['image.bin'], os.listdir(self.test_dir))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
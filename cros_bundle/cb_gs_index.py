@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module indexes Google Storage listings of whole board/channel trees.
+
+Each 'gsutil ls' pays several seconds of startup, so rather than listing one
+release directory per resource and per naming scheme, the board/channel
+prefix holding all releases is listed once, recursively, and every later
+query for a release directory under it is answered from memory.
+"""
+
+import logging
+import os
+import threading
+
+from cb_util import RunCommand
+
+# gsutil reports a prefix without any object below it with this message.
+NO_MATCH_MESSAGE = 'matched no objects'
+
+
+def IndexPrefix(url):
+  """Returns the board/channel prefix a release directory URL is under.
+
+  Args:
+    url: gs:// URL of a release directory, optionally ending with '/*', e.g.
+         gs://chromeos-releases/dev-channel/stumpy/1235.3.0/*
+  Returns:
+    a string, e.g. gs://chromeos-releases/dev-channel/stumpy
+  """
+  if url.endswith('/*'):
+    url = url[:-2]
+  return os.path.dirname(url.rstrip('/'))
+
+
+class GsIndex(object):
+
+  """An in-memory index of object URLs by directory, per listed prefix.
+
+  It contains the following fields:
+  - prefixes: a dict mapping each board/channel prefix listed to a dict
+      mapping directory URL, without trailing slash, to the object URLs
+      directly in it
+
+  Only listings holding objects are indexed: an empty one, which gsutil
+  may also return when it cannot authenticate, and a failed one are listed
+  again by the next query rather than taken to mean no such build.
+  Concurrent queries under one prefix wait for a single listing.
+  """
+
+  def __init__(self):
+    self.prefixes = {}
+    self._lock = threading.Lock()
+    self._prefix_locks = {}
+
+  def _ListPrefix(self, prefix):
+    """Lists every object under a prefix and indexes it by directory.
+
+    Args:
+      prefix: gs:// URL of a board/channel
+    Returns:
+      a dict mapping directory URL to the object URLs directly in it
+    Raises:
+      IOError when gsutil fails for any reason other than no object found
+    """
+    result = RunCommand(['gsutil', 'ls', prefix + '/**'], redirect_stdout=True,
+                        redirect_stderr=True)
+    directories = {}
+    if result.returncode:
+      if NO_MATCH_MESSAGE in (result.error or ''):
+        logging.debug('No objects under %s.', prefix)
+        return directories
+      raise IOError('Error listing %s: stdout = %r, stderr = %r' %
+                    (prefix, result.output, result.error))
+    for line in result.output.splitlines():
+      line = line.strip()
+      if line and not line.endswith('/'):
+        directories.setdefault(os.path.dirname(line), []).append(line)
+    logging.info('Indexed %d directories under %s.', len(directories), prefix)
+    return directories
+
+  def List(self, url):
+    """Returns the object URLs in a release directory.
+
+    The board/channel prefix of the directory is listed on first use.
+
+    Args:
+      url: gs:// URL of a release directory, optionally ending with '/*'
+    Returns:
+      a list of gs:// URLs, empty if the directory holds no object
+    Raises:
+      IOError when the prefix cannot be listed
+    """
+    directory = url[:-2] if url.endswith('/*') else url
+    directories = self.Directories(IndexPrefix(url))
+    return list(directories.get(directory.rstrip('/'), []))
+
+  def Directories(self, prefix):
+    """Returns every directory under a board/channel prefix.
+
+    The prefix is listed on first use.
+
+    Args:
+      prefix: gs:// URL of a board/channel, without trailing slash
+    Returns:
+      a dict mapping directory URL to the object URLs directly in it
+    Raises:
+      IOError when the prefix cannot be listed
+    """
+    with self._lock:
+      prefix_lock = self._prefix_locks.setdefault(prefix, threading.Lock())
+    with prefix_lock:
+      if prefix in self.prefixes:
+        return self.prefixes[prefix]
+      directories = self._ListPrefix(prefix)
+      if directories:
+        self.prefixes[prefix] = directories
+    return directories
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_gs_index module, against a fake gsutil."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import cb_gs_index
+import cb_url_lib
+from cb_constants import IMAGE_GSD_PREFIX
+
+_TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'testdata')
+_STUMPY = 'gs://chromeos-releases/dev-channel/stumpy'
+
+
+class _FakeGsutilTestCase(unittest.TestCase):
+  """Puts testdata/fake_gsutil first on PATH as gsutil."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    os.symlink(os.path.join(_TESTDATA, 'fake_gsutil'),
+               os.path.join(self.test_dir, 'gsutil'))
+    self.log = os.path.join(self.test_dir, 'gsutil.log')
+    self.saved_env = dict(os.environ)
+    os.environ['PATH'] = self.test_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_GSUTIL_LOG'] = self.log
+    os.environ['FAKE_GSUTIL_LISTING'] = os.path.join(
+        _TESTDATA, 'gsutil_ls_recursive.txt')
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.saved_env)
+    shutil.rmtree(self.test_dir)
+
+  def _Invocations(self):
+    if not os.path.exists(self.log):
+      return []
+    with open(self.log) as log:
+      return log.read().splitlines()
+
+
+class TestIndexPrefix(unittest.TestCase):
+  """Unit tests related to IndexPrefix."""
+
+  def testReleaseDirectory(self):
+    """Verify the board/channel prefix of a release directory."""
+    self.assertEqual(_STUMPY, cb_gs_index.IndexPrefix(_STUMPY + '/1.0/*'))
+    self.assertEqual(_STUMPY, cb_gs_index.IndexPrefix(_STUMPY + '/1.0/'))
+
+
+class TestGsIndex(_FakeGsutilTestCase):
+  """Unit tests related to GsIndex."""
+
+  def testPrefixListedOnce(self):
+    """Verify all release directories of a board are answered by one ls."""
+    index = cb_gs_index.GsIndex()
+    listed = index.List(_STUMPY + '/1235.3.0/*')
+    self.assertEqual(5, len(listed))
+    self.assertTrue(_STUMPY + '/1235.3.0/'
+                    'chromeos_1235.3.0_stumpy_ssd_dev-channel_mp-v2.bin'
+                    in listed)
+    self.assertEqual(3, len(index.List(_STUMPY + '/1235.4.0/*')))
+    self.assertEqual([], index.List(_STUMPY + '/9999.0.0/*'))
+    self.assertEqual(['ls %s/**' % _STUMPY], self._Invocations())
+
+  def testDirectories(self):
+    """Verify every release directory of a board is returned."""
+    index = cb_gs_index.GsIndex()
+    self.assertEqual([_STUMPY + '/1235.3.0', _STUMPY + '/1235.4.0'],
+                     sorted(index.Directories(_STUMPY)))
+    self.assertEqual(3, len(index.List(_STUMPY + '/1235.4.0/*')))
+    self.assertEqual(1, len(self._Invocations()))
+
+  def testEmptyListingNotIndexed(self):
+    """Verify a board/channel without objects is listed again next time."""
+    index = cb_gs_index.GsIndex()
+    missing = 'gs://chromeos-releases/dev-channel/stumpy-rc'
+    self.assertEqual([], index.List(missing + '/1235.3.0/*'))
+    self.assertEqual([], index.List(missing + '/1235.4.0/*'))
+    self.assertEqual(2, len(self._Invocations()))
+    self.assertFalse(missing in index.prefixes)
+
+  def testFailureNotIndexed(self):
+    """Verify IOError on other gsutil failures, retried next time."""
+    os.environ['FAKE_GSUTIL_LISTING'] = os.path.join(self.test_dir, 'none')
+    index = cb_gs_index.GsIndex()
+    self.assertRaises(IOError, index.List, _STUMPY + '/1235.3.0/*')
+    self.assertFalse(_STUMPY in index.prefixes)
+
+
+class TestDetermineUrlWithGsIndex(_FakeGsutilTestCase):
+  """Unit tests related to DetermineUrl answering GSD lookups from an index."""
+
+  def setUp(self):
+    _FakeGsutilTestCase.setUp(self)
+    cb_url_lib.SetGsIndex(cb_gs_index.GsIndex())
+
+  def tearDown(self):
+    cb_url_lib.SetGsIndex(None)
+    _FakeGsutilTestCase.tearDown(self)
+
+  def testLookupsShareOneListing(self):
+    """Verify every resource of a board is resolved from one listing."""
+    page = IMAGE_GSD_PREFIX + '/dev-channel/stumpy/1235.3.0'
+    self.assertEqual(
+        _STUMPY + '/1235.3.0/chromeos_1235.3.0_stumpy_recovery_dev-channel_'
+        'mp-v2.bin',
+        cb_url_lib.DetermineUrl(page, ['chromeos', 'recovery', '.bin']))
+    self.assertEqual(
+        _STUMPY + '/1235.3.0/ChromeOS-factory-R17-1235.3.0-a1-b2-stumpy.zip',
+        cb_url_lib.DetermineUrl(page, ['chromeos-factory', '.zip']))
+    self.assertEqual(None, cb_url_lib.DetermineUrl(
+        IMAGE_GSD_PREFIX + '/dev-channel/stumpy/1235.4.0', ['ssd', '.bin']))
+    self.assertEqual(1, len(self._Invocations()))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
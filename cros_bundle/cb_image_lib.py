@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module reads the partition tables and file systems of disk images.
+
+ChromeOS disk images are GPT partitioned, and their ext2/3/4 partitions
+keep the stale contents of freed blocks. Reading the GPT entries and ext
+block bitmaps tells those blocks apart, so that a copy of an image can have
+them zeroed, see ElideFreeBlocks, and cost neither compression time nor
+bundle size. Only the stateful partition is elided: dm-verity hashes every
+block of the root file systems, free ones included, and kernels are
+signed. File systems are only read, with struct; nothing is mounted.
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import struct
+import tempfile
+
+from cb_artifact_store import PlaceFile
+from cb_util import LibcFunction
+
+# Size of a GPT logical block, of ChromeOS disk images.
+SECTOR_SIZE = 512
+GPT_SIGNATURE = 'EFI PART'
+EXT_MAGIC = 0xEF53
+# Byte offset of the superblock in an ext2/3/4 file system.
+EXT_SUPERBLOCK_OFFSET = 1024
+# Bytes read and compared at a time when verifying an elided image.
+COMPARE_CHUNK_SIZE = 1024 * 1024
+# Labels of the partitions whose free blocks may be zeroed. Nothing
+# verifies their blocks bit for bit, unlike the verity-protected ROOT-A/B.
+ELIDED_PARTITIONS = (u'STATE',)
+# fallocate(2) mode deallocating a byte range, keeping the file size.
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# lseek(2) whences of Linux seeking to the next data or hole of a file.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+# Zero-filled blocks of this size, aligned on it, are deallocated from
+# images before a sparse tar. A multiple of file system block sizes.
+HOLE_BLOCK_SIZE = 64 * 1024
+
+# ext feature flags changing where or whether block bitmaps can be trusted.
+_INCOMPAT_RECOVER = 0x4
+_INCOMPAT_META_BG = 0x10
+_INCOMPAT_64BIT = 0x80
+_RO_COMPAT_BIGALLOC = 0x200
+# Block group flag of a group whose block bitmap was never written.
+_BG_BLOCK_UNINIT = 0x2
+
+_fallocate = LibcFunction(
+    'fallocate64', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+
+
+def _ReadAt(image, offset, size):
+  """Returns size bytes of an open file at offset, raising IOError if short."""
+  image.seek(offset)
+  data = image.read(size)
+  if len(data) != size:
+    raise IOError('Expected %d bytes at %d of %s but read %d.' %
+                  (size, offset, image.name, len(data)))
+  return data
+
+
+def ReadPartitions(image):
+  """Returns the partitions of a GPT disk image.
+
+  Args:
+    image: a file object of the disk image, open for reading
+  Returns:
+    a list of (label, offset, size) tuples, offset and size in bytes, in
+    partition table order; empty when the image has no GPT
+  Raises:
+    IOError when the image cannot be read
+  """
+  header = _ReadAt(image, SECTOR_SIZE, 92)
+  if header[:8] != GPT_SIGNATURE:
+    return []
+  (entries_lba, count, entry_size) = struct.unpack_from('<QII', header, 72)
+  table = _ReadAt(image, entries_lba * SECTOR_SIZE, count * entry_size)
+  partitions = []
+  for index in range(count):
+    entry = table[index * entry_size:(index + 1) * entry_size]
+    if entry[:16] == '\0' * 16:
+      # unused entry
+      continue
+    (first_lba, last_lba) = struct.unpack_from('<QQ', entry, 32)
+    label = entry[56:128].decode('utf-16-le').split(u'\0')[0]
+    partitions.append((label, first_lba * SECTOR_SIZE,
+                       (last_lba - first_lba + 1) * SECTOR_SIZE))
+  return partitions
+
+
+def _BitmapRuns(bitmap, count):
+  """Returns the runs of clear bits among the first count bits of a bitmap.
+
+  Args:
+    bitmap: a string, bit i of byte j being bit 8 * j + i
+    count: an integer, bits to look at
+  Returns:
+    a list of (first bit, number of bits) tuples
+  """
+  runs = []
+  start = None
+  for index in xrange(0, count, 8):
+    byte = ord(bitmap[index / 8])
+    if byte in (0, 0xff) and index + 8 <= count:
+      # eight blocks alike, the common case, dealt with at once
+      bits = [byte & 1]
+    else:
+      bits = [byte >> bit & 1 for bit in range(min(8, count - index))]
+    for (offset, used) in enumerate(bits):
+      if not used and start is None:
+        start = index + offset
+      elif used and start is not None:
+        runs.append((start, index + offset - start))
+        start = None
+  if start is not None:
+    runs.append((start, count - start))
+  return runs
+
+
+def ExtFreeRanges(image, offset, size):
+  """Returns the byte ranges of the free blocks of an ext2/3/4 partition.
+
+  Block groups whose bitmap was never initialized are left out, as are
+  file systems with a journal to replay, meta_bg or bigalloc. Blocks past
+  the end of the file system, e.g. a verity hash tree, are never free.
+
+  Args:
+    image: a file object of the disk image, open for reading
+    offset: an integer, byte offset of the partition in the image
+    size: an integer, size of the partition in bytes
+  Returns:
+    a list of (offset, length) tuples, in bytes from the start of the
+    image; empty when the partition holds no ext file system
+  Raises:
+    IOError when the image cannot be read
+  """
+  if size < EXT_SUPERBLOCK_OFFSET * 2:
+    return []
+  sb = _ReadAt(image, offset + EXT_SUPERBLOCK_OFFSET, 1024)
+  if struct.unpack_from('<H', sb, 56)[0] != EXT_MAGIC:
+    return []
+  (blocks_lo, first_data_block, log_block_size) = struct.unpack_from(
+      '<I12xII', sb, 4)
+  blocks_per_group = struct.unpack_from('<I', sb, 32)[0]
+  (incompat, ro_compat) = struct.unpack_from('<II', sb, 96)
+  if (incompat & (_INCOMPAT_RECOVER | _INCOMPAT_META_BG) or
+      ro_compat & _RO_COMPAT_BIGALLOC):
+    logging.info('Not eliding free blocks of partition at %d of %s, '
+                 'features %#x/%#x.', offset, image.name, incompat, ro_compat)
+    return []
+  block_size = 1024 << log_block_size
+  blocks = blocks_lo
+  desc_size = 32
+  if incompat & _INCOMPAT_64BIT:
+    blocks |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+    desc_size = struct.unpack_from('<H', sb, 254)[0]
+  blocks = min(blocks, size / block_size)
+  groups = (blocks - first_data_block + blocks_per_group - 1) / blocks_per_group
+  table = _ReadAt(image, offset + (first_data_block + 1) * block_size,
+                  groups * desc_size)
+  ranges = []
+  for group in range(groups):
+    desc = table[group * desc_size:(group + 1) * desc_size]
+    if struct.unpack_from('<H', desc, 18)[0] & _BG_BLOCK_UNINIT:
+      continue
+    bitmap_block = struct.unpack_from('<I', desc, 0)[0]
+    if desc_size >= 64:
+      bitmap_block |= struct.unpack_from('<I', desc, 0x20)[0] << 32
+    first_block = first_data_block + group * blocks_per_group
+    count = min(blocks_per_group, blocks - first_block)
+    bitmap = _ReadAt(image, offset + bitmap_block * block_size, block_size)
+    for (start, length) in _BitmapRuns(bitmap, count):
+      ranges.append((offset + (first_block + start) * block_size,
+                     length * block_size))
+  return ranges
+
+
+def FreeRanges(image):
+  """Returns the byte ranges of the free blocks of the elided partitions.
+
+  See ELIDED_PARTITIONS; every other partition is kept byte for byte.
+
+  Args:
+    image: a file object of the disk image, open for reading
+  Returns:
+    a sorted list of (offset, length) tuples, in bytes
+  Raises:
+    IOError when the image cannot be read
+  """
+  ranges = []
+  for (label, offset, size) in ReadPartitions(image):
+    if label in ELIDED_PARTITIONS:
+      ranges.extend(ExtFreeRanges(image, offset, size))
+  return sorted(ranges)
+
+
+def PunchHole(fd, offset, length):
+  """Deallocate a byte range of a file, which then reads as zeros.
+
+  Args:
+    fd: an integer, file descriptor open for writing
+    offset: an integer, first byte of the range
+    length: an integer, bytes in the range
+  Raises:
+    OSError when the file system cannot punch holes
+  """
+  if not _fallocate:
+    raise OSError(errno.ENOSYS, 'fallocate is not available')
+  if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset,
+                length):
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def DataExtents(fd, size):
+  """Returns the byte ranges of a file holding data, skipping its holes.
+
+  Args:
+    fd: an integer, file descriptor open for reading
+    size: an integer, size of the file in bytes
+  Returns:
+    a list of (start, end) tuples, end excluded; the whole file when the
+    file system cannot tell holes apart
+  """
+  extents = []
+  position = 0
+  while position < size:
+    try:
+      start = os.lseek(fd, position, SEEK_DATA)
+      end = os.lseek(fd, start, SEEK_HOLE)
+    except OSError as e:
+      if e.errno == errno.ENXIO:
+        # only a hole left
+        break
+      return [(0, size)]
+    extents.append((start, min(end, size)))
+    position = end
+  return extents
+
+
+def PunchZeroBlocks(filename):
+  """Deallocate the zero-filled blocks of a file, its contents unchanged.
+
+  Only the data extents of the file are read, see DataExtents. tar --sparse
+  then archives the file as a GNU sparse member holding its data only.
+  The file must be private: punching a hardlinked file changes every name
+  of it, e.g. a download shared with other runs.
+
+  Args:
+    filename: name of the file, writable
+  Returns:
+    an integer, the number of bytes deallocated
+  Raises:
+    IOError or OSError when the file cannot be read or holes punched
+  """
+  zeros = '\0' * HOLE_BLOCK_SIZE
+  punched = 0
+  with open(filename, 'r+b') as image:
+    fd = image.fileno()
+    size = os.fstat(fd).st_size
+    for (start, end) in DataExtents(fd, size):
+      position = start - start % HOLE_BLOCK_SIZE
+      image.seek(position)
+      # start of the zero blocks read and not punched yet
+      run = None
+      while position < end:
+        block = image.read(HOLE_BLOCK_SIZE)
+        if not block:
+          break
+        if block == zeros:
+          if run is None:
+            run = position
+        elif run is not None:
+          PunchHole(fd, run, position - run)
+          punched += position - run
+          run = None
+        position += len(block)
+      if run is not None:
+        PunchHole(fd, run, position - run)
+        punched += position - run
+  return punched
+
+
+def _ZeroRange(image, offset, length):
+  """Make a byte range of a file read as zeros, deallocating it if possible."""
+  try:
+    PunchHole(image.fileno(), offset, length)
+    return
+  except OSError:
+    pass
+  image.seek(offset)
+  zeros = '\0' * COMPARE_CHUNK_SIZE
+  while length > 0:
+    image.write(zeros[:length])
+    length -= COMPARE_CHUNK_SIZE
+
+
+def ElideFreeBlocks(source, dest):
+  """Put a copy of a disk image with the free blocks of its stateful zeroed.
+
+  The copy is placed the cheapest way the file system allows, see
+  PlaceFile, never as a hardlink, then its free blocks are deallocated, or
+  overwritten with zeros where holes cannot be punched. source is never
+  modified. dest is replaced atomically, and left alone when there are no
+  free blocks to elide.
+
+  Args:
+    source: name of the disk image
+    dest: name of the copy
+  Returns:
+    an integer, the number of bytes elided
+  Raises:
+    IOError or OSError when the image cannot be read or the copy written
+  """
+  with open(source, 'rb') as image:
+    ranges = FreeRanges(image)
+  if not ranges:
+    return 0
+  dirname = os.path.dirname(os.path.abspath(dest))
+  fd, temp_name = tempfile.mkstemp(dir=dirname,
+                                   prefix='.' + os.path.basename(dest))
+  os.close(fd)
+  try:
+    PlaceFile(source, temp_name, hardlink=False)
+    with open(temp_name, 'r+b') as copy:
+      for (offset, length) in ranges:
+        _ZeroRange(copy, offset, length)
+    os.rename(temp_name, dest)
+  except:
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+    raise
+  return sum(length for (_, length) in ranges)
+
+
+def VerifyElision(source, dest):
+  """Checks that a copy of a disk image differs only by zeroed free blocks.
+
+  The copy must have the same free blocks as the image, read as zeros
+  there, and be identical to it everywhere else: every block its file
+  systems use, their metadata, partition tables and other partitions.
+
+  Args:
+    source: name of the disk image
+    dest: name of the copy, see ElideFreeBlocks
+  Returns:
+    a boolean, True when the copy is functionally identical to the image
+  Raises:
+    IOError when either file cannot be read
+  """
+  with open(source, 'rb') as image:
+    with open(dest, 'rb') as copy:
+      ranges = FreeRanges(image)
+      if FreeRanges(copy) != ranges:
+        logging.error('Free blocks of %s differ from those of %s.', dest,
+                      source)
+        return False
+      size = os.fstat(image.fileno()).st_size
+      if os.fstat(copy.fileno()).st_size != size:
+        logging.error('Size of %s differs from that of %s.', dest, source)
+        return False
+      position = 0
+      for (offset, length) in ranges + [(size, 0)]:
+        # the kept bytes up to the free range, then the zeroed range
+        for (start, end, zeroed) in [(position, offset, False),
+                                     (offset, offset + length, True)]:
+          image.seek(start)
+          copy.seek(start)
+          while start < end:
+            want = min(COMPARE_CHUNK_SIZE, end - start)
+            expected = '\0' * want if zeroed else image.read(want)
+            if copy.read(want) != expected:
+              logging.error('%s differs from %s at bytes %d-%d.', dest,
+                            source, start, start + want - 1)
+              return False
+            start += want
+        position = offset + length
+  return True
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_image_lib module."""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+
+import cb_image_lib
+from cb_image_lib import SECTOR_SIZE
+from cb_util import RunCommand
+
+# First sector of the test partitions, as cgpt aligns them.
+_FIRST_LBA = 64
+
+
+def _MakeGptImage(name, partitions):
+  """Write a GPT disk image holding the given partition contents.
+
+  Only what ReadPartitions reads is filled in; checksums are left out.
+
+  Args:
+    name: name of the image file to create
+    partitions: a list of (label, name of a file holding the partition)
+  """
+  entries = ''
+  contents = []
+  lba = _FIRST_LBA
+  for (index, (label, filename)) in enumerate(partitions):
+    with open(filename, 'rb') as partition:
+      content = partition.read()
+    sectors = (len(content) + SECTOR_SIZE - 1) / SECTOR_SIZE
+    entries += struct.pack('<16s16sQQQ72s', chr(index + 1) * 16,
+                           chr(index + 1) * 16, lba, lba + sectors - 1, 0,
+                           label.encode('utf-16-le'))
+    contents.append((lba, content))
+    lba += sectors
+  header = struct.pack('<8s64xQII', cb_image_lib.GPT_SIGNATURE, 2, 128, 128)
+  with open(name, 'wb') as image:
+    image.seek(SECTOR_SIZE)
+    image.write(header)
+    image.seek(2 * SECTOR_SIZE)
+    image.write(entries.ljust(128 * 128, '\0'))
+    for (first_lba, content) in contents:
+      image.seek(first_lba * SECTOR_SIZE)
+      image.write(content)
+    image.truncate(lba * SECTOR_SIZE)
+
+
+def _DumpFreeBlocks(filesystem):
+  """Returns the free (first, last) blocks of a file system, from dumpe2fs."""
+  output = RunCommand(['dumpe2fs', filesystem], redirect_stdout=True,
+                      redirect_stderr=True).output
+  blocks = []
+  for line in re.findall(r'^\s+Free blocks: (.*)$', output, re.MULTILINE):
+    for spec in line.split(', '):
+      if spec:
+        first, _, last = spec.partition('-')
+        blocks.append((int(first), int(last or first)))
+  return blocks
+
+
+class TestElideFreeBlocks(unittest.TestCase):
+  """Unit tests related to FreeRanges, ElideFreeBlocks and VerifyElision."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    root = os.path.join(self.test_dir, 'root')
+    os.mkdir(root)
+    self.file_content = os.urandom(100 * 1024)
+    with open(os.path.join(root, 'file'), 'wb') as root_file:
+      root_file.write(self.file_content)
+    self.filesystem = os.path.join(self.test_dir, 'rootfs')
+    RunCommand(['mke2fs', '-q', '-F', '-t', 'ext4', '-b', '1024', '-d', root,
+                self.filesystem, '4096'], redirect_stdout=True,
+               redirect_stderr=True)
+    # stale data in every free block, as left by deleted files
+    self.free_blocks = _DumpFreeBlocks(self.filesystem)
+    with open(self.filesystem, 'r+b') as filesystem:
+      for (first, last) in self.free_blocks:
+        filesystem.seek(first * 1024)
+        filesystem.write(os.urandom((last - first + 1) * 1024))
+    self.other = os.path.join(self.test_dir, 'other')
+    with open(self.other, 'wb') as other:
+      other.write(os.urandom(64 * 1024))
+    self.image = os.path.join(self.test_dir, 'image.bin')
+    # the same file system, stale free blocks included, as root and stateful
+    _MakeGptImage(self.image, [('KERN-A', self.other),
+                               ('ROOT-A', self.filesystem),
+                               ('STATE', self.filesystem)])
+    self.root_offset = (_FIRST_LBA + 128) * SECTOR_SIZE
+    self.offset = self.root_offset + 4096 * 1024
+    self.dest = os.path.join(self.test_dir, 'elided.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Md5(self, name):
+    with open(name, 'rb') as image:
+      return hashlib.md5(image.read()).hexdigest()
+
+  def testPartitions(self):
+    """Verify GPT entries are read in table order."""
+    with open(self.image, 'rb') as image:
+      self.assertEqual([(u'KERN-A', _FIRST_LBA * SECTOR_SIZE, 64 * 1024),
+                        (u'ROOT-A', self.root_offset, 4096 * 1024),
+                        (u'STATE', self.offset, 4096 * 1024)],
+                       cb_image_lib.ReadPartitions(image))
+
+  def testFreeRangesMatchDumpe2fs(self):
+    """Verify the free blocks found are those dumpe2fs lists."""
+    with open(self.image, 'rb') as image:
+      ranges = cb_image_lib.FreeRanges(image)
+    self.assertEqual(
+        [(self.offset + first * 1024, (last - first + 1) * 1024)
+         for (first, last) in self.free_blocks], ranges)
+
+  def testNoGpt(self):
+    """Verify nothing is elided from a file without a partition table."""
+    self.assertEqual(0, cb_image_lib.ElideFreeBlocks(self.other, self.dest))
+    self.assertFalse(os.path.exists(self.dest))
+
+  def testElided(self):
+    """Verify free blocks are zeroed in a copy, the image left alone."""
+    md5 = self._Md5(self.image)
+    elided = cb_image_lib.ElideFreeBlocks(self.image, self.dest)
+    self.assertEqual(sum(last - first + 1 for (first, last)
+                         in self.free_blocks) * 1024, elided)
+    self.assertEqual(md5, self._Md5(self.image))
+    self.assertTrue(cb_image_lib.VerifyElision(self.image, self.dest))
+    with open(self.dest, 'rb') as dest:
+      (first, last) = self.free_blocks[-1]
+      dest.seek(self.offset + first * 1024)
+      self.assertEqual('\0' * 1024, dest.read(1024))
+      dest.seek(self.offset)
+      partition = dest.read(4096 * 1024)
+    # the file system is intact and its file unchanged
+    with open(self.filesystem, 'wb') as filesystem:
+      filesystem.write(partition)
+    result = RunCommand(['e2fsck', '-f', '-n', self.filesystem],
+                        redirect_stdout=True, redirect_stderr=True)
+    self.assertEqual(0, result.returncode)
+    result = RunCommand(['debugfs', '-R', 'cat /file', self.filesystem],
+                        redirect_stdout=True, redirect_stderr=True)
+    self.assertEqual(self.file_content, result.output)
+
+  def testRootFileSystemKept(self):
+    """Verify the verity-protected ROOT-A is left byte for byte."""
+    cb_image_lib.ElideFreeBlocks(self.image, self.dest)
+    with open(self.image, 'rb') as image:
+      with open(self.dest, 'rb') as dest:
+        # the partition table, KERN-A and ROOT-A
+        self.assertEqual(image.read(self.offset), dest.read(self.offset))
+
+  def testVerificationFailure(self):
+    """Verify a copy differing in a used block fails verification."""
+    cb_image_lib.ElideFreeBlocks(self.image, self.dest)
+    with open(self.dest, 'r+b') as dest:
+      dest.seek(_FIRST_LBA * SECTOR_SIZE)
+      dest.write('x')
+    self.assertFalse(cb_image_lib.VerifyElision(self.image, self.dest))
+
+  def testBitmapRuns(self):
+    """Verify clear bits are found across and within bytes."""
+    bitmap = '\x01\x00\x00\xff\xf0'
+    self.assertEqual([(1, 23), (32, 4)],
+                     cb_image_lib._BitmapRuns(bitmap, 40))
+    self.assertEqual([(1, 23), (32, 2)],
+                     cb_image_lib._BitmapRuns(bitmap, 34))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
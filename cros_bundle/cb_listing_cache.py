@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains a cache of index page listings keyed on URL."""
+
+import logging
+import threading
+import time
+
+from cb_util import LoadJson, SaveJson
+
+# Seconds a listing saved by an earlier run is used without asking the server
+# whether it changed.
+LISTING_TTL = 300
+# Index pages of a bundle number a few dozen; keep the cache file small.
+MAX_ENTRIES = 128
+
+
+class ListingCache(object):
+
+  """A record of the links listed on index pages, in memory and on disk.
+
+  It contains the following fields:
+  - path: name of the JSON file holding the cache, None to keep it in memory
+  - ttl: seconds a listing loaded from the file is fresh, after which it is
+    revalidated
+  - max_entries: number of listings kept, least recently used dropped first
+  - entries: a dict mapping index URL to a dict with keys
+      'links': a list of strings, the links listed
+      'etag': ETag of the index page or None
+      'last_modified': Last-Modified of the index page or None
+      'fetched': time the listing was last fetched or revalidated
+      'used': time of last lookup
+
+  A listing fetched or revalidated by this instance is reused for as long
+  as it lives, that is for one run. Concurrent lookups of the same URL wait
+  for a single fetch. Failed fetches and listings without a single link
+  are not cached. A corrupt or unreadable cache file is treated as empty,
+  and writes go to a temporary file renamed over the cache.
+  """
+
+  def __init__(self, path=None, ttl=LISTING_TTL, max_entries=MAX_ENTRIES):
+    self.path = path
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._in_flight = {}
+    # URLs fetched or revalidated since the cache was loaded
+    self._current = set()
+    self.entries = self._Load()
+
+  def _Load(self):
+    """Returns the entries stored on disk, empty if none or unreadable."""
+    if not self.path:
+      return {}
+    return LoadJson(self.path, 'listing cache')
+
+  def _Save(self):
+    """Trim to max_entries and atomically rewrite the cache, if on disk."""
+    if len(self.entries) > self.max_entries:
+      by_use = sorted(self.entries,
+                      key=lambda k: self.entries[k].get('used', 0))
+      for old_key in by_use[:len(self.entries) - self.max_entries]:
+        del self.entries[old_key]
+    if not self.path:
+      return
+    SaveJson(self.path, self.entries, 'listing cache')
+
+  def _Fresh(self, url, entry):
+    """Returns True when an entry can be used without revalidation."""
+    return (url in self._current or
+            0 <= time.time() - entry.get('fetched', 0) < self.ttl)
+
+  def Get(self, url, fetch):
+    """Returns the links listed at an index URL.
+
+    A listing fetched during this run, or loaded from the cache file and
+    younger than ttl, is returned from the cache. An older one is revalidated
+    by passing its validators to fetch, and kept if unchanged.
+
+    Args:
+      url: the index URL, used as cache key
+      fetch: function taking the cached ETag and Last-Modified, each None if
+             unknown, and returning None when the listing is unchanged or a
+             tuple (links, etag, last_modified); it raises IOError on failure
+    Returns:
+      a list of strings, the links listed
+    Raises:
+      IOError when the listing is not cached and cannot be fetched
+    """
+    while True:
+      with self._lock:
+        entry = self.entries.get(url)
+        if entry and self._Fresh(url, entry):
+          entry['used'] = time.time()
+          logging.debug('Listing cache hit for %s.', url)
+          return list(entry['links'])
+        in_flight = self._in_flight.get(url)
+        if not in_flight:
+          self._in_flight[url] = threading.Event()
+          break
+      # another thread is fetching this listing, use its result
+      in_flight.wait()
+      with self._lock:
+        entry = self.entries.get(url)
+        if entry and self._Fresh(url, entry):
+          entry['used'] = time.time()
+          return list(entry['links'])
+    try:
+      if entry:
+        fetched = fetch(entry.get('etag'), entry.get('last_modified'))
+      else:
+        fetched = fetch(None, None)
+      with self._lock:
+        now = time.time()
+        if fetched is None and entry:
+          logging.debug('Listing of %s unchanged.', url)
+        else:
+          links, etag, last_modified = fetched
+          if not any(links):
+            # e.g. an empty gsutil listing, which may be transient
+            logging.debug('Not caching the empty listing of %s.', url)
+            if self.entries.pop(url, None):
+              self._Save()
+            return list(links)
+          entry = {'links': list(links), 'etag': etag,
+                   'last_modified': last_modified}
+        entry.update(fetched=now, used=now)
+        self.entries[url] = entry
+        self._current.add(url)
+        self._Save()
+        return list(entry['links'])
+    finally:
+      with self._lock:
+        self._in_flight.pop(url).set()
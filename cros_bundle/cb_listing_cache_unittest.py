@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_listing_cache module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import cb_listing_cache
+
+
+class _Fetcher(object):
+  """Stands in for a listing fetch, recording the validators it is given."""
+
+  def __init__(self, links, etag=None, unchanged=False, delay=0):
+    self.links = links
+    self.etag = etag
+    self.unchanged = unchanged
+    self.delay = delay
+    self.calls = []
+
+  def __call__(self, etag, last_modified):
+    self.calls.append((etag, last_modified))
+    time.sleep(self.delay)
+    if self.links is None:
+      raise IOError('index page not found')
+    if self.unchanged and etag == self.etag:
+      return None
+    return (self.links, self.etag, None)
+
+
+class TestListingCache(unittest.TestCase):
+  """Unit tests related to ListingCache."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache_name = os.path.join(self.test_dir, 'listing_cache.json')
+    self.url = 'http://server/dev-channel/board/1.0'
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testFreshListingShared(self):
+    """Verify a fresh listing is fetched once, also across instances."""
+    fetch = _Fetcher(['a.bin', 'b.zip'])
+    cache = cb_listing_cache.ListingCache(self.cache_name)
+    self.assertEqual(['a.bin', 'b.zip'], cache.Get(self.url, fetch))
+    self.assertEqual(['a.bin', 'b.zip'], cache.Get(self.url, fetch))
+    cache = cb_listing_cache.ListingCache(self.cache_name)
+    self.assertEqual(['a.bin', 'b.zip'], cache.Get(self.url, fetch))
+    self.assertEqual([(None, None)], fetch.calls)
+
+  def testMemoryOnly(self):
+    """Verify nothing is written without a path."""
+    cache = cb_listing_cache.ListingCache()
+    cache.Get(self.url, _Fetcher(['a.bin']))
+    self.assertEqual([], os.listdir(self.test_dir))
+
+  def testListingSharedWithinRun(self):
+    """Verify a listing is not revalidated again by the same instance."""
+    cache = cb_listing_cache.ListingCache(self.cache_name, ttl=0)
+    fetch = _Fetcher(['a.bin'], etag='"v1"', unchanged=True)
+    cache.Get(self.url, fetch)
+    cache.Get(self.url, fetch)
+    cache = cb_listing_cache.ListingCache(self.cache_name, ttl=0)
+    cache.Get(self.url, fetch)
+    cache.Get(self.url, fetch)
+    self.assertEqual([(None, None), ('"v1"', None)], fetch.calls)
+
+  def testStaleListingRevalidated(self):
+    """Verify an expired listing is kept when the server says unchanged."""
+    fetch = _Fetcher(['a.bin'], etag='"v1"', unchanged=True)
+    cb_listing_cache.ListingCache(self.cache_name).Get(self.url, fetch)
+    cache = cb_listing_cache.ListingCache(self.cache_name, ttl=0)
+    fetch.links = ['should not be used']
+    self.assertEqual(['a.bin'], cache.Get(self.url, fetch))
+    self.assertEqual([(None, None), ('"v1"', None)], fetch.calls)
+
+  def testStaleListingReplaced(self):
+    """Verify an expired listing is replaced when the page changed."""
+    cb_listing_cache.ListingCache(self.cache_name).Get(
+        self.url, _Fetcher(['a.bin'], etag='"v1"'))
+    cache = cb_listing_cache.ListingCache(self.cache_name, ttl=0)
+    self.assertEqual(['b.bin'],
+                     cache.Get(self.url, _Fetcher(['b.bin'], etag='"v2"')))
+    self.assertEqual('"v2"', cache.entries[self.url]['etag'])
+
+  def testFailureNotCached(self):
+    """Verify a failed fetch raises and is retried next time."""
+    cache = cb_listing_cache.ListingCache(self.cache_name)
+    self.assertRaises(IOError, cache.Get, self.url, _Fetcher(None))
+    self.assertEqual(['a.bin'], cache.Get(self.url, _Fetcher(['a.bin'])))
+
+  def testEmptyListingNotCached(self):
+    """Verify a listing without links is fetched again, and never saved."""
+    cache = cb_listing_cache.ListingCache(self.cache_name)
+    fetch = _Fetcher([''])
+    self.assertEqual([''], cache.Get(self.url, fetch))
+    self.assertFalse(os.path.exists(self.cache_name))
+    fetch.links = ['a.bin']
+    self.assertEqual(['a.bin'], cache.Get(self.url, fetch))
+    self.assertEqual(2, len(fetch.calls))
+
+  def testConcurrentLookupsFetchOnce(self):
+    """Verify concurrent lookups of one URL wait for a single fetch."""
+    cache = cb_listing_cache.ListingCache()
+    fetch = _Fetcher(['a.bin'], delay=0.2)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.Get(self.url, fetch)))
+               for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual([['a.bin']] * 4, results)
+    self.assertEqual(1, len(fetch.calls))
+
+  def testBoundedSize(self):
+    """Verify least recently used listings are dropped past max_entries."""
+    cache = cb_listing_cache.ListingCache(self.cache_name, max_entries=2)
+    for index in range(3):
+      cache.Get('%s/%d' % (self.url, index), _Fetcher([str(index)]))
+    cache = cb_listing_cache.ListingCache(self.cache_name, max_entries=2)
+    self.assertEqual(2, len(cache.entries))
+    self.assertFalse(self.url + '/0' in cache.entries)
+
+  def testCorruptCacheIgnored(self):
+    """Verify an unparseable cache file is treated as empty."""
+    with open(self.cache_name, 'w') as f:
+      f.write('{"truncated')
+    cache = cb_listing_cache.ListingCache(self.cache_name)
+    self.assertEqual(['a.bin'], cache.Get(self.url, _Fetcher(['a.bin'])))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains advisory file locks shared between bundle runs.
+
+Runs on one machine share WORKDIR, the vboot_reference checkout and the
+installed cgpt. Each is guarded by a flock(2) lock on a file of the lock
+directory, named after the path it protects. A run finding a lock held
+waits for it, then reuses what the holder produced when it can tell that
+result is good, so concurrent runs fetch each artifact once.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import threading
+import urllib
+
+# Directory of lock files, None to disable locking.
+_lock_dir = None
+# (lock file, thread ident) -> [depth, file descriptor] of locks held.
+_held = {}
+_held_lock = threading.Lock()
+# Every user of the machine creates lock files in the lock directory.
+_LOCK_DIR_MODE = 01777
+
+
+def SetLockDir(path):
+  """Sets, and creates if needed, the directory lock files are kept in.
+
+  Args:
+    path: a directory shared by every run to coordinate, None to disable
+  """
+  global _lock_dir
+  if path and not os.path.isdir(path):
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      # another run starting at once may have created it first
+      if e.errno != errno.EEXIST or not os.path.isdir(path):
+        raise
+    else:
+      try:
+        os.chmod(path, _LOCK_DIR_MODE)
+      except OSError:
+        logging.warning('Could not share lock directory %s.', path)
+  _lock_dir = path
+
+
+def LockPath(name):
+  """Returns the lock file guarding a path, None when locking is disabled.
+
+  Args:
+    name: path of the file or directory to guard
+  """
+  if not _lock_dir:
+    return None
+  return os.path.join(_lock_dir,
+                      urllib.quote(os.path.abspath(name), safe='') + '.lock')
+
+
+class FileLock(object):
+
+  """An advisory lock on a path, held across processes and threads.
+
+  It contains the following fields:
+  - name: path guarded by the lock
+  - shared: a boolean, True for a lock other shared holders may hold too
+  - waited: a boolean, True when the lock was held by someone else when
+      acquired, so what they did meanwhile may be reused
+
+  Used as a context manager. A thread already holding the lock re-enters
+  it without waiting. Threads of one process exclude each other as other
+  processes do. Without a lock directory, see SetLockDir, it does nothing.
+  """
+
+  def __init__(self, name, shared=False):
+    self.name = name
+    self.shared = shared
+    self.waited = False
+    self._key = None
+
+  def Acquire(self):
+    """Take the lock, waiting for other holders if needed.
+
+    Returns:
+      self
+    Raises:
+      IOError or OSError when the lock file cannot be opened or locked
+    """
+    path = LockPath(self.name)
+    if not path:
+      return self
+    key = (path, threading.current_thread().ident)
+    with _held_lock:
+      if key in _held:
+        _held[key][0] += 1
+        self._key = key
+        return self
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0666)
+    mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+    try:
+      try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        logging.info('Waiting for %s, in use by another run.', self.name)
+        fcntl.flock(fd, mode)
+        self.waited = True
+    except (IOError, OSError):
+      os.close(fd)
+      raise
+    with _held_lock:
+      _held[key] = [1, fd]
+    self._key = key
+    return self
+
+  def Release(self):
+    """Release the lock, once as many times as it was acquired."""
+    if not self._key:
+      return
+    with _held_lock:
+      held = _held[self._key]
+      held[0] -= 1
+      if held[0]:
+        self._key = None
+        return
+      del _held[self._key]
+    self._key = None
+    fcntl.flock(held[1], fcntl.LOCK_UN)
+    os.close(held[1])
+
+  def __enter__(self):
+    return self.Acquire()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Release()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_lock_lib module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import cb_lock_lib
+import cb_url_lib
+from cb_lock_lib import FileLock
+from cb_test_http_server import StandInServer
+
+
+class _LockTestCase(unittest.TestCase):
+  """Sets a lock directory in a temporary directory."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.lock_dir = os.path.join(self.test_dir, 'locks')
+    cb_lock_lib.SetLockDir(self.lock_dir)
+    self.name = os.path.join(self.test_dir, 'image.bin')
+
+  def tearDown(self):
+    cb_lock_lib.SetLockDir(None)
+    shutil.rmtree(self.test_dir)
+
+  def _HoldInThread(self, lock, seconds):
+    """Hold a lock from another thread, returns once it is held."""
+    held = threading.Event()
+
+    def Hold():
+      with lock:
+        held.set()
+        time.sleep(seconds)
+    thread = threading.Thread(target=Hold)
+    thread.start()
+    held.wait()
+    return thread
+
+
+class TestFileLock(_LockTestCase):
+  """Unit tests related to FileLock."""
+
+  def testDisabled(self):
+    """Verify nothing is locked without a lock directory."""
+    cb_lock_lib.SetLockDir(None)
+    self.assertEqual(None, cb_lock_lib.LockPath(self.name))
+    with FileLock(self.name) as lock:
+      self.assertFalse(lock.waited)
+
+  def testLockDirExists(self):
+    """Verify a lock directory created by a concurrent run is reused."""
+    makedirs = os.makedirs
+    def _RaceMakedirs(path):
+      makedirs(path)
+      makedirs(path)
+    other_dir = os.path.join(self.test_dir, 'other_locks')
+    os.makedirs = _RaceMakedirs
+    try:
+      cb_lock_lib.SetLockDir(other_dir)
+    finally:
+      os.makedirs = makedirs
+    self.assertEqual(os.path.join(other_dir, '%2Fimage.bin.lock'),
+                     cb_lock_lib.LockPath('/image.bin'))
+    cb_lock_lib.SetLockDir(other_dir)
+    self.assertTrue(os.path.isdir(other_dir))
+
+  def testLockPath(self):
+    """Verify one lock file per guarded path, in the lock directory."""
+    path = cb_lock_lib.LockPath(self.name)
+    self.assertEqual(self.lock_dir, os.path.dirname(path))
+    self.assertNotEqual(path, cb_lock_lib.LockPath(self.name + '.md5'))
+    self.assertEqual(path, cb_lock_lib.LockPath(
+        os.path.join(self.test_dir, '.', 'image.bin')))
+
+  def testReentrant(self):
+    """Verify a thread holding a lock takes it again without waiting."""
+    with FileLock(self.name):
+      with FileLock(self.name) as inner:
+        self.assertFalse(inner.waited)
+      # still held by the outer lock
+      other = FileLock(self.name)
+      thread = threading.Thread(target=other.Acquire)
+      thread.start()
+      thread.join(0.2)
+      self.assertTrue(thread.isAlive())
+    thread.join()
+    self.assertTrue(other.waited)
+    other.Release()
+
+  def testThreadsExcluded(self):
+    """Verify a second thread waits for the lock, then knows it waited."""
+    thread = self._HoldInThread(FileLock(self.name), 0.2)
+    with FileLock(self.name) as lock:
+      self.assertTrue(lock.waited)
+    thread.join()
+
+  def testProcessesExcluded(self):
+    """Verify a process waits for a lock held by another process."""
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if not pid:
+      try:
+        os.close(read_fd)
+        with FileLock(self.name):
+          os.write(write_fd, 'x')
+          time.sleep(0.2)
+      finally:
+        os._exit(0)
+    os.close(write_fd)
+    os.read(read_fd, 1)
+    os.close(read_fd)
+    with FileLock(self.name) as lock:
+      self.assertTrue(lock.waited)
+    os.waitpid(pid, 0)
+
+  def testSharedLocks(self):
+    """Verify shared holders do not wait for each other, exclusive ones do."""
+    thread = self._HoldInThread(FileLock(self.name, shared=True), 0.2)
+    with FileLock(self.name, shared=True) as lock:
+      self.assertFalse(lock.waited)
+    with FileLock(self.name) as lock:
+      self.assertTrue(lock.waited)
+    thread.join()
+
+
+class TestDownloadSingleFlight(_LockTestCase):
+  """Unit tests related to DownloadWithDigests waiting for another run."""
+
+  def setUp(self):
+    _LockTestCase.setUp(self)
+    self.saved_workdir = cb_url_lib.WORKDIR
+    cb_url_lib.WORKDIR = self.test_dir
+    self.content = os.urandom(500)
+    self.server = StandInServer({'/image.bin': self.content}).Start()
+    self.url = self.server.url + '/image.bin'
+
+  def tearDown(self):
+    self.server.Stop()
+    cb_url_lib.WORKDIR = self.saved_workdir
+    _LockTestCase.tearDown(self)
+
+  def testDownloadedOnce(self):
+    """Verify a run waiting on a download reuses it rather than fetching."""
+    results = []
+
+    def Fetch():
+      results.append(cb_url_lib.DownloadWithDigests(self.url))
+    lock = FileLock(self.name)
+    lock.Acquire()
+    threads = [threading.Thread(target=Fetch) for _ in range(2)]
+    for thread in threads:
+      thread.start()
+    # both wait, then one downloads and the other reuses its download
+    time.sleep(0.2)
+    lock.Release()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, len(self.server.requests))
+    self.assertEqual(results[0], results[1])
+    with open(self.name, 'rb') as image:
+      self.assertEqual(self.content, image.read())
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
@@ -8,6 +8,8 @@
 import datetime
 import logging
 import os
+import Queue
+import threading
 
 from cb_constants import BundlingError, IMAGE_SERVER_PREFIX, IMAGE_GSD_PREFIX
 from cb_url_lib import DetermineUrl, NameResolutionError
@@ -15,6 +17,47 @@ from cb_url_lib import DetermineUrl, NameResolutionError
 NUM_NAMING_SCHEMES = 4
 DATE_FORMAT = '%Y_%m_%d'
 
+# Whether RunWithNamingRetries probes all naming schemes at once
+_parallel_probes = False
+# NamingCache of schemes that last resolved, None to always rediscover them
+_naming_cache = None
+
+
+def SetParallelProbes(enabled):
+  """Sets whether naming schemes are probed concurrently.
+
+  Args:
+    enabled: a boolean, True to probe all naming schemes at once when the
+             caller of RunWithNamingRetries provides a probe
+  """
+  global _parallel_probes
+  _parallel_probes = enabled
+
+
+def SetNamingCache(cache):
+  """Sets the cache RunWithNamingRetries remembers resolved schemes in.
+
+  Args:
+    cache: a cb_naming_cache.NamingCache object, None to disable
+  """
+  global _naming_cache
+  _naming_cache = cache
+
+
+def NamingKey(board, version_string):
+  """Returns the key naming schemes are remembered under.
+
+  Images of the same board and channel are hosted with the same layout.
+
+  Args:
+    board: target board
+    version_string: string with image version information, e.g.
+                    version/channel or version/channel/key
+  Returns:
+    a string, 'board/channel'
+  """
+  return '/'.join([board, version_string.split('/')[1]])
+
 
 def GetBundleDefaultName(version=None):
   """Generates factory bundle default name.
@@ -31,6 +74,28 @@ def GetBundleDefaultName(version=None):
   return '_'.join(items)
 
 
+def GetBoardUrl(board, channel, alt_naming):
+  """Determine the URL of the directory holding all releases of a board.
+
+  Args:
+    board: target board
+    channel: image channel as given in version strings, e.g. dev
+    alt_naming: see docstring for GetNameComponents
+  Returns:
+    a string, URL of the board directory, each release in a subdirectory
+    named after its version
+  """
+  cha = channel + '-channel'
+  if alt_naming == 1:
+    return os.path.join(IMAGE_SERVER_PREFIX, cha, board + '-rc')
+  elif alt_naming == 2:
+    return os.path.join(
+        IMAGE_SERVER_PREFIX.replace('chromeos-official', ''), cha, board)
+  elif alt_naming == 3:
+    return os.path.join(IMAGE_GSD_PREFIX, cha, board)
+  return os.path.join(IMAGE_SERVER_PREFIX, cha, board)
+
+
 def GetNameComponents(board, version_string, alt_naming):
   """Determine URL and version components of script input.
 
@@ -52,17 +117,8 @@ def GetNameComponents(board, version_string, alt_naming):
     key, a string, part of the image signing key label
   """
   num, cha, key = version_string.split('/')
-  cha = cha + '-channel'
-  if alt_naming == 1:
-    url = os.path.join(IMAGE_SERVER_PREFIX, cha, board + '-rc', num)
-  elif alt_naming == 2:
-    url = os.path.join(
-        IMAGE_SERVER_PREFIX.replace('chromeos-official', ''), cha, board, num)
-  elif alt_naming == 3:
-    url = os.path.join(IMAGE_GSD_PREFIX, cha, board, num)
-  else:
-    url = os.path.join(IMAGE_SERVER_PREFIX, cha, board, num)
-  return (url, num, cha, key)
+  url = os.path.join(GetBoardUrl(board, cha, alt_naming), num)
+  return (url, num, cha + '-channel', key)
 
 
 def GetReleaseName(board, release, alt_naming=0):
@@ -95,16 +151,7 @@ def GetFactoryName(board, factory, alt_naming=0):
     token_list: a list of strings, in the order they are expected in the url.
   """
   fac_no, fac_ch = factory.split('/')
-  fac_ch = fac_ch + '-channel'
-  if alt_naming == 1:
-    fac_url = os.path.join(IMAGE_SERVER_PREFIX, fac_ch, board + '-rc', fac_no)
-  elif alt_naming == 2:
-    fac_url = os.path.join(IMAGE_SERVER_PREFIX.replace('chromeos-official', ''),
-                           fac_ch, board, fac_no)
-  elif alt_naming == 3:
-    fac_url = os.path.join(IMAGE_GSD_PREFIX, fac_ch, board, fac_no)
-  else:
-    fac_url = os.path.join(IMAGE_SERVER_PREFIX, fac_ch, board, fac_no)
+  fac_url = os.path.join(GetBoardUrl(board, fac_ch, alt_naming), fac_no)
   token_list = ['chromeos-factory', fac_no, board, '.zip']
   return (fac_url, token_list)
 
@@ -166,27 +213,148 @@ def ResolveRecoveryUrl(board, recovery, alt_naming=0):
   return (rec_url, index_page)
 
 
-def RunWithNamingRetries(default, funcname, *args):
+def _ProbeWorker(probe, args, alt_naming, results, cancelled):
+  """Run a probe on one naming scheme and queue its outcome.
+
+  Args:
+    probe: function accepting args and alt_naming, see RunWithNamingRetries
+    args: a tuple, arguments to pass to probe
+    alt_naming: an integer, the naming scheme to probe
+    results: a Queue, (alt_naming, succeeded, result) is put on it
+    cancelled: a threading.Event, set once the outcome is no longer needed
+  """
+  try:
+    result = probe(*args, alt_naming=alt_naming)
+    succeeded = bool(result)
+  except NameResolutionError:
+    result, succeeded = None, False
+  except Exception as e:
+    logging.warning('Probing naming scheme %d failed: %s', alt_naming, e)
+    result, succeeded = None, False
+  if not cancelled.is_set():
+    results.put((alt_naming, succeeded, result))
+
+
+def ProbeNamingSchemes(probe, *args):
+  """Probe all naming schemes at once, returning the lowest that resolves.
+
+  A scheme only wins once every lower-numbered scheme has failed, so the
+  outcome is the one trying schemes in order would give, but the cost is
+  that of the slowest probe needed rather than the sum of all of them.
+  Probes still outstanding once the winner is known are cancelled: their
+  results are discarded and their daemon threads left to finish alone.
+
+  Args:
+    probe: function accepting args and alt_naming, returning a true value
+           when the scheme resolves, or raising NameResolutionError
+    *args: arbitrarily many arguments to provide to the probe
+  Returns:
+    a tuple (alt_naming, result) for the winning scheme, (None, None) if no
+    scheme resolves
+  """
+  results = Queue.Queue()
+  cancelled = threading.Event()
+  for alt_naming in range(NUM_NAMING_SCHEMES):
+    worker = threading.Thread(target=_ProbeWorker,
+                              args=(probe, args, alt_naming, results,
+                                    cancelled))
+    worker.daemon = True
+    worker.start()
+  outcomes = {}
+  try:
+    for alt_naming in range(NUM_NAMING_SCHEMES):
+      while alt_naming not in outcomes:
+        finished, succeeded, result = results.get()
+        outcomes[finished] = (succeeded, result)
+      succeeded, result = outcomes[alt_naming]
+      if succeeded:
+        logging.info('Naming scheme %d resolves for %s', alt_naming,
+                     probe.__name__)
+        return (alt_naming, result)
+    return (None, None)
+  finally:
+    cancelled.set()
+
+
+def _TryNamingScheme(funcname, args, alt_naming):
+  """Runs a function on one naming scheme.
+
+  Args:
+    funcname: name of function to run
+    args: a tuple, arguments to provide to the function
+    alt_naming: an integer, the naming scheme to try
+  Returns:
+    a tuple (succeeded, result of the function call)
+  """
+  try:
+    logging.info('Trying function %s with naming scheme %d' %
+                 (funcname.__name__, alt_naming))
+    return (True, funcname(*args, alt_naming=alt_naming))
+  except NameResolutionError:
+    logging.info('Tried naming scheme %d; trying alternative naming scheme' %
+                 alt_naming)
+    return (False, None)
+
+
+def RunWithNamingRetries(default, funcname, *args, **kwargs):
   """Executes a function with arguments on various URL naming schemes.
 
   Assumes function provided accepts alt_naming as final parameter.
   Assumes function provided raises NameResolutionError to trigger retry.
 
+  Given a key and a naming cache, the scheme that last resolved for that
+  key is tried first, and forgotten if it fails. The scheme that resolves
+  is remembered for the next run.
+
+  When parallel probing is enabled and a probe is given, all naming schemes
+  are probed at once and the function is first run on the lowest-numbered
+  one that resolves, skipping the lower schemes whose probes failed, then
+  on the following schemes in order as before. Given the function itself
+  as its probe, its result on the winning scheme is returned directly.
+
   Args:
     default: return value on failure
     funcname: name of function to run
     *args: arbitrarily many arguments to provide to the function
+    probe: optional keyword argument, a cheap function accepting the same
+           arguments that fails for a scheme whenever funcname would, see
+           ProbeNamingSchemes
+    key: optional keyword argument, a string such as NamingKey returns,
+         under which the resolving scheme is remembered
   Returns:
     result of the first successful function call or default return on failure
   """
+  probe = kwargs.pop('probe', None)
+  key = kwargs.pop('key', None)
+  if kwargs:
+    raise TypeError('Unexpected keyword arguments %r' % kwargs.keys())
+  cache = _naming_cache if key else None
+  remembered = cache.Lookup(key) if cache else None
+  if remembered is not None:
+    (succeeded, result) = _TryNamingScheme(funcname, args, remembered)
+    if succeeded:
+      return result
+    logging.info('Naming scheme %d no longer resolves for %s', remembered, key)
+    cache.Forget(key)
   alt_naming = 0
+  if _parallel_probes and probe:
+    (alt_naming, result) = ProbeNamingSchemes(probe, *args)
+    if alt_naming is None:
+      logging.info('No naming scheme resolves for %s' % funcname.__name__)
+      return default
+    if probe is funcname:
+      if cache:
+        cache.Record(key, alt_naming)
+      return result
+    if alt_naming == remembered:
+      # it failed above but its probe resolves now, so try it again
+      remembered = None
   while(alt_naming < NUM_NAMING_SCHEMES):
-    try:
-      logging.info('Trying function %s with naming scheme %d' %
-                   (funcname.__name__, alt_naming))
-      return funcname(*args, alt_naming=alt_naming)
-    except NameResolutionError:
-      logging.info('Tried naming scheme %d; trying alternative naming scheme' %
-                   alt_naming)
-      alt_naming = alt_naming + 1
+    if alt_naming != remembered:
+      (succeeded, result) = _TryNamingScheme(funcname, args, alt_naming)
+      if succeeded:
+        if cache:
+          cache.Record(key, alt_naming)
+        return result
+    alt_naming = alt_naming + 1
   return default
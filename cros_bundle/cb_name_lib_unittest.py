@@ -6,11 +6,31 @@
 """Unit tests for the cb_name_lib module."""
 
 import mox
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from cb_constants import IMAGE_GSD_PREFIX, IMAGE_SERVER_PREFIX
 import cb_name_lib
+from cb_naming_cache import NamingCache
+
+
+class TestGetBoardUrl(unittest.TestCase):
+  """Tests related to GetBoardUrl."""
+
+  def testNamingSchemes(self):
+    """Verify each release URL is a version under its board URL."""
+    for alt_naming in range(cb_name_lib.NUM_NAMING_SCHEMES):
+      (url, num, _, _) = cb_name_lib.GetNameComponents(
+          'x86-alex', '0.12.433.269/stable/mp', alt_naming)
+      self.assertEqual(os.path.join(cb_name_lib.GetBoardUrl(
+          'x86-alex', 'stable', alt_naming), num), url)
+    self.assertEqual(IMAGE_GSD_PREFIX + '/stable-channel/x86-alex',
+                     cb_name_lib.GetBoardUrl('x86-alex', 'stable', 3))
 
 
 class TestGetNameComponents(unittest.TestCase):
@@ -185,5 +205,149 @@ class TestResolveRecoveryUrl(mox.MoxTestBase):
     self.assertEqual(expected, actual)
 
 
+class TestRunWithNamingRetries(unittest.TestCase):
+  """Unit tests related to RunWithNamingRetries and ProbeNamingSchemes."""
+
+  def setUp(self):
+    cb_name_lib.SetParallelProbes(True)
+    self.lock = threading.Lock()
+    self.probed = []
+    self.run = []
+
+  def tearDown(self):
+    cb_name_lib.SetParallelProbes(False)
+
+  def _MakeProbe(self, resolving, delays=None):
+    """Returns a probe resolving the given schemes after given delays."""
+    def _Probe(name, alt_naming=0):
+      time.sleep((delays or {}).get(alt_naming, 0))
+      with self.lock:
+        self.probed.append(alt_naming)
+      if alt_naming not in resolving:
+        raise cb_name_lib.NameResolutionError('%s %d' % (name, alt_naming))
+      return '%s %d' % (name, alt_naming)
+    return _Probe
+
+  def _Func(self, name, alt_naming=0):
+    self.run.append(alt_naming)
+    if alt_naming == 1:
+      raise cb_name_lib.NameResolutionError('scheme 1 fails')
+    return '%s %d' % (name, alt_naming)
+
+  def testSerialWithoutProbe(self):
+    """Verify schemes are tried in order when no probe is given."""
+    self.assertEqual('x 2', cb_name_lib.RunWithNamingRetries(
+        None, self._MakeProbe([2, 3]), 'x'))
+    self.assertEqual([0, 1, 2], self.probed)
+
+  def testLowestResolvingSchemeWins(self):
+    """Verify a faster higher-numbered scheme does not win."""
+    probe = self._MakeProbe([1, 3], delays={1: 0.2})
+    self.assertEqual((1, 'x 1'), cb_name_lib.ProbeNamingSchemes(probe, 'x'))
+    self.assertEqual(3, self.probed.index(1))
+
+  def testWinnerReturnedBeforeSlowProbesFinish(self):
+    """Verify outstanding higher-numbered probes are not waited for."""
+    probe = self._MakeProbe([0, 3], delays={3: 2})
+    start = time.time()
+    self.assertEqual((0, 'x 0'), cb_name_lib.ProbeNamingSchemes(probe, 'x'))
+    self.assertTrue(time.time() - start < 1)
+    self.assertFalse(3 in self.probed)
+
+  def testNoSchemeResolves(self):
+    """Verify the default is returned without running the function."""
+    self.assertEqual('default', cb_name_lib.RunWithNamingRetries(
+        'default', self._Func, 'x', probe=self._MakeProbe([])))
+    self.assertEqual([], self.run)
+
+  def testFunctionRunFromWinner(self):
+    """Verify the function starts at the winner and retries in order."""
+    self.assertEqual('x 2', cb_name_lib.RunWithNamingRetries(
+        None, self._Func, 'x', probe=self._MakeProbe([1, 3])))
+    self.assertEqual([1, 2], self.run)
+
+  def testFunctionAsOwnProbe(self):
+    """Verify the winning probe result is reused rather than run again."""
+    probe = self._MakeProbe([2])
+    self.assertEqual('x 2', cb_name_lib.RunWithNamingRetries(
+        None, probe, 'x', probe=probe))
+    self.assertEqual(1, self.probed.count(2))
+
+
+class TestRunWithNamingCache(unittest.TestCase):
+  """Unit tests related to RunWithNamingRetries remembering schemes."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache = NamingCache(os.path.join(self.test_dir, 'naming.json'))
+    cb_name_lib.SetNamingCache(self.cache)
+    self.key = cb_name_lib.NamingKey('board', '1.0/dev/mp')
+    self.resolving = [2, 3]
+    self.run = []
+
+  def tearDown(self):
+    cb_name_lib.SetNamingCache(None)
+    shutil.rmtree(self.test_dir)
+
+  def _Func(self, alt_naming=0):
+    self.run.append(alt_naming)
+    if alt_naming not in self.resolving:
+      raise cb_name_lib.NameResolutionError('scheme %d' % alt_naming)
+    return alt_naming
+
+  def _Run(self):
+    return cb_name_lib.RunWithNamingRetries(None, self._Func, key=self.key)
+
+  def testNamingKey(self):
+    """Verify schemes are remembered per board and channel."""
+    self.assertEqual('board/dev', self.key)
+
+  def testResolvedSchemeTriedFirst(self):
+    """Verify the scheme that resolved last run is tried first."""
+    self.assertEqual(2, self._Run())
+    self.assertEqual(2, self.cache.Lookup(self.key))
+    self.run = []
+    self.assertEqual(2, self._Run())
+    self.assertEqual([2], self.run)
+
+  def testFailedSchemeExpired(self):
+    """Verify a remembered scheme that fails is forgotten and replaced."""
+    self._Run()
+    self.resolving = [3]
+    self.run = []
+    self.assertEqual(3, self._Run())
+    self.assertEqual([2, 0, 1, 3], self.run)
+    self.assertEqual(3, self.cache.Lookup(self.key))
+
+  def testRememberedSchemeProbedAgain(self):
+    """Verify a remembered scheme failing once is not skipped by probes."""
+    self._Run()
+    flaky = [2]
+
+    def FlakyFunc(alt_naming=0):
+      if alt_naming in flaky:
+        flaky.remove(alt_naming)
+        raise cb_name_lib.NameResolutionError('scheme %d' % alt_naming)
+      return self._Func(alt_naming)
+    cb_name_lib.SetParallelProbes(True)
+    try:
+      self.assertEqual(2, cb_name_lib.RunWithNamingRetries(
+          None, FlakyFunc, key=self.key, probe=FlakyFunc))
+    finally:
+      cb_name_lib.SetParallelProbes(False)
+    self.assertEqual(2, self.cache.Lookup(self.key))
+
+  def testNothingResolves(self):
+    """Verify the default is returned and no scheme is remembered."""
+    self.resolving = []
+    self.assertEqual(None, self._Run())
+    self.assertEqual(None, self.cache.Lookup(self.key))
+
+  def testNoKey(self):
+    """Verify nothing is remembered without a key."""
+    cb_name_lib.RunWithNamingRetries(None, self._Func)
+    self.assertEqual({}, self.cache.entries)
+
+
 if __name__ == '__main__':
   unittest.main()
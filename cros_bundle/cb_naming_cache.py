@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module remembers which URL naming scheme each board/channel uses."""
+
+import threading
+import time
+
+from cb_util import LoadJson, SaveJson
+
+# One entry per board and channel seen, a handful in practice.
+MAX_ENTRIES = 64
+
+
+class NamingCache(object):
+
+  """An on-disk record of the naming scheme that last resolved for a key.
+
+  It contains the following fields:
+  - path: name of the JSON file holding the cache
+  - max_entries: number of entries kept, least recently used dropped first
+  - entries: a dict mapping key, e.g. 'board/channel', to a dict with keys
+      'alt_naming': the naming scheme that last resolved, an integer
+      'used': time of last lookup or record
+
+  An entry is forgotten as soon as its scheme fails to resolve. A corrupt
+  or unreadable cache file is treated as empty, and writes go to a
+  temporary file renamed over the cache.
+  """
+
+  def __init__(self, path, max_entries=MAX_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self.entries = self._Load()
+
+  def _Load(self):
+    """Returns the entries stored on disk, empty if none or unreadable."""
+    return LoadJson(self.path, 'naming cache')
+
+  def _Save(self):
+    """Atomically rewrite the cache, keeping the most recently used entries."""
+    if len(self.entries) > self.max_entries:
+      by_use = sorted(self.entries,
+                      key=lambda k: self.entries[k].get('used', 0))
+      for old_key in by_use[:len(self.entries) - self.max_entries]:
+        del self.entries[old_key]
+    SaveJson(self.path, self.entries, 'naming cache')
+
+  def Lookup(self, key):
+    """Returns the naming scheme that last resolved for key, None if unknown.
+
+    Args:
+      key: a string identifying what was resolved, e.g. 'board/channel'
+    """
+    with self._lock:
+      entry = self.entries.get(key)
+      if not entry or not isinstance(entry.get('alt_naming'), int):
+        return None
+      entry['used'] = time.time()
+      return entry['alt_naming']
+
+  def Record(self, key, alt_naming):
+    """Remember the naming scheme that resolved for key.
+
+    Args:
+      key: a string identifying what was resolved, e.g. 'board/channel'
+      alt_naming: an integer, the naming scheme that resolved
+    """
+    with self._lock:
+      entry = self.entries.get(key)
+      if entry and entry.get('alt_naming') == alt_naming:
+        entry['used'] = time.time()
+        return
+      self.entries[key] = {'alt_naming': alt_naming, 'used': time.time()}
+      self._Save()
+
+  def Forget(self, key):
+    """Expire the entry for key, e.g. when its naming scheme failed.
+
+    Args:
+      key: a string identifying what was resolved, e.g. 'board/channel'
+    """
+    with self._lock:
+      if self.entries.pop(key, None) is not None:
+        self._Save()
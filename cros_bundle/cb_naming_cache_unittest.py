@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_naming_cache module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import cb_naming_cache
+
+
+class TestNamingCache(unittest.TestCase):
+  """Unit tests related to NamingCache."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache_name = os.path.join(self.test_dir, 'naming_cache.json')
+    self.key = 'stumpy/dev-channel'
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testHitAcrossInstances(self):
+    """Verify a scheme recorded by one run is found by the next."""
+    cb_naming_cache.NamingCache(self.cache_name).Record(self.key, 3)
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    self.assertEqual(3, cache.Lookup(self.key))
+    self.assertEqual(None, cache.Lookup('stumpy/beta-channel'))
+
+  def testForgetExpiresEntry(self):
+    """Verify a forgotten scheme is no longer found, also by the next run."""
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    cache.Record(self.key, 1)
+    cache.Forget(self.key)
+    self.assertEqual(None, cache.Lookup(self.key))
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    self.assertEqual(None, cache.Lookup(self.key))
+
+  def testSchemeZeroRemembered(self):
+    """Verify the default scheme is remembered like any other."""
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    cache.Record(self.key, 0)
+    self.assertEqual(0, cb_naming_cache.NamingCache(
+        self.cache_name).Lookup(self.key))
+
+  def testBoundedSize(self):
+    """Verify least recently used entries are dropped past max_entries."""
+    cache = cb_naming_cache.NamingCache(self.cache_name, max_entries=2)
+    for index in range(3):
+      cache.Record('board%d/dev-channel' % index, index)
+    cache = cb_naming_cache.NamingCache(self.cache_name, max_entries=2)
+    self.assertEqual(2, len(cache.entries))
+    self.assertEqual(None, cache.Lookup('board0/dev-channel'))
+
+  def testCorruptCacheIgnored(self):
+    """Verify an unparseable cache file is treated as empty."""
+    with open(self.cache_name, 'w') as f:
+      f.write('[1, 2')
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    self.assertEqual(None, cache.Lookup(self.key))
+    cache.Record(self.key, 2)
+    self.assertEqual(2, cache.Lookup(self.key))
+
+  def testFailedSaveLeavesNoTemporaryFile(self):
+    """Verify a cache that cannot be written leaves nothing behind."""
+    cache = cb_naming_cache.NamingCache(self.cache_name)
+    cache.entries['unserializable'] = {'alt_naming': object(), 'used': 0}
+    cache.Record(self.key, 1)
+    self.assertEqual([], os.listdir(self.test_dir))
+    self.assertEqual(1, cache.Lookup(self.key))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
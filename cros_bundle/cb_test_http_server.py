@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A local HTTP server standing in for the image server in unit tests."""
+
+import BaseHTTPServer
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the files of its server, honouring single and suffix ranges."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.lock:
+      self.server.connections.add(self.connection)
+      self.server.connection_count += 1
+
+  def finish(self):
+    with self.server.lock:
+      self.server.connections.discard(self.connection)
+    BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+  def _Send(self, head_only):
+    server = self.server
+    path = self.path.split('?')[0]
+    server.requests.append((self.command, path, self.headers.get('Range')))
+    if server.latency:
+      time.sleep(server.latency)
+    content = server.files.get(path)
+    if content is None:
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    if server.etag and self.headers.get('If-None-Match') == server.etag:
+      self.send_response(304)
+      self.send_header('ETag', server.etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    start, end = 0, len(content) - 1
+    match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+    if_range = self.headers.get('If-Range')
+    if match and server.ranges and (not if_range or if_range == server.etag):
+      if not match.group(1):
+        # suffix range, the last bytes of the file
+        start = max(0, len(content) - int(match.group(2)))
+      else:
+        start = int(match.group(1))
+        if match.group(2):
+          end = min(int(match.group(2)), end)
+      if start > end:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % len(content))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range',
+                       'bytes %d-%d/%d' % (start, end, len(content)))
+    else:
+      self.send_response(200)
+    if server.ranges:
+      self.send_header('Accept-Ranges', 'bytes')
+    if server.etag:
+      self.send_header('ETag', server.etag)
+    self.send_header('Content-Length', str(end - start + 1))
+    self.end_headers()
+    if not head_only:
+      body = content[start:end + 1]
+      if server.stall and start < server.stall[0] <= end:
+        split = server.stall[0] - start
+        self.wfile.write(body[:split])
+        self.wfile.flush()
+        time.sleep(server.stall[1])
+        body = body[split:]
+      self.wfile.write(body)
+
+  def do_GET(self):
+    self._Send(False)
+
+  def do_HEAD(self):
+    self._Send(True)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  """A threaded HTTP server on localhost serving in-memory files.
+
+  It contains the following fields:
+  - files: a dict mapping URL path to file content
+  - ranges: a boolean, False to ignore Range headers and answer with 200
+  - latency: seconds to sleep before answering each request
+  - etag: ETag of every file, a Range with another If-Range gets a 200 and
+    a matching If-None-Match a 304
+  - stall: None, or a tuple (offset, seconds), a body holding byte offset
+    pauses for seconds before sending it
+  - requests: a list of (method, path, Range header) tuples received
+  - connection_count: number of connections accepted
+  - url: the base URL of the server, without trailing slash
+  """
+
+  daemon_threads = True
+
+  def __init__(self, files, ranges=True, latency=0, etag=None):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                       _StandInHandler)
+    self.files = files
+    self.ranges = ranges
+    self.latency = latency
+    self.etag = etag
+    self.stall = None
+    self.requests = []
+    self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+    # connections being served, clients may keep them alive
+    self.connections = set()
+    self.connection_count = 0
+    self.lock = threading.Lock()
+    self._thread = threading.Thread(target=self.serve_forever)
+    self._thread.daemon = True
+
+  def handle_error(self, request, client_address):
+    # clients may hang up before reading a whole response, as range
+    # readers do once they have what they need
+    if not isinstance(sys.exc_info()[1], socket.error):
+      BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+  def Start(self):
+    """Start serving in a background thread."""
+    self._thread.start()
+    return self
+
+  def DropConnections(self):
+    """Close connections kept alive, as a server timing them out does."""
+    with self.lock:
+      for connection in self.connections:
+        try:
+          connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+
+  def Stop(self):
+    """Stop serving, closing the listening socket and kept alive ones."""
+    self.shutdown()
+    self.DropConnections()
+    self.server_close()
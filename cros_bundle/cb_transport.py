@@ -0,0 +1,951 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module contains the transports online resources are opened over.
+
+A URL is opened by the transport registered for its scheme: HTTP(S) over
+pooled keep-alive connections, file:// for a local mirror such as an NFS
+mount, and gs:// through 'gsutil cat'. Mirror rules first rewrite URL
+prefixes, so that the image server or GSD can be replaced by an on-site
+cache without the rest of cros_bundle knowing; URLs elsewhere, e.g. cache
+keys, stay those of the original servers.
+
+With racing enabled, see SetRacing, a URL and its mirrors are all sources
+of it instead: they are probed together and ranked by throughput, and a
+request not answered in time by the fastest source is sent to the next
+one too, the first answer winning. A body that stalls once answered has
+its remaining bytes fetched from the next source holding the same version
+of it, see _FailoverResponse.
+
+Every transport answers with a file object like those of urllib2: read,
+close, info().getheader and getcode.
+"""
+
+import contextlib
+import email.utils
+import httplib
+import logging
+import os
+import Queue
+import re
+import socket
+import StringIO
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+from cb_constants import IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX
+from cb_util import StartCommand
+
+# Seconds without progress on a connection before it is given up.
+TIMEOUT = 60
+# Idle keep-alive connections kept per server.
+MAX_IDLE_CONNECTIONS = 8
+# Redirects followed for one request.
+MAX_REDIRECTS = 5
+# Unread response bytes drained, rather than closing the connection, when
+# a response is closed early.
+DRAIN_LIMIT = 64 * 1024
+USER_AGENT = 'cros_bundle'
+# Seconds a raced request waits for an answer before the next source of its
+# URL is asked too.
+HEDGE_DELAY = 2.0
+# Bytes read from each source of a URL to measure its throughput.
+PROBE_SIZE = 256 * 1024
+# Seconds sources are ranked without the probes that have not finished.
+PROBE_TIMEOUT = 10
+# Bytes read at a time from a raced response body; a read not done within
+# the hedge delay is a stall.
+STALL_READ_SIZE = 64 * 1024
+# Reads of a raced response body held ahead of its reader.
+STALL_READ_AHEAD = 4
+
+# (prefix, mirror) rules, the first matching prefix of a URL is replaced.
+_mirrors = []
+# scheme -> transport used for URLs of that scheme.
+_transports = {}
+# Seconds before a raced request is hedged, None when sources are not raced.
+_hedge_delay = None
+# source root -> bytes per second measured, 0 for a source that failed.
+_throughput = {}
+# source root -> thread probing it, once probed.
+_probes = {}
+_probe_lock = threading.Lock()
+# Request headers naming a validator, which only its source can check.
+_CONDITIONAL_HEADERS = ('If-Range', 'If-None-Match', 'If-Modified-Since')
+
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/')
+
+
+def _Headers(headers):
+  """Returns an httplib.HTTPMessage holding a dict of headers."""
+  text = ''.join('%s: %s\r\n' % item for item in sorted(headers.iteritems()))
+  return httplib.HTTPMessage(StringIO.StringIO(text + '\r\n'))
+
+
+def _HttpError(url, code, reason, headers=None):
+  """Returns the urllib2.HTTPError urllib2 would raise for a status."""
+  return urllib2.HTTPError(url, code, reason, headers or _Headers({}), None)
+
+
+def _ParseRange(headers, size=None):
+  """Returns the (first, last) bytes of a Range header, None if none.
+
+  Args:
+    headers: a dict of request headers
+    size: optional, size of the file, to resolve suffix and open ranges
+  """
+  match = _RANGE_RE.match((headers or {}).get('Range', ''))
+  if not match or not (match.group(1) or match.group(2)):
+    return None
+  first, last = match.groups()
+  if size is None:
+    return (first and int(first), last and int(last))
+  if not first:
+    return (max(0, size - int(last)), size - 1)
+  return (int(first), min(int(last), size - 1) if last else size - 1)
+
+
+class HttpResponse(object):
+
+  """A response of HttpTransport, its connection pooled once it is closed.
+
+  It contains the following fields:
+  - url: the URL answered, after redirects
+  """
+
+  def __init__(self, transport, key, connection, response, url):
+    self.url = url
+    self._transport = transport
+    self._key = key
+    self._connection = connection
+    self._response = response
+
+  def read(self, size=-1):
+    try:
+      if size is None or size < 0:
+        return self._response.read()
+      return self._response.read(size)
+    except httplib.HTTPException as e:
+      raise IOError('Could not read %s: %r' % (self.url, e))
+
+  def info(self):
+    return self._response.msg
+
+  def getcode(self):
+    return self._response.status
+
+  def geturl(self):
+    return self.url
+
+  def close(self):
+    """Close the response, pooling its connection if it can be reused."""
+    connection, self._connection = self._connection, None
+    if not connection:
+      return
+    response = self._response
+    try:
+      if (not response.isclosed() and response.length is not None and
+          response.length <= DRAIN_LIMIT):
+        response.read()
+    except (IOError, httplib.HTTPException):
+      pass
+    if response.isclosed() and not response.will_close:
+      self._transport._Release(self._key, connection)
+    else:
+      response.close()
+      connection.close()
+
+
+class HttpTransport(object):
+
+  """Opens http(s):// URLs over pooled keep-alive connections.
+
+  Proxies set in the environment are honoured, as urllib does. A pooled
+  connection that turns out closed by the server is replaced once.
+  """
+
+  ranges = True
+
+  def __init__(self, timeout=TIMEOUT, max_idle=MAX_IDLE_CONNECTIONS):
+    self.timeout = timeout
+    self.max_idle = max_idle
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def _Route(self, url):
+    """Returns (pool key, request path, tunnel) of a URL, through proxies."""
+    parts = urlparse.urlsplit(url)
+    path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    proxy = urllib.getproxies().get(parts.scheme)
+    if proxy and not urllib.proxy_bypass(parts.hostname):
+      proxy_host = urlparse.urlsplit(proxy).netloc or proxy
+      if parts.scheme == 'http':
+        return (('http', proxy_host, None), url, None)
+      return (('https', proxy_host, parts.netloc), path, parts.netloc)
+    return ((parts.scheme, parts.netloc, None), path, None)
+
+  def _Connect(self, key, tunnel):
+    """Returns an idle connection to a server, or a new one."""
+    with self._lock:
+      idle = self._idle.get(key)
+      if idle:
+        return (idle.pop(), True)
+    if key[0] == 'https':
+      connection = httplib.HTTPSConnection(key[1], timeout=self.timeout)
+    else:
+      connection = httplib.HTTPConnection(key[1], timeout=self.timeout)
+    if tunnel:
+      connection.set_tunnel(tunnel)
+    return (connection, False)
+
+  def _Release(self, key, connection):
+    """Return a connection whose response was read to the pool."""
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_idle:
+        idle.append(connection)
+        return
+    connection.close()
+
+  def Close(self):
+    """Close every idle connection."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for connections in idle.itervalues():
+      for connection in connections:
+        connection.close()
+
+  def _Request(self, url, headers, method):
+    """Send one request, returns an HttpResponse whatever its status."""
+    (key, path, tunnel) = self._Route(url)
+    request_headers = {'User-Agent': USER_AGENT}
+    request_headers.update(headers or {})
+    while True:
+      (connection, reused) = self._Connect(key, tunnel)
+      try:
+        connection.request(method, path, headers=request_headers)
+        response = connection.getresponse()
+        return HttpResponse(self, key, connection, response, url)
+      except (socket.error, httplib.HTTPException) as e:
+        connection.close()
+        if not reused:
+          raise IOError('Could not fetch %s: %r' % (url, e))
+        logging.debug('Pooled connection for %s was closed, reconnecting.',
+                      url)
+
+  def Open(self, url, headers=None, method='GET'):
+    """Open a URL, following redirects.
+
+    Args:
+      url: http(s):// URL
+      headers: optional dict of request headers
+      method: optional HTTP method, e.g. 'HEAD'
+    Returns:
+      an HttpResponse, with a 2xx status
+    Raises:
+      urllib2.HTTPError for any other status, as urllib2.urlopen does
+      IOError on network failure
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+      response = self._Request(url, headers, method)
+      code = response.getcode()
+      location = response.info().getheader('Location')
+      if code in (301, 302, 303, 307, 308) and location:
+        response.close()
+        url = urlparse.urljoin(url, location)
+        continue
+      if code >= 300:
+        error = _HttpError(url, code, response._response.reason,
+                           response.info())
+        response.close()
+        raise error
+      return response
+    raise IOError('Too many redirects opening %s.' % url)
+
+
+class FileResponse(object):
+  """A local file, or a byte range of it, answered like an HTTP response."""
+
+  def __init__(self, url, local_file, code, headers, length):
+    self.url = url
+    self._file = local_file
+    self._code = code
+    self._headers = _Headers(headers)
+    self._left = length
+
+  def read(self, size=-1):
+    if size is None or size < 0 or size > self._left:
+      size = self._left
+    data = self._file.read(size)
+    self._left -= len(data)
+    return data
+
+  def info(self):
+    return self._headers
+
+  def getcode(self):
+    return self._code
+
+  def geturl(self):
+    return self.url
+
+  def close(self):
+    self._file.close()
+
+
+class FileTransport(object):
+
+  """Opens file:// URLs, e.g. of a mirror mounted over NFS.
+
+  Byte ranges are honoured, conditional on Last-Modified, so downloads from
+  a mirror are resumed and segmented as over HTTP.
+  """
+
+  ranges = True
+
+  def Open(self, url, headers=None, method='GET'):
+    """Open a local file.
+
+    Args:
+      url: file:// URL
+      headers: optional dict of request headers, Range and If-Range are used
+      method: optional, 'HEAD' to open nothing but the headers
+    Returns:
+      a FileResponse
+    Raises:
+      urllib2.HTTPError for a range beyond the end of the file
+      IOError when the file cannot be read
+    """
+    path = LocalPath(url)
+    local_file = open(path, 'rb')
+    try:
+      st = os.fstat(local_file.fileno())
+      validator = email.utils.formatdate(st.st_mtime, usegmt=True)
+      response_headers = {'Accept-Ranges': 'bytes',
+                          'Last-Modified': validator}
+      (code, first, last) = (200, 0, st.st_size - 1)
+      byte_range = _ParseRange(headers, st.st_size)
+      if_range = (headers or {}).get('If-Range')
+      if byte_range and (not if_range or if_range == validator):
+        (first, last) = byte_range
+        if first >= st.st_size:
+          raise _HttpError(url, 416, 'Requested Range Not Satisfiable')
+        code = 206
+        response_headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            first, last, st.st_size)
+      length = max(0, last - first + 1) if method != 'HEAD' else 0
+      response_headers['Content-Length'] = str(last - first + 1)
+      local_file.seek(first)
+    except:
+      local_file.close()
+      raise
+    return FileResponse(url, local_file, code, response_headers, length)
+
+
+class PipeResponse(object):
+  """The output of a command answered like an HTTP response.
+
+  Reading to the end waits for the command and raises IOError if it failed.
+  """
+
+  def __init__(self, url, cmd, code, headers):
+    self.url = url
+    self._name = cmd[0]
+    self._code = code
+    self._headers = _Headers(headers)
+    self._error_file = tempfile.TemporaryFile()
+    self._proc = StartCommand(cmd, stderr=self._error_file)
+
+  def read(self, size=-1):
+    whole = size is None or size < 0
+    data = self._proc.stdout.read() if whole else self._proc.stdout.read(size)
+    if (whole or not data) and self._proc.returncode is None:
+      self._proc.stdout.close()
+      if self._proc.wait():
+        self._error_file.seek(0)
+        raise IOError('%s failed: stderr = %r' %
+                      (self._name, self._error_file.read()))
+    return data
+
+  def info(self):
+    return self._headers
+
+  def getcode(self):
+    return self._code
+
+  def geturl(self):
+    return self.url
+
+  def close(self):
+    if self._proc.returncode is None:
+      self._proc.stdout.close()
+      self._proc.wait()
+    self._error_file.close()
+
+
+class GsTransport(object):
+
+  """Opens gs:// URLs through a 'gsutil cat' pipe.
+
+  Byte ranges are passed on as 'gsutil cat -r'; gsutil has neither
+  conditional requests nor response headers.
+  """
+
+  ranges = False
+
+  def Open(self, url, headers=None, method='GET'):
+    """Start streaming a Google Storage object.
+
+    Args:
+      url: gs:// URL
+      headers: optional dict of request headers, only Range is used
+      method: optional, only 'GET' is supported
+    Returns:
+      a PipeResponse
+    Raises:
+      IOError when gsutil cannot be started or the method is not GET
+    """
+    if method != 'GET':
+      raise IOError('Cannot %s %s with gsutil.' % (method, url))
+    cmd = ['gsutil', 'cat', url]
+    byte_range = _ParseRange(headers)
+    if not byte_range:
+      return PipeResponse(url, cmd, 200, {})
+    (first, last) = byte_range
+    spec = '%s-%s' % ('' if first is None else first,
+                      '' if last is None else last)
+    cmd[2:2] = ['-r', spec]
+    return PipeResponse(url, cmd, 206, {'Content-Range': 'bytes %s/*' % spec})
+
+
+def RegisterTransport(scheme, transport):
+  """Sets the transport URLs of a scheme are opened with.
+
+  Args:
+    scheme: a URL scheme, e.g. 'http'
+    transport: an object with an Open(url, headers, method) method returning
+               a file object like urllib2.urlopen, and a boolean field
+               ranges, True when it honours Range and If-Range
+  """
+  _transports[scheme] = transport
+
+
+def SetMirrors(mirrors):
+  """Sets the mirror rules URLs are rewritten with before being opened.
+
+  A rule for IMAGE_GSD_PREFIX also applies to IMAGE_GSD_BUCKET URLs, which
+  name the same files.
+
+  Args:
+    mirrors: a list of (prefix, mirror) tuples, e.g.
+             ('http://chromeos-images/chromeos-official',
+              'file:///mnt/chromeos-images')
+  """
+  global _mirrors
+  rules = []
+  for (prefix, mirror) in mirrors:
+    rules.append((prefix.rstrip('/'), mirror.rstrip('/')))
+    if prefix.rstrip('/') == IMAGE_GSD_PREFIX:
+      rules.append((IMAGE_GSD_BUCKET, mirror.rstrip('/')))
+  _mirrors = rules
+  _ForgetProbes()
+
+
+def SetRacing(hedge_delay):
+  """Enables racing the sources of mirrored URLs, see RankSources.
+
+  Args:
+    hedge_delay: seconds a request waits for an answer before the next
+                 source is asked too, None to fetch from Rewrite only
+  """
+  global _hedge_delay
+  _hedge_delay = hedge_delay
+  _ForgetProbes()
+
+
+def _ForgetProbes():
+  """Forget the throughput measured of every source."""
+  with _probe_lock:
+    _throughput.clear()
+    _probes.clear()
+
+
+def Rewrite(url):
+  """Returns the URL a URL is fetched from, after mirror rules.
+
+  Args:
+    url: URL of an online resource
+  """
+  for (prefix, mirror) in _mirrors:
+    if url == prefix or url.startswith(prefix + '/'):
+      return mirror + url[len(prefix):]
+  return url
+
+
+def _Candidates(url):
+  """Returns a (root, source) tuple for each location a URL is fetched from.
+
+  Matching mirrors come first, in rule order, then the URL itself. A root
+  is the mirror, or prefix, a source starts with; throughput is measured
+  per root. A URL no rule matches is its only source.
+
+  Args:
+    url: URL of an online resource
+  """
+  candidates = []
+  origin = None
+  for (prefix, mirror) in _mirrors:
+    if url == prefix or url.startswith(prefix + '/'):
+      source = mirror + url[len(prefix):]
+      if source not in [known for (_, known) in candidates]:
+        candidates.append((mirror, source))
+      origin = origin or prefix
+  candidates.append((origin or url, url))
+  return candidates
+
+
+def _Transport(source):
+  """Returns the transport of a URL after mirror rules, raising IOError."""
+  transport = _transports.get(urlparse.urlsplit(source).scheme)
+  if not transport:
+    raise IOError('No transport for %s.' % source)
+  return transport
+
+
+def _Probe(root, source):
+  """Measure the throughput of a source by reading its first bytes.
+
+  Args:
+    root: root of the source, the throughput is recorded for it
+    source: URL of the resource at the source
+  """
+  start = time.time()
+  headers = {'Range': 'bytes=0-%d' % (PROBE_SIZE - 1)}
+  try:
+    web_file = _Transport(source).Open(source, headers=headers)
+    with contextlib.closing(web_file):
+      size = len(web_file.read(PROBE_SIZE))
+    throughput = size / max(time.time() - start, 0.001)
+  except (IOError, OSError) as e:
+    logging.info('Probing %s failed: %s', source, e)
+    throughput = 0
+  logging.debug('Measured %d KB/s from %s.', throughput / 1024, root)
+  with _probe_lock:
+    _throughput[root] = throughput
+
+
+def _Rank(url):
+  """Returns the (root, source) tuples of a URL, fastest first.
+
+  See RankSources.
+  """
+  candidates = _Candidates(url)
+  if len(candidates) == 1:
+    return candidates
+  with _probe_lock:
+    for (root, source) in candidates:
+      if root not in _probes:
+        probe = threading.Thread(target=_Probe, args=(root, source))
+        probe.daemon = True
+        probe.start()
+        _probes[root] = probe
+    probes = [_probes[root] for (root, _) in candidates]
+  deadline = time.time() + PROBE_TIMEOUT
+  for probe in probes:
+    probe.join(max(0, deadline - time.time()))
+  with _probe_lock:
+    return sorted(candidates,
+                  key=lambda candidate: -_throughput.get(candidate[0], 0))
+
+
+def RankSources(url):
+  """Returns the URLs a URL can be fetched from, fastest first.
+
+  The sources of a URL are its mirrors and itself, see _Candidates. The
+  first time a mirror or server is a source, the first PROBE_SIZE bytes of
+  the URL are read from it, at the same time as from the other sources
+  not measured yet, and its throughput is kept for the rest of the run.
+  A source whose probe failed, or is still running after PROBE_TIMEOUT,
+  is ranked last. Equally fast sources keep their rule order.
+
+  Args:
+    url: URL of an online resource
+  """
+  return [source for (_, source) in _Rank(url)]
+
+
+def _Demote(root):
+  """Rank a source last for the rest of the run."""
+  logging.info('Ranking %s last, it stalled or failed.', root)
+  with _probe_lock:
+    _throughput[root] = 0
+
+
+def _OpenAttempt(source, headers, method, results):
+  """Open one source of a raced request, putting the outcome on a queue."""
+  try:
+    results.put((source, _Transport(source).Open(source, headers=headers,
+                                                 method=method), None))
+  except (IOError, OSError) as e:
+    results.put((source, None, e))
+
+
+def _CloseLate(results, pending):
+  """Close the responses of attempts that lost a race as they arrive."""
+  for _ in range(pending):
+    (_, web_file, _) = results.get()
+    if web_file:
+      web_file.close()
+
+
+class _BodyReader(object):
+
+  """Reads a response body on a thread of its own, a chunk at a time.
+
+  Chunks are put on a queue of at most STALL_READ_AHEAD, as (data, error)
+  tuples; an empty or failed read is the last one. The response is closed
+  once the reader is abandoned and its thread done reading.
+
+  It contains the following fields:
+  - chunks: a Queue of (data, error) tuples
+  """
+
+  def __init__(self, web_file, length):
+    """Start reading a body.
+
+    Args:
+      web_file: a response
+      length: an integer, bytes of the body left to read
+    """
+    self.chunks = Queue.Queue(STALL_READ_AHEAD)
+    self._file = web_file
+    self._left = length
+    self._lock = threading.Lock()
+    (self._abandoned, self._done) = (False, False)
+    thread = threading.Thread(target=self._Run)
+    thread.daemon = True
+    thread.start()
+
+  def _Run(self):
+    while not self._abandoned and self._left > 0:
+      try:
+        (data, error) = (self._file.read(min(STALL_READ_SIZE, self._left)),
+                         None)
+      except (IOError, OSError) as e:
+        (data, error) = (None, e)
+      self.chunks.put((data, error))
+      if not data:
+        break
+      self._left -= len(data)
+    with self._lock:
+      self._done = True
+      abandoned = self._abandoned
+    if abandoned:
+      self._file.close()
+
+  def Abandon(self):
+    """Stop reading, closing the response now or once a stalled read ends."""
+    with self._lock:
+      self._abandoned = True
+      done = self._done
+    # the thread blocked on a full queue puts once more, then sees abandoned
+    while True:
+      try:
+        self.chunks.get_nowait()
+      except Queue.Empty:
+        break
+    if done:
+      self._file.close()
+
+
+def _Validator(web_file):
+  """Returns the strong ETag or Last-Modified of a response, None if none."""
+  headers = web_file.info()
+  etag = headers.getheader('ETag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return headers.getheader('Last-Modified')
+
+
+class _FailoverResponse(object):
+
+  """A raced GET response whose body moves to the next source on a stall.
+
+  The body is read STALL_READ_SIZE bytes at a time by a _BodyReader. When a
+  read does not finish within the hedge delay, fails or ends early, the
+  bytes not received yet are requested as a range from the other sources
+  honouring ranges, conditional on the validator of the first response.
+  The first to answer 206 for exactly them replaces the current source,
+  which is demoted, so that no bytes of another version of the file are
+  mixed in. If none does, a stalled source is read on as an unraced fetch
+  would be. Status and headers stay those of the first response.
+
+  It contains the following fields:
+  - url: the URL answered
+  """
+
+  def __init__(self, url, web_file, root, others, headers, first, last):
+    """Wrap a response holding bytes first to last of a URL.
+
+    Args:
+      url: URL of the online resource
+      web_file: the response of the source that answered first, with an
+        ETag or Last-Modified
+      root: root of that source, see _Candidates
+      others: a list of (root, source) tuples to continue from, fastest first
+      headers: dict of the request headers, a Range is replaced
+      first: an integer, offset of the first byte of the body
+      last: an integer, offset of the last byte of the body
+    """
+    self.url = url
+    self._first_response = web_file
+    self._root = root
+    self._others = list(others)
+    self._headers = dict(headers or {})
+    self._headers['If-Range'] = _Validator(web_file)
+    self._position = first
+    self._last = last
+    self._delay = _hedge_delay
+    self._buffer = ''
+    self._reader = _BodyReader(web_file, last - first + 1)
+
+  def _Failover(self):
+    """Continue the body from the next source that holds the same file.
+
+    The current source is kept, and read on, until another one answers
+    with the bytes not received yet.
+
+    Returns:
+      a boolean, True when the body now comes from another source
+    """
+    headers = dict(self._headers)
+    headers['Range'] = 'bytes=%d-%d' % (self._position, self._last)
+    while self._others:
+      (root, source) = self._others.pop(0)
+      try:
+        transport = _Transport(source)
+        if not transport.ranges:
+          continue
+        web_file = transport.Open(source, headers=headers)
+      except (IOError, OSError) as e:
+        logging.info('Could not continue %s from %s: %s', self.url, source, e)
+        continue
+      match = _CONTENT_RANGE_RE.match(
+          web_file.info().getheader('Content-Range') or '')
+      if (web_file.getcode() != 206 or not match or
+          int(match.group(1)) != self._position):
+        logging.info('Could not continue %s from %s: not the same file.',
+                     self.url, source)
+        web_file.close()
+        continue
+      logging.info('Fetching %s from %s from byte %d.', self.url, source,
+                   self._position)
+      _Demote(self._root)
+      self._reader.Abandon()
+      self._root = root
+      self._reader = _BodyReader(web_file, self._last - self._position + 1)
+      return True
+    logging.info('No other source of %s continues it, reading on from %s.',
+                 self.url, self._root)
+    return False
+
+  def _NextChunk(self):
+    """Returns the next bytes of the body, '' at its end."""
+    while True:
+      try:
+        (data, error) = self._reader.chunks.get(
+            timeout=self._delay if self._others else None)
+      except Queue.Empty:
+        logging.info('Reading %s from %s stalled.', self.url, self._root)
+        self._Failover()
+        continue
+      if data:
+        self._position += len(data)
+        return data
+      if self._others:
+        logging.info('Reading %s from %s failed: %s', self.url, self._root,
+                     error or 'short body')
+        if self._Failover():
+          continue
+      if error:
+        raise error
+      return ''
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      chunks = []
+      while True:
+        chunk = self.read(STALL_READ_SIZE)
+        if not chunk:
+          return ''.join(chunks)
+        chunks.append(chunk)
+    if not self._buffer and self._position <= self._last:
+      self._buffer = self._NextChunk()
+    (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+    return data
+
+  def info(self):
+    return self._first_response.info()
+
+  def getcode(self):
+    return self._first_response.getcode()
+
+  def geturl(self):
+    return self._first_response.geturl()
+
+  def close(self):
+    self._reader.Abandon()
+
+
+def _Failover(url, web_file, candidates, source, headers, errors):
+  """Returns a response continuing its body elsewhere on a stall, if it can.
+
+  Args:
+    url: URL of the online resource
+    web_file: the response of the source that answered first
+    candidates: a list of (root, source) tuples, fastest first
+    source: the source that answered first
+    headers: dict of the request headers
+    errors: a dict mapping each source that failed to its error
+  Returns:
+    a _FailoverResponse, or web_file when no other source can continue it,
+    its body is of unknown length or it has no validator to check that
+    another source holds the same file
+  """
+  others = [(root, other) for (root, other) in candidates
+            if other != source and other not in errors]
+  length = web_file.info().getheader('Content-Length')
+  if (not others or not length or not length.isdigit() or
+      not _Validator(web_file)):
+    return web_file
+  if web_file.getcode() == 206:
+    match = _CONTENT_RANGE_RE.match(
+        web_file.info().getheader('Content-Range') or '')
+    if not match:
+      return web_file
+    first = int(match.group(1))
+  elif web_file.getcode() == 200:
+    first = 0
+  else:
+    return web_file
+  root = [root for (root, known) in candidates if known == source][0]
+  return _FailoverResponse(url, web_file, root, others, headers, first,
+                           first + int(length) - 1)
+
+
+def _HedgedOpen(url, candidates, headers, method):
+  """Open the first source of a URL to answer.
+
+  The request is sent to the first source, then to the next one whenever
+  no source answered within the hedge delay, or every source asked failed.
+  Sources asked before the winner are ranked last from then on. An error
+  status below 400, e.g. 304 Not Modified, is an answer, not a failure.
+  The body of a GET answer is continued from the other sources if it
+  stalls, see _FailoverResponse.
+
+  Args:
+    url: URL of an online resource
+    candidates: a list of (root, source) tuples, fastest first
+    headers: optional dict of request headers
+    method: request method
+  Returns:
+    a file object like those urllib2.urlopen returns
+  Raises:
+    the error of the first source when every source failed
+  """
+  results = Queue.Queue()
+  sources = [source for (_, source) in candidates]
+  errors = {}
+  (asked, pending, stalled) = (0, 0, False)
+  while asked < len(sources) or pending:
+    if asked < len(sources) and (stalled or not pending):
+      if asked:
+        logging.info('Also fetching %s from %s.', url, sources[asked])
+      attempt = threading.Thread(target=_OpenAttempt,
+                                 args=(sources[asked], headers, method,
+                                       results))
+      attempt.daemon = True
+      attempt.start()
+      (asked, pending) = (asked + 1, pending + 1)
+    try:
+      timeout = _hedge_delay if asked < len(sources) else None
+      (source, web_file, error) = results.get(timeout=timeout)
+    except Queue.Empty:
+      stalled = True
+      continue
+    (pending, stalled) = (pending - 1, False)
+    if error and not (isinstance(error, urllib2.HTTPError) and
+                      error.code < 400):
+      errors[source] = error
+      continue
+    for (root, _) in candidates[:sources.index(source)]:
+      _Demote(root)
+    if pending:
+      closer = threading.Thread(target=_CloseLate, args=(results, pending))
+      closer.daemon = True
+      closer.start()
+    if error:
+      raise error
+    if method != 'GET':
+      return web_file
+    return _Failover(url, web_file, candidates, source, headers, errors)
+  raise errors[sources[0]]
+
+
+def LocalPath(url):
+  """Returns the local path of a file:// URL."""
+  return urllib.url2pathname(urlparse.urlsplit(url).path)
+
+
+def TransportFor(url):
+  """Returns the transport a URL is opened with, None if none.
+
+  Args:
+    url: URL of an online resource, before mirror rules
+  """
+  source = RankSources(url)[0] if _hedge_delay is not None else Rewrite(url)
+  return _transports.get(urlparse.urlsplit(source).scheme)
+
+
+def OpenUrl(url, headers=None, method='GET'):
+  """Open a URL, through its mirror if any, with the transport of its scheme.
+
+  With racing enabled, the URL is fetched from its fastest source, and
+  from the next ones if it stalls, see RankSources and _HedgedOpen. A
+  conditional request goes to the fastest source only, as its validator
+  only means something there.
+
+  Args:
+    url: URL of an online resource
+    headers: optional dict of request headers
+    method: optional request method, e.g. 'HEAD'
+  Returns:
+    a file object like those urllib2.urlopen returns
+  Raises:
+    urllib2.HTTPError for an HTTP error status
+    IOError when the URL cannot be opened
+  """
+  if _hedge_delay is not None:
+    candidates = _Rank(url)
+    if not set(headers or {}).intersection(_CONDITIONAL_HEADERS):
+      return _HedgedOpen(url, candidates, headers, method)
+    source = candidates[0][1]
+  else:
+    source = Rewrite(url)
+  if source != url:
+    logging.debug('Fetching %s from mirror %s.', url, source)
+  return _Transport(source).Open(source, headers=headers, method=method)
+
+
+_http_transport = HttpTransport()
+RegisterTransport('http', _http_transport)
+RegisterTransport('https', _http_transport)
+RegisterTransport('file', FileTransport())
+RegisterTransport('gs', GsTransport())
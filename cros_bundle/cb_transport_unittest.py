@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# Copyright (c) 2011 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cb_transport module."""
+
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib2
+
+import cb_transport
+import cb_url_lib
+from cb_constants import IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX, \
+    IMAGE_SERVER_PREFIX
+from cb_test_http_server import StandInServer
+
+
+class TestRewrite(unittest.TestCase):
+  """Unit tests related to SetMirrors and Rewrite."""
+
+  def tearDown(self):
+    cb_transport.SetMirrors([])
+
+  def testNoMirrors(self):
+    """Verify URLs are left alone without mirror rules."""
+    self.assertEqual(IMAGE_SERVER_PREFIX + '/a',
+                     cb_transport.Rewrite(IMAGE_SERVER_PREFIX + '/a'))
+
+  def testPrefixReplaced(self):
+    """Verify only whole path components of a prefix are replaced."""
+    cb_transport.SetMirrors([(IMAGE_SERVER_PREFIX + '/', 'file:///m/')])
+    self.assertEqual('file:///m/dev-channel/a.bin', cb_transport.Rewrite(
+        IMAGE_SERVER_PREFIX + '/dev-channel/a.bin'))
+    self.assertEqual(IMAGE_SERVER_PREFIX + '-x/a', cb_transport.Rewrite(
+        IMAGE_SERVER_PREFIX + '-x/a'))
+
+  def testGsdMirrorCoversBucket(self):
+    """Verify a GSD rule applies to gs:// URLs of the same files."""
+    cb_transport.SetMirrors([(IMAGE_GSD_PREFIX, 'http://cache/releases')])
+    self.assertEqual('http://cache/releases/dev-channel/a.bin',
+                     cb_transport.Rewrite(IMAGE_GSD_BUCKET +
+                                          '/dev-channel/a.bin'))
+    self.assertEqual(cb_transport.TransportFor(IMAGE_GSD_BUCKET + '/a'),
+                     cb_transport.TransportFor('http://cache/a'))
+
+
+class TestHttpTransport(unittest.TestCase):
+  """Unit tests related to HttpTransport against a local server."""
+
+  def setUp(self):
+    self.content = os.urandom(1000)
+    self.server = StandInServer({'/a.bin': self.content,
+                                 '/big.bin': 'x' * (1024 * 1024)},
+                                etag='"v1"').Start()
+    self.transport = cb_transport.HttpTransport()
+
+  def tearDown(self):
+    self.transport.Close()
+    self.server.Stop()
+
+  def _Read(self, path, headers=None):
+    url = self.server.url + path
+    with contextlib.closing(self.transport.Open(url, headers)) as web_file:
+      return web_file.read()
+
+  def testConnectionReused(self):
+    """Verify requests to one server share a kept alive connection."""
+    for _ in range(3):
+      self.assertEqual(self.content, self._Read('/a.bin'))
+    self.assertEqual(1, self.server.connection_count)
+
+  def testUnreadResponseNotReused(self):
+    """Verify a connection with a large unread body is not pooled."""
+    web_file = self.transport.Open(self.server.url + '/big.bin')
+    web_file.read(10)
+    web_file.close()
+    self.assertEqual(self.content, self._Read('/a.bin'))
+    self.assertEqual(2, self.server.connection_count)
+
+  def testDroppedConnectionReplaced(self):
+    """Verify a pooled connection closed by the server is replaced."""
+    self._Read('/a.bin')
+    self.server.DropConnections()
+    time.sleep(0.1)
+    self.assertEqual(self.content, self._Read('/a.bin'))
+    self.assertEqual(2, self.server.connection_count)
+
+  def testRange(self):
+    """Verify range requests are answered with their bytes."""
+    url = self.server.url + '/a.bin'
+    with contextlib.closing(self.transport.Open(
+        url, {'Range': 'bytes=10-19'})) as web_file:
+      self.assertEqual(206, web_file.getcode())
+      self.assertEqual('bytes 10-19/1000',
+                       web_file.info().getheader('Content-Range'))
+      self.assertEqual(self.content[10:20], web_file.read())
+
+  def testErrorStatus(self):
+    """Verify HTTPError for error and not modified statuses."""
+    try:
+      self.transport.Open(self.server.url + '/missing')
+      self.fail('HTTPError not raised')
+    except urllib2.HTTPError as e:
+      self.assertEqual(404, e.code)
+    try:
+      self.transport.Open(self.server.url + '/a.bin',
+                          {'If-None-Match': '"v1"'})
+      self.fail('HTTPError not raised')
+    except urllib2.HTTPError as e:
+      self.assertEqual(304, e.code)
+    # both answers were read, so the connection is still used
+    self.assertEqual(self.content, self._Read('/a.bin'))
+    self.assertEqual(1, self.server.connection_count)
+
+  def testNoServer(self):
+    """Verify IOError when nothing listens."""
+    url = self.server.url + '/a.bin'
+    self.server.Stop()
+    self.server = StandInServer({}).Start()
+    self.assertRaises(IOError, self.transport.Open, url)
+
+
+class TestFileTransport(unittest.TestCase):
+  """Unit tests related to FileTransport."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.content = os.urandom(1000)
+    self.name = os.path.join(self.test_dir, 'a.bin')
+    with open(self.name, 'wb') as local_file:
+      local_file.write(self.content)
+    self.url = 'file://' + self.name
+    self.transport = cb_transport.FileTransport()
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Open(self, headers=None):
+    return contextlib.closing(self.transport.Open(self.url, headers))
+
+  def testWholeFile(self):
+    """Verify a file is read whole, announcing its size and range support."""
+    with self._Open() as web_file:
+      self.assertEqual(200, web_file.getcode())
+      self.assertEqual('1000', web_file.info().getheader('Content-Length'))
+      self.assertEqual('bytes', web_file.info().getheader('Accept-Ranges'))
+      self.assertEqual(self.content, web_file.read())
+
+  def testRanges(self):
+    """Verify first-last, open and suffix ranges."""
+    for (spec, first, last) in [('10-19', 10, 19), ('990-', 990, 999),
+                                ('-5', 995, 999), ('995-2000', 995, 999)]:
+      with self._Open({'Range': 'bytes=' + spec}) as web_file:
+        self.assertEqual(206, web_file.getcode())
+        self.assertEqual('bytes %d-%d/1000' % (first, last),
+                         web_file.info().getheader('Content-Range'))
+        self.assertEqual(self.content[first:last + 1], web_file.read())
+
+  def testIfRange(self):
+    """Verify a range conditional on another version gets the whole file."""
+    with self._Open() as web_file:
+      validator = web_file.info().getheader('Last-Modified')
+    with self._Open({'Range': 'bytes=10-', 'If-Range': validator}) as web_file:
+      self.assertEqual(206, web_file.getcode())
+    with self._Open({'Range': 'bytes=10-', 'If-Range': 'other'}) as web_file:
+      self.assertEqual(200, web_file.getcode())
+      self.assertEqual(self.content, web_file.read())
+
+  def testRangeBeyondEnd(self):
+    """Verify HTTPError 416 for a range past the end of the file."""
+    self.assertRaises(urllib2.HTTPError, self.transport.Open, self.url,
+                      {'Range': 'bytes=1000-'})
+
+  def testMissingFile(self):
+    """Verify IOError for a missing file."""
+    self.assertRaises(IOError, self.transport.Open, self.url + '.missing')
+
+
+class TestRacing(unittest.TestCase):
+  """Unit tests related to RankSources and hedged requests."""
+
+  def setUp(self):
+    self.content = os.urandom(1000)
+    self.origin = StandInServer({'/a.bin': self.content}).Start()
+    self.mirror = StandInServer({'/a.bin': self.content}).Start()
+    cb_transport.SetMirrors([(self.origin.url, self.mirror.url)])
+    cb_transport.SetRacing(5)
+    self.url = self.origin.url + '/a.bin'
+
+  def tearDown(self):
+    cb_transport.SetRacing(None)
+    cb_transport.SetMirrors([])
+    self.origin.Stop()
+    self.mirror.Stop()
+
+  def _Read(self, headers=None):
+    with contextlib.closing(cb_transport.OpenUrl(self.url,
+                                                 headers)) as web_file:
+      return web_file.read()
+
+  def _Fastest(self):
+    """Returns the server ranked first."""
+    if cb_transport.RankSources(self.url)[0] == self.url:
+      return self.origin
+    return self.mirror
+
+  def _StallFastest(self):
+    """Serve a large file, stalling midway from the fastest source.
+
+    Returns:
+      a tuple (stalled, other) of the servers
+    """
+    self.content = os.urandom(200 * 1024)
+    self.origin.files['/a.bin'] = self.mirror.files['/a.bin'] = self.content
+    self.origin.etag = self.mirror.etag = '"v1"'
+    cb_transport.SetRacing(0.2)
+    stalled = self._Fastest()
+    other = self.mirror if stalled is self.origin else self.origin
+    stalled.stall = (100 * 1024, 3)
+    return (stalled, other)
+
+  def testFastestFirst(self):
+    """Verify sources are ranked by throughput, whatever the rule order."""
+    self.mirror.latency = 0.3
+    self.assertEqual([self.url, self.mirror.url + '/a.bin'],
+                     cb_transport.RankSources(self.url))
+    self.assertEqual(self.content, self._Read())
+    # one probe each, then the request to the fastest only
+    self.assertEqual(1, len(self.mirror.requests))
+    self.assertEqual(2, len(self.origin.requests))
+
+  def testStalledSourceHedged(self):
+    """Verify a stalled request is also sent to the next source."""
+    cb_transport.RankSources(self.url)
+    cb_transport.SetRacing(0.1)
+    self.origin.latency = self.mirror.latency = 0
+    first = cb_transport.RankSources(self.url)[0]
+    stalled = self.origin if first == self.url else self.mirror
+    stalled.latency = 2
+    start = time.time()
+    self.assertEqual(self.content, self._Read())
+    self.assertTrue(time.time() - start < 1)
+    self.assertNotEqual(first, cb_transport.RankSources(self.url)[0])
+
+  def testStalledBodyContinued(self):
+    """Verify a body stalling midway is finished from the next source."""
+    (stalled, other) = self._StallFastest()
+    start = time.time()
+    self.assertEqual(self.content, self._Read())
+    self.assertTrue(time.time() - start < 2)
+    # the bytes after the first read, from the other source
+    self.assertEqual(('GET', '/a.bin', 'bytes=%d-%d' % (
+        cb_transport.STALL_READ_SIZE, len(self.content) - 1)),
+                     other.requests[-1])
+    self.assertNotEqual(stalled, self._Fastest())
+
+  def testStalledBodyNotMixedWithOtherVersion(self):
+    """Verify a body is read on from its source if no other has its version."""
+    (stalled, other) = self._StallFastest()
+    other.etag = '"other"'
+    self.assertEqual(self.content, self._Read())
+    # the range was asked conditionally, and answered with the whole file
+    self.assertEqual('bytes=%d-%d' % (cb_transport.STALL_READ_SIZE,
+                                      len(self.content) - 1),
+                     other.requests[-1][2])
+    self.assertEqual(stalled, self._Fastest())
+
+  def testStalledBodyWithoutValidator(self):
+    """Verify a body that cannot be checked elsewhere is not continued."""
+    (stalled, other) = self._StallFastest()
+    stalled.etag = other.etag = None
+    stalled.stall = (100 * 1024, 0.5)
+    requests = len(other.requests)
+    self.assertEqual(self.content, self._Read())
+    self.assertEqual(requests, len(other.requests))
+
+  def testMissingFromMirror(self):
+    """Verify a source without the file is skipped without waiting."""
+    del self.mirror.files['/a.bin']
+    self.origin.latency = 0.3
+    start = time.time()
+    self.assertEqual(self.content, self._Read())
+    # probes, then the mirror's 404 and the origin's answer
+    self.assertTrue(time.time() - start < 5)
+
+  def testEverySourceFails(self):
+    """Verify the error of the fastest source when all of them fail."""
+    del self.mirror.files['/a.bin']
+    del self.origin.files['/a.bin']
+    try:
+      cb_transport.OpenUrl(self.url)
+      self.fail('HTTPError not raised')
+    except urllib2.HTTPError as e:
+      self.assertEqual(404, e.code)
+
+  def testConditionalRequestNotHedged(self):
+    """Verify a request with a validator goes to the fastest source only."""
+    self.mirror.latency = 0.3
+    cb_transport.RankSources(self.url)
+    self.assertEqual(self.content[10:], self._Read(
+        {'Range': 'bytes=10-', 'If-Range': 'validator'})[10:])
+    self.assertEqual(1, len(self.mirror.requests))
+
+  def testUnmirroredUrl(self):
+    """Verify a URL without mirrors is fetched without probes."""
+    self.assertEqual([self.mirror.url + '/a.bin'], cb_transport.RankSources(
+        self.mirror.url + '/a.bin'))
+    self.assertEqual([], self.mirror.requests)
+
+
+class TestFileMirror(unittest.TestCase):
+  """Unit tests related to listing and downloading through a file mirror."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.mirror_dir = os.path.join(self.test_dir, 'mirror')
+    self.work_dir = os.path.join(self.test_dir, 'work')
+    os.makedirs(os.path.join(self.mirror_dir, '1.0', 'sub'))
+    os.makedirs(self.work_dir)
+    self.content = os.urandom(5000)
+    self.image = 'ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip'
+    with open(os.path.join(self.mirror_dir, '1.0', self.image), 'wb') as image:
+      image.write(self.content)
+    # the server answers nothing, every request must go to the mirror
+    self.server = StandInServer({}).Start()
+    cb_transport.SetMirrors([(self.server.url, 'file://' + self.mirror_dir)])
+    self.saved_workdir = cb_url_lib.WORKDIR
+    cb_url_lib.WORKDIR = self.work_dir
+
+  def tearDown(self):
+    cb_url_lib.WORKDIR = self.saved_workdir
+    cb_transport.SetMirrors([])
+    self.server.Stop()
+    shutil.rmtree(self.test_dir)
+
+  def testListed(self):
+    """Verify a mirrored index is listed as the mirror directory."""
+    self.assertEqual([self.image, 'sub/'],
+                     cb_url_lib.ListUrls(self.server.url + '/1.0'))
+
+  def testDeterminedThenDownloaded(self):
+    """Verify an image is found and fetched from the mirror only."""
+    url = cb_url_lib.DetermineUrl(self.server.url + '/1.0',
+                                  ['chromeos', '.zip'])
+    self.assertEqual(self.server.url + '/1.0/' + self.image, url)
+    self.assertTrue(cb_url_lib.Download(url))
+    with open(os.path.join(self.work_dir, self.image), 'rb') as image:
+      self.assertEqual(self.content, image.read())
+    self.assertEqual([], self.server.requests)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
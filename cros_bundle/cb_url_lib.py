@@ -5,27 +5,55 @@
 
 """This module contains methods for interacting with online resources."""
 
-import contextlib
 import fnmatch
-import formatter
 import logging
 import os
 import re
-import urllib
+import urllib2
+import zipfile
 
-from cb_archive_hashing_lib import CheckMd5
+from cb_archive_hashing_lib import CheckMd5, DIGEST_ALGORITHMS, \
+    GenerateDigests, RecordDigests, STORE_DIGEST_ALGORITHMS, ZipExtract
 from cb_constants import BundlingError, IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX, \
     WORKDIR
+from cb_download_lib import ConfigureDownloads, DiscardDownload, \
+    DownloadDigests, FetchGs, FetchHttp, FetchZipMember, PartialName, \
+    PromoteDownload
+from cb_lock_lib import FileLock
+from cb_transport import LocalPath, OpenUrl, Rewrite, TransportFor
 from cb_util import RunCommand
-from htmllib import HTMLParser
-
-
-class UrlLister(HTMLParser):
-
-  """List all hyperlinks found on an html page.
+from xml.sax import saxutils
+
+# Bytes of an index page parsed at a time.
+LISTING_CHUNK_SIZE = 64 * 1024
+# Anchor tags, and comments, whose anchors are ignored.
+_MARKUP_RE = re.compile(r'<!--|<a\s[^>]*>', re.IGNORECASE)
+_HREF_RE = re.compile(
+    r'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+_ENTITIES = {'&quot;': '"', '&#39;': "'", '&#x27;': "'"}
+# Characters fnmatch gives a special meaning to.
+_GLOB_CHARS_RE = re.compile(r'[*?[]')
+# Memo of compiled token_list patterns, cleared when it grows this large.
+MAX_COMPILED_TOKENS = 100
+_compiled_tokens = {}
+
+# ListingCache shared by every DetermineUrl call, None to always fetch.
+_listing_cache = None
+# GsIndex answering gs:// listings, None to run 'gsutil ls' per directory.
+_gs_index = None
+# ArtifactCatalog DetermineUrl resolves from first, None to always list.
+_catalog = None
+# ArtifactStore downloads are shared through, None to always download.
+_artifact_store = None
+
+
+class UrlLister(object):
+
+  """List all hyperlinks found on an html page, parsing it as it streams in.
 
   It contains the following fields:
   - urls: list of urls found
+  - done: a boolean, True once limit urls were found and feeding may stop
 
   The href attribute of all anchor tags will be stored in urls, so if the page
   has relative links then for those urls stored they will be relative links.
@@ -33,27 +61,99 @@ class UrlLister(HTMLParser):
   <a href="http://google.com/">Google</a> -> "http://google.com"
   <a href="my_filename_here.zip">My file!</a> -> "my_filename_here.zip"
 
-  Modified from http://diveintopython.org/html_processing/extracting_data.html
+  The page may be fed in chunks of any size; only an anchor tag cut by a
+  chunk boundary is held back until the next chunk, and whether a comment
+  is still open is carried over, so memory is bounded by the chunk size and
+  the urls kept. Anchors inside comments are ignored, and character
+  entities in hrefs are decoded.
   """
 
-  def __init__(self, given_formatter):
-    HTMLParser.__init__(self, given_formatter)
-    self.urls = []
+  def __init__(self, accept=None, limit=None):
+    """Create a lister.
+
+    Args:
+      accept: optional function taking an href, False to not keep it
+      limit: optional number of urls after which the lister is done
+    """
+    self.accept = accept
+    self.limit = limit
+    self.reset()
 
   def reset(self):
     """Reset the parser to clean state."""
-    HTMLParser.reset(self)
     self.urls = []
-
-  def start_a(self, attrs):
-    """Add urls found to list of urls.
+    self.done = False
+    self._pending = ''
+    self._in_comment = False
+
+  def _Add(self, tag):
+    """Keep the href of an anchor tag, if any and accepted."""
+    match = _HREF_RE.search(tag, 2)
+    if not match:
+      return
+    href = saxutils.unescape(match.group(1) or match.group(2) or
+                             match.group(3) or '', _ENTITIES)
+    if self.accept and not self.accept(href):
+      return
+    self.urls.append(href)
+    if self.limit and len(self.urls) >= self.limit:
+      self.done = True
+
+  def feed(self, data):
+    """Parse the next chunk of the page.
 
     Args:
-      attrs: attributes of the anchor tag
+      data: a string, the chunk
     """
-    href = [v for k, v in attrs if k == 'href']
-    if href:
-      self.urls.extend(href)
+    if self.done:
+      return
+    data = self._pending + data
+    pos = 0
+    while True:
+      if self._in_comment:
+        close = data.find('-->', pos)
+        if close == -1:
+          # keep what may begin the end of the comment
+          self._pending = data[max(pos, len(data) - 2):]
+          return
+        pos = close + 3
+        self._in_comment = False
+      match = _MARKUP_RE.search(data, pos)
+      if not match:
+        break
+      pos = match.end()
+      if match.group() == '<!--':
+        self._in_comment = True
+        continue
+      self._Add(match.group())
+      if self.done:
+        self._pending = ''
+        return
+    self._pending = data[_IncompleteMarkup(data, pos):]
+
+  def close(self):
+    """Finish parsing, dropping any unterminated tag or comment."""
+    self._pending = ''
+    self._in_comment = False
+
+
+def _IncompleteMarkup(data, start):
+  """Returns where an anchor tag or comment start cut off at the end begins.
+
+  Args:
+    data: a string, html parsed up to start
+    start: an integer, where parsing of data stopped
+  Returns:
+    an integer, the offset of the incomplete markup, len(data) if none
+  """
+  pos = data.find('<', start)
+  while pos != -1:
+    if len(data) - pos < 4:
+      return pos
+    if data[pos + 1] in 'aA' and data[pos + 2].isspace():
+      return pos
+    pos = data.find('<', pos + 1)
+  return len(data)
 
 
 class NameResolutionError(Exception):
@@ -85,6 +185,184 @@ def _ConvertHttpToGsUrl(url):
   return gs_url + '/*'
 
 
+def SetListingCache(cache):
+  """Sets the cache index page listings are looked up in.
+
+  Args:
+    cache: a cb_listing_cache.ListingCache object, None to always fetch
+  """
+  global _listing_cache
+  _listing_cache = cache
+
+
+def SetGsIndex(index):
+  """Sets the index gs:// listings are answered from.
+
+  Args:
+    index: a cb_gs_index.GsIndex object, None to list each directory
+  """
+  global _gs_index
+  _gs_index = index
+
+
+def SetArtifactStore(store):
+  """Sets the store downloads are reused from and added to.
+
+  Downloads are hashed with SHA-256 as well as MD5 only while a store,
+  which keys artifacts on SHA-256, is set.
+
+  Args:
+    store: a cb_artifact_store.ArtifactStore object, None to always download
+  """
+  global _artifact_store
+  _artifact_store = store
+  ConfigureDownloads(algorithms=STORE_DIGEST_ALGORITHMS if store
+                     else DIGEST_ALGORITHMS)
+
+
+def SetCatalog(catalog):
+  """Sets the artifact catalog release directories are looked up in.
+
+  Args:
+    catalog: a cb_catalog.ArtifactCatalog object, None to always list
+  """
+  global _catalog
+  _catalog = catalog
+
+
+def _FetchGsListing(url, etag=None, last_modified=None):
+  """Lists files matching a gs:// URL with 'gsutil ls'.
+
+  With a gs index set, the listing is answered from it instead, listing
+  the whole board/channel at most once.
+
+  gsutil has no conditional listing, so validators are ignored.
+
+  Args:
+    url: gs:// URL, may end with a wildcard
+    etag: ignored
+    last_modified: ignored
+  Returns:
+    a tuple (links, None, None), links being a list of gs:// URLs
+  Raises:
+    IOError when gsutil fails
+  """
+  if _gs_index:
+    return (_gs_index.List(url), None, None)
+  result = RunCommand(['gsutil', 'ls', url], redirect_stdout=True,
+                      redirect_stderr=True)
+  if result.returncode:
+    msg = ('Error fetching index page for %s: stdout = %r, stderr = %r' %
+           (url, result.output, result.error))
+    logging.error(msg)
+    raise IOError(msg)
+  return (result.output.split('\n'), None, None)
+
+
+def _ParsePage(usock, parser):
+  """Feed an opened page to a UrlLister as it arrives, until it is done.
+
+  Args:
+    usock: a file object, the opened page
+    parser: a UrlLister
+  Returns:
+    the parser, closed
+  """
+  while not parser.done:
+    chunk = usock.read(LISTING_CHUNK_SIZE)
+    if not chunk:
+      break
+    parser.feed(chunk)
+  parser.close()
+  return parser
+
+
+def _FetchHttpListing(url, etag=None, last_modified=None):
+  """Lists the hyperlinks of an html index page.
+
+  Given the validators of a previous listing, the page is only fetched if
+  it changed since.
+
+  Args:
+    url: html page to list
+    etag: optional, ETag of the page when last listed
+    last_modified: optional, Last-Modified of the page when last listed
+  Returns:
+    None if the page is unchanged, else a tuple (links, etag, last_modified)
+  Raises:
+    IOError when the page cannot be fetched
+  """
+  if etag or last_modified:
+    headers = {}
+    if etag:
+      headers['If-None-Match'] = etag
+    if last_modified:
+      headers['If-Modified-Since'] = last_modified
+    try:
+      usock = OpenUrl(url, headers=headers)
+    except urllib2.HTTPError as e:
+      if e.code == 304:
+        return None
+      raise
+  else:
+    usock = OpenUrl(url)
+  parser = _ParsePage(usock, UrlLister())
+  info = getattr(usock, 'info', None)
+  headers = info() if info else None
+  usock.close()
+  if not headers:
+    return (parser.urls, None, None)
+  return (parser.urls, headers.getheader('ETag'),
+          headers.getheader('Last-Modified'))
+
+
+def _FetchFileListing(url, etag=None, last_modified=None):
+  """Lists a local directory, e.g. of a mirror, as its index page would.
+
+  Args:
+    url: file:// URL of a directory
+    etag: ignored
+    last_modified: ignored
+  Returns:
+    a tuple (links, None, None), links being relative, with a trailing
+    slash for directories
+  Raises:
+    IOError when the directory cannot be listed
+  """
+  path = LocalPath(url)
+  try:
+    names = sorted(os.listdir(path))
+  except OSError as e:
+    raise IOError('Could not list %s: %s' % (url, e))
+  return ([name + '/' if os.path.isdir(os.path.join(path, name)) else name
+           for name in names], None, None)
+
+
+def ListUrls(url):
+  """Returns the links listed at an index URL, using the listing cache.
+
+  A URL with a mirror, see cb_transport, is listed from the mirror; a
+  file:// mirror is listed as a directory.
+
+  Args:
+    url: html page, or gs:// URL to list with gsutil
+  Returns:
+    a list of strings, links as listed, relative for html pages
+  Raises:
+    IOError when the listing cannot be fetched
+  """
+  source = Rewrite(url)
+  if source.startswith(IMAGE_GSD_BUCKET):
+    fetch = lambda *validators: _FetchGsListing(url, *validators)
+  elif source.startswith('file://'):
+    fetch = lambda *validators: _FetchFileListing(source, *validators)
+  else:
+    fetch = lambda *validators: _FetchHttpListing(url, *validators)
+  if _listing_cache:
+    return _listing_cache.Get(url, fetch)
+  return fetch(None, None)[0]
+
+
 def DetermineUrl(url, token_list):
   """Return an exact URL linked from a page given a token_list to match.
 
@@ -103,34 +381,179 @@ def DetermineUrl(url, token_list):
   Returns:
     a string, an exact URL, or None if URL not present or link not found.
   """
-  logging.debug('DetermineUrl(): HTTP url = %r', url)
+  return DetermineUrls(url, [token_list])[0]
+
+
+def DetermineUrls(url, token_lists):
+  """Return the exact URLs linked from a page matching several token_lists.
+
+  The page is listed once and matched against all token_lists in a single
+  pass; see DetermineUrl for how each token_list is matched.
+
+  With an artifact catalog set, a release directory it holds is resolved
+  from it without listing; a directory listed because a token_list had no
+  match in the catalog is catalogued again.
+
+  Listings are shared through the listing cache, if any, so looking up
+  several files on one index page fetches it only once. Without a cache,
+  an html page is only read until a second link matching a lone token_list
+  shows that the match is ambiguous.
+
+  Args:
+    url: html page with a relative file links.
+    token_lists: a list of token_lists, see DetermineUrl() docstring.
+
+  Returns:
+    a list holding for each token_list an exact URL, or None if URL not
+    present or link not found.
+  """
+  logging.debug('DetermineUrls(): HTTP url = %r', url)
+  matcher = UrlMatcher(token_lists)
+  if _catalog:
+    links = matcher.Match(_catalog.Listing(url))
+    if all(links):
+      logging.debug('DetermineUrls(): %r resolved from catalog', url)
+      return links
+  index_url = url
   try:
-    if url.startswith(IMAGE_GSD_PREFIX):
-      http_url = url
-      url = _ConvertHttpToGsUrl(http_url)
-      logging.debug('DetermineUrl(): gs URL = %r', url)
-      result = RunCommand(['gsutil', 'ls', url], redirect_stdout=True,
-                          redirect_stderr=True)
-      if result.returncode:
-        msg = ('Error fetching index page for %s: stdout = %r, stderr = %r' %
-               (http_url, result.output, result.error))
-        logging.error(msg)
-      else:
-        return MatchUrl(result.output.split('\n'), token_list)
+    if url.startswith(IMAGE_GSD_PREFIX) and Rewrite(url) == url:
+      url = _ConvertHttpToGsUrl(index_url)
+      logging.debug('DetermineUrls(): gs URL = %r', url)
+      links = ListUrls(url)
+    elif _listing_cache or _catalog or Rewrite(url).startswith('file://'):
+      links = [os.path.join(url, link) for link in ListUrls(url)]
     else:
-      usock = urllib.urlopen(url)
-      htmlformatter = formatter.NullFormatter()
-      parser = UrlLister(htmlformatter)
-      parser.feed(usock.read())
+      # with no listing to share, only keep the matching links
+      usock = OpenUrl(url)
+      limit = 2 if len(token_lists) == 1 else None
+      parser = _ParsePage(usock, UrlLister(accept=matcher.Accepts,
+                                           limit=limit))
       usock.close()
-      parser.close()
-      link = MatchUrl(parser.urls, token_list)
-      if link:
-        return os.path.join(url, link)
+      links = [os.path.join(url, link) for link in parser.urls]
+    if _catalog:
+      _catalog.AddListing(index_url, [link for link in links if link])
+    return matcher.Match(links)
   except IOError:
     logging.warning('Could not open %s.', url)
 
-  return None
+  return [None] * len(token_lists)
+
+
+def _CompileTokens(token_list):
+  """Returns the compiled file name pattern of a token_list.
+
+  Compiled patterns are memoized, callers match the same few token_lists
+  against every listing.
+
+  Args:
+    token_list: a list of strings, see DetermineUrl() docstring.
+  Returns:
+    a compiled regular expression matching whole lower-cased file names
+  """
+  pattern = '*'.join(token_list)
+  regex = _compiled_tokens.get(pattern)
+  if not regex:
+    if len(_compiled_tokens) >= MAX_COMPILED_TOKENS:
+      _compiled_tokens.clear()
+    regex = re.compile(fnmatch.translate(pattern))
+    _compiled_tokens[pattern] = regex
+  return regex
+
+
+def _MatchesTokens(url, token_list):
+  """Returns True when the file name of a URL matches a token_list.
+
+  Args:
+    url: a string, a full or relative URL
+    token_list: a list of strings, see DetermineUrl() docstring.
+  """
+  return bool(_CompileTokens(token_list).match(
+      os.path.basename(url).lower()))
+
+
+class UrlMatcher(object):
+
+  """Match URLs against several token_lists in a single pass over a listing.
+
+  It contains the following fields:
+  - token_lists: the token_lists matched, see DetermineUrl() docstring
+
+  A file name only matches a token_list when it starts with its first
+  token, so token_lists are bucketed by first token and each URL is only
+  tested against those whose first token it starts with. A pass thus costs
+  time linear in the listing size rather than in listing size times
+  token_lists. An empty token_list matches nothing, as in MatchUrl.
+  """
+
+  def __init__(self, token_lists):
+    self.token_lists = [list(token_list) for token_list in token_lists]
+    # first token length -> first token -> [(token_list index, regex)]
+    self._buckets = {}
+    # token_lists whose first token holds glob characters
+    self._unbucketed = []
+    for index, token_list in enumerate(self.token_lists):
+      if not token_list:
+        continue
+      entry = (index, _CompileTokens(token_list))
+      lead = token_list[0]
+      if _GLOB_CHARS_RE.search(lead):
+        self._unbucketed.append(entry)
+      else:
+        self._buckets.setdefault(len(lead), {}).setdefault(
+            lead, []).append(entry)
+
+  def _Candidates(self, filename):
+    """Returns the (index, regex) pairs a lower-cased file name may match."""
+    candidates = list(self._unbucketed)
+    for length, bucket in self._buckets.iteritems():
+      candidates.extend(bucket.get(filename[:length], []))
+    return candidates
+
+  def Accepts(self, url):
+    """Returns True when a URL matches any of the token_lists.
+
+    Args:
+      url: a string, a full or relative URL
+    """
+    filename = os.path.basename(url).lower()
+    return any(regex.match(filename)
+               for _, regex in self._Candidates(filename))
+
+  def MatchAll(self, url_list):
+    """Returns every URL matching each token_list.
+
+    Args:
+      url_list: a list of strings (full or relative URLs).
+    Returns:
+      a list holding for each token_list the list of matching URLs, in
+      url_list order
+    """
+    matches = [[] for _ in self.token_lists]
+    for url in url_list or []:
+      filename = os.path.basename(url).lower()
+      for index, regex in self._Candidates(filename):
+        if regex.match(filename):
+          matches[index].append(url)
+    return matches
+
+  def Match(self, url_list):
+    """Returns the first URL matching each token_list.
+
+    A warning is logged for each token_list matching more than one URL.
+
+    Args:
+      url_list: a list of strings (full or relative URLs).
+    Returns:
+      a list holding for each token_list its first matching URL, or None
+    """
+    first_matches = []
+    for token_list, match_list in zip(self.token_lists,
+                                      self.MatchAll(url_list)):
+      if len(match_list) > 1:
+        logging.warning('MatchUrl(): token_list %r matches multiple urls (%r)',
+                        token_list, match_list)
+      first_matches.append(match_list[0] if match_list else None)
+    return first_matches
 
 
 def MatchUrl(url_list, token_list):
@@ -146,7 +569,8 @@ def MatchUrl(url_list, token_list):
   our script).
 
   If more than one URL is found to match, only the first match is returned
-  and a warning is logged.
+  and a warning is logged. See UrlMatcher to match several token_lists at
+  once.
 
   Args:
     url_list: a list of strings (full URLs).
@@ -157,57 +581,163 @@ def MatchUrl(url_list, token_list):
   """
   if not url_list or not token_list:
     return None
+  return UrlMatcher([token_list]).Match(url_list)[0]
 
-  match_list = []
 
-  for url in url_list:
-    filename = os.path.basename(url)
-    if fnmatch.fnmatch(filename.lower(), '*'.join(token_list)):
-      match_list.append(url)
+def DownloadWithDigests(url, promote=True, path=None):
+  """Copy the contents of a file from a given URL to a local file.
 
-  if not match_list:
-    return None
+  Local file stored in a tmp dir specified in "cb_constants.WORKDIR" variable,
+  unless another directory is given. If local file exists, it will be
+  overwritten by default.
 
-  if len(match_list) > 1:
-    logging.warning('MatchUrl(): token_list %r matches multiple urls (%r)',
-                    token_list, match_list)
-  return match_list[0]
+  The file is streamed to disk in bounded chunks and hashed inline, so
+  verifying it needs no second read. Google Storage URLs are fetched through
+  a 'gsutil cat' pipe, large HTTP files as concurrent byte ranges. Data is
+  written to <local file>.partial, with a journal of the byte ranges on disk,
+  and renamed over the local file only once complete. An interrupted
+  download is resumed from its journal by the next attempt. The digests are
+  also recorded in the digest cache, if any.
 
+  With an artifact store set, a URL it holds is copied from it rather than
+  downloaded, provided the MD5 published in <url>.md5 still matches, and
+  promoted downloads are added to it.
 
-def Download(url):
-  """Copy the contents of a file from a given URL to a local file.
-
-  Local file stored in a tmp dir specified in "cb_constants.WORKDIR" variable.
-  If local file exists, it will be overwritten by default.
+  The local file is locked while downloaded, see cb_lock_lib. A run that
+  waited for another to download it reuses that download.
 
   Modified from code.activestate.com/recipes/496685-downloading-a-file-from-
   the-web/
 
   Args:
     url: online location of file to download
+    promote: False to leave the complete file under its partial name, for
+             the caller to verify then PromoteDownload or DiscardDownload
+    path: optional, directory to download to, WORKDIR by default
   Returns:
-    a boolean, True only when file is fully downloaded
+    a dict mapping algorithm name to hexdigest of the file, None on failure
   """
-  local_file_name = os.path.join(WORKDIR, os.path.basename(url))
+  local_file_name = os.path.join(path or WORKDIR, os.path.basename(url))
+  with FileLock(local_file_name) as lock:
+    if promote and lock.waited and os.path.exists(local_file_name):
+      logging.info('Reusing %s downloaded by another run.', local_file_name)
+      try:
+        return GenerateDigests(local_file_name, DownloadDigests())
+      except IOError:
+        logging.info('Could not read %s, downloading it again.',
+                     local_file_name)
+    return _DownloadWithDigests(url, local_file_name, promote)
+
+
+def _PublishedMd5(url):
+  """Returns the MD5 hexdigest published for a URL in <url>.md5.
+
+  Args:
+    url: online location of a file
+  Returns:
+    a string, None when no MD5 is published or it cannot be fetched
+  """
+  if url.endswith('.md5'):
+    return None
   try:
-    if url.startswith(IMAGE_GSD_BUCKET):
-      result = RunCommand(['gsutil', 'cp', url, local_file_name],
-                          redirect_stdout=True, redirect_stderr=True)
-      if not result.returncode:
-        return True
-
-      msg = ('Error fetching image %s: stdout = %r, stderr = %r' %
-             (url, result.output, result.error))
-      logging.error(msg)
+    md5_file = OpenUrl(url + '.md5')
+    try:
+      fields = md5_file.read(1024).split()
+    finally:
+      md5_file.close()
+  except (IOError, OSError) as e:
+    logging.debug('No MD5 published for %s: %s', url, e)
+    return None
+  return fields[0] if fields else None
+
+
+def _DownloadWithDigests(url, local_file_name, promote):
+  """Download a file, see DownloadWithDigests, holding its lock.
+
+  Args:
+    url: online location of file to download
+    local_file_name: name to download the file to
+    promote: see DownloadWithDigests
+  Returns:
+    a dict mapping algorithm name to hexdigest of the file, None on failure
+  """
+  # an artifact is only reused while the server still publishes its MD5
+  md5 = _PublishedMd5(url) if _artifact_store else None
+  if md5:
+    target = local_file_name if promote else PartialName(local_file_name)
+    digests = _artifact_store.Fetch(url, target, md5=md5)
+    if digests:
+      if promote:
+        # leftovers of an earlier, interrupted download
+        DiscardDownload(local_file_name)
+      return digests
+  try:
+    if Rewrite(url).startswith(IMAGE_GSD_BUCKET):
+      digests = FetchGs(url, local_file_name)
     else:
-      with contextlib.closing(urllib.urlopen(url)) as web_file:
-        with open(local_file_name, 'w') as local_file:
-          local_file.write(web_file.read())
-          return True
-  except IOError:
-    logging.warning('Could not open %s or writing local file failed.', url)
+      digests = FetchHttp(url, local_file_name)
+    if promote:
+      PromoteDownload(local_file_name)
+  except (IOError, OSError) as e:
+    logging.warning('Could not open %s or writing local file failed: %s',
+                    url, e)
+    return None
 
-  return False
+  if promote:
+    RecordDigests(local_file_name, digests)
+    if _artifact_store and not url.endswith('.md5'):
+      _artifact_store.Add(url, local_file_name, digests)
+  return digests
+
+
+def Download(url, path=None):
+  """Copy the contents of a file from a given URL to a local file.
+
+  See DownloadWithDigests, whose digests this discards.
+
+  Args:
+    url: online location of file to download
+    path: optional, directory to download to, WORKDIR by default
+  Returns:
+    a boolean, True only when file is fully downloaded
+  """
+  return DownloadWithDigests(url, path=path) is not None
+
+
+def ZipExtractUrl(url, filename, path=WORKDIR):
+  """Extract a file from a zip archive online.
+
+  Over HTTP, or from a file:// mirror, only the archive's directory and
+  the file are fetched, see FetchZipMember. The whole archive is
+  downloaded to WORKDIR instead when the server ignores range requests or
+  the remote read fails, and for gs:// URLs. The extracted file is locked
+  while extracted; a run that waited for another to extract it reuses it.
+
+  Args:
+    url: online location of the zip archive
+    filename: name of the file to extract
+    path: optional name of directory to extract file to
+  Returns:
+    a boolean, True only when the file is successfully extracted
+  """
+  target = os.path.join(path, filename)
+  with FileLock(target) as lock:
+    if lock.waited and os.path.exists(target):
+      logging.info('Reusing %s extracted by another run.', target)
+      return True
+    transport = TransportFor(url)
+    if transport and transport.ranges:
+      try:
+        if not os.path.isdir(os.path.dirname(target)):
+          os.makedirs(os.path.dirname(target))
+        return FetchZipMember(url, filename, target)
+      except (IOError, OSError, zipfile.BadZipfile) as e:
+        logging.info('Could not extract %s from %s remotely, downloading '
+                     'the archive: %s', filename, url, e)
+    if not Download(url):
+      return False
+    return ZipExtract(os.path.join(WORKDIR, os.path.basename(url)), filename,
+                      path=path)
 
 
 def DetermineThenDownloadCheckMd5(url, token_list, path, desc):
@@ -252,6 +782,10 @@ def DownloadCheckMd5(url, path, desc):
 
   Assuming a golden md5 is available from <resource_url>.md5
   Also checks if the resource is already locally present with an MD5 to check.
+  The resource only gets its final name once its MD5 matches, a corrupt
+  download is discarded rather than resumed. The resource is locked
+  throughout, so a run waiting for another to fetch it finds it present
+  with a good MD5 and skips the fetch.
 
   Args:
     url: url at which resource can be downloaded
@@ -263,16 +797,25 @@ def DownloadCheckMd5(url, path, desc):
     BundlingError when resources cannot be fetched or download integrity fails.
   """
   name = os.path.join(path, os.path.basename(url))
-  if CheckResourceExistsWithMd5(name, name + '.md5'):
-    logging.info('Resource %s already exists with good MD5, skipping fetch.',
-                 name)
-  else:
-    logging.info('Downloading ' + url)
-    if not Download(url):
-      raise BundlingError(desc + ' could not be fetched.')
-    if not Download(url + '.md5'):
-      raise BundlingError(desc + ' MD5 could not be fetched.')
-    if not CheckMd5(name, name + '.md5'):
-      raise BundlingError(desc + ' MD5 checksum does not match.')
-    logging.debug('MD5 checksum match succeeded for %s', name)
+  with FileLock(name):
+    if CheckResourceExistsWithMd5(name, name + '.md5'):
+      logging.info('Resource %s already exists with good MD5, skipping fetch.',
+                   name)
+    else:
+      logging.info('Downloading ' + url)
+      digests = DownloadWithDigests(url, promote=False, path=path)
+      if not digests:
+        raise BundlingError(desc + ' could not be fetched.')
+      if not Download(url + '.md5', path=path):
+        raise BundlingError(desc + ' MD5 could not be fetched.')
+      if not CheckMd5(PartialName(name), name + '.md5', md5sum=digests['md5']):
+        DiscardDownload(name)
+        raise BundlingError(desc + ' MD5 checksum does not match.')
+      logging.debug('MD5 checksum match succeeded for %s', name)
+      PromoteDownload(name)
+      RecordDigests(name, digests)
+      if _artifact_store:
+        _artifact_store.Add(url, name, digests)
+      if _catalog:
+        _catalog.RecordChecksum(url, os.path.getsize(name), digests['md5'])
   return name
@@ -5,33 +5,60 @@
 
 """Unit tests for the cb_url_lib module."""
 
+import cb_download_lib
+import cb_transport
 import cb_url_lib
-import formatter
+import hashlib
 import logging
 import mox
 import os
+import shutil
+import StringIO
 import unittest
-import urllib
 import tempfile
+import zipfile
 
 from cb_constants import BundlingError, IMAGE_GSD_BUCKET, IMAGE_GSD_PREFIX
+from cb_listing_cache import ListingCache
+from cb_test_http_server import StandInServer
 from cb_util import CommandResult
 
-from mox import IsA
 
 _LINK_NAME = 'href_atrribute/of_a_link'
 
 
+class _FakeInfo(object):
+  """Stands in for the headers of an opened URL."""
+
+  def __init__(self, length):
+    self.length = length
+
+  def getheader(self, name):
+    if name == 'Content-Length':
+      return str(self.length)
+    return None
+
+
+class _FakeProcess(object):
+  """Stands in for a subprocess.Popen object streaming its stdout."""
+
+  def __init__(self, stdout, returncode):
+    self.stdout = stdout
+    self.returncode = None
+    self._returncode = returncode
+
+  def wait(self):
+    self.returncode = self._returncode
+    return self.returncode
+
+
 class UrlListerTest(unittest.TestCase):
   """Unit tests for the UrlLister class."""
 
-  def setUp(self):
-    self.givenformatter = formatter.NullFormatter()
-
   def testReset(self):
     """Tests the reset method of class UrlLister."""
     with open('testdata/test_page_one_link.html', 'r') as page:
-      parser = cb_url_lib.UrlLister(self.givenformatter)
+      parser = cb_url_lib.UrlLister()
       parser.urls = ['a_fake_link', 'another_fake_link']
       parser.reset()
       parser.feed(page.read())
@@ -41,7 +68,7 @@ class UrlListerTest(unittest.TestCase):
   def testStart_aNoLinks(self):
     """Verify behavior when no links exist on given page."""
     with open('testdata/test_page_no_links.html', 'r') as page:
-      parser = cb_url_lib.UrlLister(self.givenformatter)
+      parser = cb_url_lib.UrlLister()
       parser.feed(page.read())
       parser.close()
       self.assertEqual([], parser.urls)
@@ -49,7 +76,7 @@ class UrlListerTest(unittest.TestCase):
   def testStart_aOneLink(self):
     """Verify parsing when one link present."""
     with open('testdata/test_page_one_link.html', 'r') as page:
-      parser = cb_url_lib.UrlLister(self.givenformatter)
+      parser = cb_url_lib.UrlLister()
       parser.feed(page.read())
       parser.close()
       self.assertEqual([_LINK_NAME], parser.urls)
@@ -57,7 +84,7 @@ class UrlListerTest(unittest.TestCase):
   def testStart_aManyLinks(self):
     """Verify parsing when many links present."""
     with open('testdata/test_page_many_links.html', 'r') as page:
-      parser = cb_url_lib.UrlLister(self.givenformatter)
+      parser = cb_url_lib.UrlLister()
       parser.feed(page.read())
       parser.close()
       # sample page links taken from real chromeos-images index page
@@ -67,13 +94,59 @@ class UrlListerTest(unittest.TestCase):
       actual = parser.urls
       self.assertEqual(expected, actual)
 
+  def testChunkBoundaries(self):
+    """Verify the same links are found however the page is split."""
+    with open('testdata/test_page_many_links.html', 'r') as page:
+      content = page.read()
+    whole = cb_url_lib.UrlLister()
+    whole.feed(content)
+    whole.close()
+    for size in [1, 2, 3, 7, 64]:
+      parser = cb_url_lib.UrlLister()
+      for start in range(0, len(content), size):
+        parser.feed(content[start:start + size])
+      parser.close()
+      self.assertEqual(whole.urls, parser.urls)
+
+  def testAttributeForms(self):
+    """Verify quoting, case, entities and comments are handled."""
+    parser = cb_url_lib.UrlLister()
+    parser.feed('<A class="x" HREF=\'single.bin\'>s</A>'
+                '<a href=bare.bin>b</a><a\nhref="a&amp;b.bin">e</a>'
+                '<!-- <a href="commented.bin">c</a> -->'
+                '<a name="no_href">n</a><area href="not_anchor.bin">')
+    parser.close()
+    self.assertEqual(['single.bin', 'bare.bin', 'a&b.bin'], parser.urls)
+
+  def testCommentAcrossChunks(self):
+    """Verify anchors in a comment split across chunks are ignored."""
+    for chunks in [['<!-- <a href="commented.bin">', ' --><a href="a.bin">'],
+                   ['<!-- <a href="comm', 'ented.bin"> -', '-><a href="a.bin">'],
+                   ['<!', '-- <a href="commented.bin"> --><a href="a.bin">']]:
+      parser = cb_url_lib.UrlLister()
+      for chunk in chunks:
+        parser.feed(chunk)
+      parser.close()
+      self.assertEqual(['a.bin'], parser.urls)
+
+  def testAcceptAndLimit(self):
+    """Verify only accepted links are kept and parsing stops at limit."""
+    parser = cb_url_lib.UrlLister(accept=lambda href: href.endswith('.zip'),
+                                  limit=1)
+    with open('testdata/test_page_many_links.html', 'r') as page:
+      parser.feed(page.read())
+    self.assertTrue(parser.done)
+    parser.feed('<a href="later.zip">')
+    self.assertEqual(['ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip'],
+                     parser.urls)
+
 
 class TestDetermineUrl(mox.MoxTestBase):
   """Unit tests related to DetermineUrl."""
 
   def setUp(self):
     self.mox = mox.Mox()
-    self.mox.StubOutWithMock(urllib, 'urlopen')
+    self.mox.StubOutWithMock(cb_url_lib, 'OpenUrl')
     self.mox.StubOutWithMock(cb_url_lib, 'RunCommand')
     self.url = 'test_url'
     self.pattern = ['chromeos', '.zip']
@@ -84,7 +157,7 @@ class TestDetermineUrl(mox.MoxTestBase):
   def testHttpUrlGood(self):
     """Verify URL returned when page opens properly."""
     with open('testdata/test_page_many_links.html', 'r') as test_page:
-      urllib.urlopen('test_url').AndReturn(test_page)
+      cb_url_lib.OpenUrl('test_url').AndReturn(test_page)
       self.mox.ReplayAll()
       expected = 'test_url/ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip'
       actual = cb_url_lib.DetermineUrl(self.url, self.pattern)
@@ -92,7 +165,7 @@ class TestDetermineUrl(mox.MoxTestBase):
 
   def testHttpUrlBad(self):
     """Verify None returned when page fails to open properly."""
-    urllib.urlopen('test_url').AndRaise(IOError)
+    cb_url_lib.OpenUrl('test_url').AndRaise(IOError)
     self.mox.ReplayAll()
     actual = cb_url_lib.DetermineUrl(self.url, self.pattern)
     self.assertEqual(None, actual)
@@ -100,7 +173,7 @@ class TestDetermineUrl(mox.MoxTestBase):
   def testHttpUrlNoMatch(self):
     """Verify None returned when MatchUrl() returns None."""
     with open('testdata/test_page_no_links.html', 'r') as test_page:
-      urllib.urlopen('test_url').AndReturn(test_page)
+      cb_url_lib.OpenUrl('test_url').AndReturn(test_page)
       self.mox.ReplayAll()
       actual = cb_url_lib.DetermineUrl(self.url, self.pattern)
       self.assertEqual(None, actual)
@@ -146,6 +219,120 @@ class TestDetermineUrl(mox.MoxTestBase):
     self.assertEqual(None, actual)
 
 
+class TestDetermineUrlWithListingCache(unittest.TestCase):
+  """Unit tests related to DetermineUrl sharing listings."""
+
+  def setUp(self):
+    with open('testdata/test_page_many_links.html', 'r') as test_page:
+      self.page = test_page.read()
+    self.server = StandInServer({'/index': self.page}, etag='"v1"').Start()
+    self.url = self.server.url + '/index'
+    self.test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.server.Stop()
+    cb_url_lib.SetListingCache(None)
+    shutil.rmtree(self.test_dir)
+
+  def testListingShared(self):
+    """Verify lookups of several files on one page fetch it once."""
+    cb_url_lib.SetListingCache(ListingCache())
+    self.assertEqual(
+        self.url + '/ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip',
+        cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(None, cb_url_lib.DetermineUrl(self.url, ['none', '.x']))
+    self.assertEqual(1, len(self.server.requests))
+
+  def testStaleListingRevalidated(self):
+    """Verify an expired listing of an earlier run is revalidated."""
+    cache_name = os.path.join(self.test_dir, 'listing_cache.json')
+    cb_url_lib.SetListingCache(ListingCache(cache_name))
+    first = cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip'])
+    cb_url_lib.SetListingCache(ListingCache(cache_name, ttl=0))
+    self.server.files['/index'] = ''
+    self.assertEqual(first,
+                     cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(first,
+                     cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip']))
+    self.assertEqual(2, len(self.server.requests))
+
+  def testNoCache(self):
+    """Verify every lookup fetches the page without a cache."""
+    cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip'])
+    cb_url_lib.DetermineUrl(self.url, ['chromeos', '.zip'])
+    self.assertEqual(2, len(self.server.requests))
+
+
+class TestUrlMatcher(unittest.TestCase):
+  """Unit tests related to UrlMatcher."""
+
+  def setUp(self):
+    self.listing = [
+        'gs://b/dev-channel/stumpy/1.0/ChromeOS-factory-1.0-stumpy.zip',
+        'gs://b/dev-channel/stumpy/1.0/chromeos_1.0_stumpy_recovery_mp.bin',
+        'gs://b/dev-channel/stumpy/1.0/chromeos_1.0_stumpy_ssd_mp.bin',
+        'gs://b/dev-channel/stumpy/1.0/chromeos_1.0_stumpy_factory_mp.bin',
+        'gs://b/dev-channel/stumpy/1.0/chromeos_1.0_stumpy_ssd_mp.bin.md5']
+    self.token_lists = [['chromeos', 'recovery', '.bin'],
+                        ['chromeos', 'ssd', '.bin'],
+                        ['chromeos-factory', 'stumpy', '.zip'],
+                        ['chromeos', 'stumpy', 'factory', '.bin'],
+                        ['chromeos', 'missing', '.bin']]
+
+  def testAllMatchesPerTokenList(self):
+    """Verify one pass finds every match of every token_list in order."""
+    matches = cb_url_lib.UrlMatcher(self.token_lists).MatchAll(self.listing)
+    self.assertEqual([[self.listing[1]], [self.listing[2]], [self.listing[0]],
+                      [self.listing[3]], []], matches)
+
+  def testMatchSameAsMatchUrl(self):
+    """Verify first matches agree with MatchUrl for each token_list."""
+    self.token_lists.append(['chromeos', '.bin'])
+    self.assertEqual(
+        [cb_url_lib.MatchUrl(self.listing, t) for t in self.token_lists],
+        cb_url_lib.UrlMatcher(self.token_lists).Match(self.listing))
+
+  def testGlobAndEmptyTokenLists(self):
+    """Verify leading glob tokens match and empty token_lists do not."""
+    matcher = cb_url_lib.UrlMatcher([['*factory', '.zip'], []])
+    self.assertEqual([self.listing[0], None], matcher.Match(self.listing))
+
+  def testCandidatesBoundedByFirstToken(self):
+    """Verify a URL is only tested against token_lists it may match."""
+    token_lists = [['board%d_' % index, '.bin'] for index in range(200)]
+    matcher = cb_url_lib.UrlMatcher(token_lists)
+    self.assertEqual(1, len(matcher._Candidates('board17_image.bin')))
+    self.assertEqual(0, len(matcher._Candidates('other.bin')))
+
+
+class TestDetermineUrls(mox.MoxTestBase):
+  """Unit tests related to DetermineUrls."""
+
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.mox.StubOutWithMock(cb_url_lib, 'OpenUrl')
+
+  def testSeveralFilesOneFetch(self):
+    """Verify several token_lists are resolved from one page fetch."""
+    with open('testdata/test_page_many_links.html', 'r') as test_page:
+      cb_url_lib.OpenUrl('test_url').AndReturn(test_page)
+      self.mox.ReplayAll()
+      self.assertEqual(
+          ['test_url/ChromeOS-factory-0.12.433.269-r72d7eaa2-b198-x86-alex.zip',
+           None,
+           'test_url/ChromeOS-0.12.433.269-r72d7eaa2-b198-x86-alex.zip'],
+          cb_url_lib.DetermineUrls('test_url', [['chromeos-factory', '.zip'],
+                                                ['chromeos', '.bin'],
+                                                ['chromeos-0', '.zip']]))
+
+  def testFetchFails(self):
+    """Verify None for each token_list when the page cannot be opened."""
+    cb_url_lib.OpenUrl('test_url').AndRaise(IOError)
+    self.mox.ReplayAll()
+    self.assertEqual([None, None], cb_url_lib.DetermineUrls(
+        'test_url', [['a'], ['b']]))
+
+
 class TestMatchUrl(unittest.TestCase):
   """Unit tests related to MatchUrl."""
 
@@ -209,28 +396,36 @@ class TestDownload(mox.MoxTestBase):
 
   def setUp(self):
     self.mox = mox.Mox()
-    self.mox.StubOutWithMock(urllib, 'urlopen')
-    self.mox.StubOutWithMock(cb_url_lib, 'RunCommand')
+    # HTTP through OpenUrl, gs:// down to the gsutil command run
+    self.mox.StubOutWithMock(cb_transport, 'StartCommand')
+    self.work_dir = tempfile.mkdtemp()
+    self.mox.stubs.Set(cb_url_lib, 'WORKDIR', self.work_dir)
     self.url = 'test_url'
     self.gsd_url = IMAGE_GSD_BUCKET + self.url
-    self.named_file = tempfile.NamedTemporaryFile()
+    self.local_name = os.path.join(self.work_dir, self.url)
+    self.content = 'Some sample content for testing.'
     self.test_file = tempfile.TemporaryFile()
-    self.test_file.write('Some sample content for testing.')
+    self.test_file.write(self.content)
     self.test_file.seek(0) # must rewind file handle for read
-    # Stub out os.path AFTER creating temp files
-    self.mox.StubOutWithMock(os.path, 'join')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def _ExpectOpenUrl(self):
+    self.mox.StubOutWithMock(cb_download_lib, 'OpenUrl')
+    return cb_download_lib.OpenUrl('test_url')
 
   def testUrlGoodLocalFileOpenSucceeds(self):
     """Verify return value when page opens properly."""
-    os.path.join(IsA(str), IsA(str)).AndReturn(self.named_file.name)
-    urllib.urlopen('test_url').AndReturn(self.test_file)
+    self._ExpectOpenUrl().AndReturn(self.test_file)
     self.mox.ReplayAll()
     self.assertTrue(cb_url_lib.Download(self.url))
+    with open(self.local_name) as local_file:
+      self.assertEqual(self.content, local_file.read())
 
   def testUrlBad(self):
     """Verify clean return value when page does not open properly."""
-    os.path.join(IsA(str), IsA(str)).AndReturn('')
-    urllib.urlopen('test_url').AndRaise(IOError)
+    self._ExpectOpenUrl().AndRaise(IOError)
     self.mox.ReplayAll()
     expected = False
     actual = cb_url_lib.Download(self.url)
@@ -238,36 +433,210 @@ class TestDownload(mox.MoxTestBase):
 
   def testLocalFileOpenFails(self):
     """Verify clean return value when local file fails to open."""
-    os.path.join(IsA(str), IsA(str)).AndReturn('')
-    urllib.urlopen('test_url').AndReturn(self.test_file)
+    self.mox.stubs.Set(cb_url_lib, 'WORKDIR',
+                       os.path.join(self.work_dir, 'missing'))
+    self._ExpectOpenUrl().AndReturn(self.test_file)
+    self.mox.ReplayAll()
+    self.assertFalse(cb_url_lib.Download(self.url))
+
+  def testTruncatedDownloadKeepsOldFile(self):
+    """Verify a short download replaces no local file and can be resumed."""
+    with open(self.local_name, 'w') as old_file:
+      old_file.write('old')
+    web_file = StringIO.StringIO(self.content)
+    web_file.info = lambda: _FakeInfo(len(self.content) + 1)
+    self._ExpectOpenUrl().AndReturn(web_file)
     self.mox.ReplayAll()
     self.assertFalse(cb_url_lib.Download(self.url))
+    self.assertEqual(['test_url', 'test_url.partial',
+                      'test_url.partial.journal'],
+                     sorted(os.listdir(self.work_dir)))
+    journal = cb_download_lib.DownloadJournal(self.local_name, self.url)
+    self.assertEqual(len(self.content), journal.Prefix())
+    with open(self.local_name) as local_file:
+      self.assertEqual('old', local_file.read())
+
+  def testUrlGoodDigestsComputed(self):
+    """Verify digests of the downloaded bytes are returned."""
+    self._ExpectOpenUrl().AndReturn(self.test_file)
+    self.mox.ReplayAll()
+    digests = cb_url_lib.DownloadWithDigests(self.url)
+    self.assertEqual(hashlib.md5(self.content).hexdigest(), digests['md5'])
 
   def testGsdUrlGoodLocalFileOpenSucceeds(self):
     """Verify return value when GSD URL opens properly."""
-    test_result = CommandResult()
-    test_result.returncode = 0
-
-    os.path.join(IsA(str), IsA(str)).AndReturn(self.named_file.name)
-    cb_url_lib.RunCommand(
-        ['gsutil', 'cp', self.gsd_url, self.named_file.name],
-        redirect_stdout=True, redirect_stderr=True).AndReturn(test_result)
+    cb_transport.StartCommand(
+        ['gsutil', 'cat', self.gsd_url],
+        stderr=mox.IgnoreArg()).AndReturn(_FakeProcess(self.test_file, 0))
+    self.mox.ReplayAll()
+    digests = cb_url_lib.DownloadWithDigests(self.gsd_url)
+    self.assertEqual(hashlib.md5(self.content).hexdigest(), digests['md5'])
+    gsd_name = os.path.join(self.work_dir, os.path.basename(self.gsd_url))
+    with open(gsd_name) as local_file:
+      self.assertEqual(self.content, local_file.read())
+    self.assertEqual([os.path.basename(self.gsd_url)],
+                     os.listdir(self.work_dir))
+
+  def testGsdUrlResumed(self):
+    """Verify an interrupted gsutil download resumes at its journaled end."""
+    gsd_name = os.path.join(self.work_dir, os.path.basename(self.gsd_url))
+    journal = cb_download_lib.DownloadJournal(gsd_name, self.gsd_url)
+    journal.Reset(None, None)
+    with open(journal.partial_name, 'w') as partial:
+      partial.write(self.content[:10])
+    journal.Add(0, 10)
+    cb_transport.StartCommand(
+        ['gsutil', 'cat', '-r', '10-', self.gsd_url],
+        stderr=mox.IgnoreArg()).AndReturn(
+            _FakeProcess(StringIO.StringIO(self.content[10:]), 0))
     self.mox.ReplayAll()
-    self.assertTrue(cb_url_lib.Download(self.gsd_url))
+    digests = cb_url_lib.DownloadWithDigests(self.gsd_url)
+    self.assertEqual(hashlib.md5(self.content).hexdigest(), digests['md5'])
+    with open(gsd_name) as local_file:
+      self.assertEqual(self.content, local_file.read())
 
   def testGsdUrlFileCopyFails(self):
     """Verify return value when gsutil copy fails."""
-    test_result = CommandResult()
-    test_result.returncode = -1
-
-    os.path.join(IsA(str), IsA(str)).AndReturn(self.named_file.name)
-    cb_url_lib.RunCommand(
-        ['gsutil', 'cp', self.gsd_url, self.named_file.name],
-        redirect_stdout=True, redirect_stderr=True).AndReturn(test_result)
+    cb_transport.StartCommand(
+        ['gsutil', 'cat', self.gsd_url],
+        stderr=mox.IgnoreArg()).AndReturn(_FakeProcess(self.test_file, 1))
     self.mox.ReplayAll()
     self.assertFalse(cb_url_lib.Download(self.gsd_url))
 
 
+class TestDownloadFromServer(unittest.TestCase):
+  """Unit tests related to Download against a local HTTP server."""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.saved = (cb_url_lib.WORKDIR, cb_download_lib._connections,
+                  cb_download_lib._segment_size)
+    cb_url_lib.WORKDIR = self.work_dir
+    cb_download_lib.ConfigureDownloads(connections=3, segment_size=4096)
+    self.content = os.urandom(5 * 4096 + 7)
+    self.local_name = os.path.join(self.work_dir, 'image.bin')
+
+  def tearDown(self):
+    (cb_url_lib.WORKDIR, cb_download_lib._connections,
+     cb_download_lib._segment_size) = self.saved
+    shutil.rmtree(self.work_dir)
+
+  def _Download(self, ranges):
+    server = getattr(self, 'server', None) or StandInServer(
+        {'/image.bin': self.content}, ranges=ranges)
+    server.Start()
+    try:
+      digests = cb_url_lib.DownloadWithDigests(server.url + '/image.bin')
+    finally:
+      server.Stop()
+    self.assertEqual(hashlib.md5(self.content).hexdigest(), digests['md5'])
+    with open(self.local_name, 'rb') as local_file:
+      self.assertEqual(self.content, local_file.read())
+    return server.requests
+
+  def testSegmented(self):
+    """Verify a large file is fetched as concurrent byte ranges."""
+    requests = self._Download(True)
+    self.assertEqual(7, len(requests))
+
+  def testFallbackToSingleStream(self):
+    """Verify a server without Range support is read with one stream."""
+    requests = self._Download(False)
+    self.assertEqual(1, len(requests))
+
+  def testDownloadCheckMd5ElsewhereThanWorkdir(self):
+    """Verify a resource checked into another directory lands there."""
+    path = os.path.join(self.work_dir, 'elsewhere')
+    os.mkdir(path)
+    server = StandInServer(
+        {'/image.bin': self.content,
+         '/image.bin.md5': hashlib.md5(self.content).hexdigest()}).Start()
+    try:
+      name = cb_url_lib.DownloadCheckMd5(server.url + '/image.bin', path,
+                                         'image')
+    finally:
+      server.Stop()
+    self.assertEqual(os.path.join(path, 'image.bin'), name)
+    with open(name, 'rb') as local_file:
+      self.assertEqual(self.content, local_file.read())
+    self.assertFalse(os.path.exists(self.local_name))
+
+  def _Interrupt(self, content, validator='"v1"'):
+    """Leave a partial download holding content, as if killed."""
+    journal = cb_download_lib.DownloadJournal(self.local_name,
+                                              self.server.url + '/image.bin')
+    journal.Reset(len(self.content), validator)
+    with open(journal.partial_name, 'wb') as partial:
+      partial.write(content)
+    journal.Add(0, len(content))
+
+  def testStreamResumed(self):
+    """Verify a single stream download resumes with a conditional range."""
+    cb_download_lib.ConfigureDownloads(connections=1)
+    self.server = StandInServer({'/image.bin': self.content}, etag='"v1"')
+    self._Interrupt(self.content[:1000])
+    requests = self._Download(True)
+    self.assertEqual([('GET', '/image.bin', 'bytes=1000-')], requests)
+    self.assertEqual(['image.bin'], os.listdir(self.work_dir))
+
+  def testSegmentsResumed(self):
+    """Verify only segments missing from the journal are fetched again."""
+    self.server = StandInServer({'/image.bin': self.content}, etag='"v1"')
+    self._Interrupt(self.content[:2 * 4096])
+    requests = self._Download(True)
+    self.assertEqual(4, len(requests))
+    self.assertFalse(('GET', '/image.bin', 'bytes=0-4095') in requests)
+
+  def testChangedFileRestarted(self):
+    """Verify a partial download of an older version is started over."""
+    cb_download_lib.ConfigureDownloads(connections=1)
+    self.server = StandInServer({'/image.bin': self.content}, etag='"v2"')
+    self._Interrupt('x' * 1000)
+    requests = self._Download(True)
+    self.assertEqual([('GET', '/image.bin', 'bytes=1000-')], requests)
+
+
+class TestZipExtractUrl(unittest.TestCase):
+  """Unit tests related to ZipExtractUrl against a local HTTP server."""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.saved_workdir = cb_url_lib.WORKDIR
+    cb_url_lib.WORKDIR = self.work_dir
+    self.member = os.path.join('factory_test', 'chromiumos_factory_image.bin')
+    self.content = os.urandom(3000)
+    archive = StringIO.StringIO()
+    zpf = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+    zpf.writestr(self.member, self.content)
+    zpf.writestr('other.bin', os.urandom(100 * 1024))
+    zpf.close()
+    self.archive = archive.getvalue()
+
+  def tearDown(self):
+    self.server.Stop()
+    cb_url_lib.WORKDIR = self.saved_workdir
+    shutil.rmtree(self.work_dir)
+
+  def _Extract(self, ranges):
+    self.server = StandInServer({'/factory.zip': self.archive},
+                                ranges=ranges).Start()
+    self.assertTrue(cb_url_lib.ZipExtractUrl(
+        self.server.url + '/factory.zip', self.member, path=self.work_dir))
+    with open(os.path.join(self.work_dir, self.member), 'rb') as member:
+      self.assertEqual(self.content, member.read())
+
+  def testRemoteMember(self):
+    """Verify the member is extracted without downloading the archive."""
+    self._Extract(True)
+    self.assertEqual(['factory_test'], os.listdir(self.work_dir))
+
+  def testFallbackToDownload(self):
+    """Verify the archive is downloaded when Range is not supported."""
+    self._Extract(False)
+    self.assertTrue(os.path.exists(os.path.join(self.work_dir,
+                                                'factory.zip')))
+
+
 class TestDetermineThenDownloadCheckMd5(mox.MoxTestBase):
   """Unit tests related to DetermineThenDownloadCheckMd5."""
 
@@ -362,7 +731,9 @@ class TestDownloadCheckMd5(mox.MoxTestBase):
     self.path = 'path'
     self.desc = 'desc'
     self.name = 'path/file'
+    self.partial_name = 'path/file.partial'
     self.md5name = 'path/file.md5'
+    self.digests = {'md5': 'md5sum', 'sha256': 'sha256sum'}
 
   def testResourceExists(self):
     """Test behavior when resource exists with good MD5."""
@@ -376,12 +747,19 @@ class TestDownloadCheckMd5(mox.MoxTestBase):
   def testDownloadsCheckMd5Succeed(self):
     """Test behavior when fetch is entirely successful."""
     self.mox.StubOutWithMock(cb_url_lib, 'Download')
+    self.mox.StubOutWithMock(cb_url_lib, 'DownloadWithDigests')
     self.mox.StubOutWithMock(cb_url_lib, 'CheckMd5')
+    self.mox.StubOutWithMock(cb_url_lib, 'PromoteDownload')
+    self.mox.StubOutWithMock(cb_url_lib, 'RecordDigests')
     cb_url_lib.CheckResourceExistsWithMd5(self.name,
                                           self.md5name).AndReturn(False)
-    cb_url_lib.Download(self.url).AndReturn(True)
-    cb_url_lib.Download(self.md5url).AndReturn(True)
-    cb_url_lib.CheckMd5(self.name, self.md5name).AndReturn(True)
+    cb_url_lib.DownloadWithDigests(self.url, promote=False,
+                                   path=self.path).AndReturn(self.digests)
+    cb_url_lib.Download(self.md5url, path=self.path).AndReturn(True)
+    cb_url_lib.CheckMd5(self.partial_name, self.md5name,
+                        md5sum=self.digests['md5']).AndReturn(True)
+    cb_url_lib.PromoteDownload(self.name)
+    cb_url_lib.RecordDigests(self.name, self.digests)
     self.mox.ReplayAll()
     expected = self.name
     actual = cb_url_lib.DownloadCheckMd5(self.url, self.path, self.desc)
@@ -390,9 +768,11 @@ class TestDownloadCheckMd5(mox.MoxTestBase):
   def testFileDownloadFails(self):
     """Test behavior when file fetch fails."""
     self.mox.StubOutWithMock(cb_url_lib, 'Download')
+    self.mox.StubOutWithMock(cb_url_lib, 'DownloadWithDigests')
     cb_url_lib.CheckResourceExistsWithMd5(self.name,
                                           self.md5name).AndReturn(False)
-    cb_url_lib.Download(self.url).AndReturn(False)
+    cb_url_lib.DownloadWithDigests(self.url, promote=False,
+                                   path=self.path).AndReturn(None)
     self.mox.ReplayAll()
     self.assertRaises(BundlingError,
                       cb_url_lib.DownloadCheckMd5,
@@ -403,10 +783,12 @@ class TestDownloadCheckMd5(mox.MoxTestBase):
   def testMd5FileDownloadFails(self):
     """Test behavior when MD5 file fetch fails."""
     self.mox.StubOutWithMock(cb_url_lib, 'Download')
+    self.mox.StubOutWithMock(cb_url_lib, 'DownloadWithDigests')
     cb_url_lib.CheckResourceExistsWithMd5(self.name,
                                           self.md5name).AndReturn(False)
-    cb_url_lib.Download(self.url).AndReturn(True)
-    cb_url_lib.Download(self.md5url).AndReturn(False)
+    cb_url_lib.DownloadWithDigests(self.url, promote=False,
+                                   path=self.path).AndReturn(self.digests)
+    cb_url_lib.Download(self.md5url, path=self.path).AndReturn(False)
     self.mox.ReplayAll()
     self.assertRaises(BundlingError,
                       cb_url_lib.DownloadCheckMd5,
@@ -417,12 +799,17 @@ class TestDownloadCheckMd5(mox.MoxTestBase):
   def testMd5CheckFails(self):
     """Test behavior when MD5 check fails."""
     self.mox.StubOutWithMock(cb_url_lib, 'Download')
+    self.mox.StubOutWithMock(cb_url_lib, 'DownloadWithDigests')
     self.mox.StubOutWithMock(cb_url_lib, 'CheckMd5')
+    self.mox.StubOutWithMock(cb_url_lib, 'DiscardDownload')
     cb_url_lib.CheckResourceExistsWithMd5(self.name,
                                           self.md5name).AndReturn(False)
-    cb_url_lib.Download(self.url).AndReturn(True)
-    cb_url_lib.Download(self.md5url).AndReturn(True)
-    cb_url_lib.CheckMd5(self.name, self.md5name).AndReturn(False)
+    cb_url_lib.DownloadWithDigests(self.url, promote=False,
+                                   path=self.path).AndReturn(self.digests)
+    cb_url_lib.Download(self.md5url, path=self.path).AndReturn(True)
+    cb_url_lib.CheckMd5(self.partial_name, self.md5name,
+                        md5sum=self.digests['md5']).AndReturn(False)
+    cb_url_lib.DiscardDownload(self.name)
     self.mox.ReplayAll()
     self.assertRaises(BundlingError,
                       cb_url_lib.DownloadCheckMd5,
@@ -5,8 +5,13 @@
 
 """This module contains methods interfacing with pre-existing tools."""
 
+import ctypes
+import ctypes.util
+import json
 import logging
+import os
 import subprocess
+import tempfile
 
 from cb_constants import BundlingError
 
@@ -62,3 +67,104 @@ def RunCommand(cmd, redirect_stdout=False, redirect_stderr=False, cwd=None):
   (cmd_result.output, cmd_result.error) = proc.communicate()
   cmd_result.returncode = proc.returncode
   return cmd_result
+
+
+def StartCommand(cmd, stderr=None, cwd=None):
+  """Starts a command whose output is to be streamed through a pipe.
+
+  Unlike RunCommand this does not block: the caller reads the returned
+  process's stdout and then waits on it.
+
+  Args:
+    cmd: a list of arguments to Popen
+    stderr: optional file object to receive subprocess errors
+    cwd: working directory in which to run command
+  Returns:
+    a subprocess.Popen object with stdout piped.
+  Raises:
+    BundlingError when starting command fails.
+  """
+  logging.info('Running command: ' + ' '.join(cmd))
+  try:
+    return subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=stderr)
+  except OSError as (errno, strerror):
+    raise BundlingError('\n'.join(['OSError [%d] : %s' % (errno, strerror),
+                                   'OSError running cmd %s' % ' '.join(cmd)]))
+
+
+def LibcFunction(name, restype, argtypes):
+  """Returns a libc function as a ctypes function, None if missing.
+
+  The function sets errno, read back through ctypes.get_errno.
+
+  Args:
+    name: a string, name of the libc symbol
+    restype: the ctypes type it returns
+    argtypes: a list of the ctypes types of its arguments
+  """
+  libc_name = ctypes.util.find_library('c')
+  if not libc_name:
+    return None
+  try:
+    function = getattr(ctypes.CDLL(libc_name, use_errno=True), name)
+  except (AttributeError, OSError):
+    return None
+  function.restype = restype
+  function.argtypes = argtypes
+  return function
+
+
+def LoadJson(path, description):
+  """Returns the dict stored in a JSON file, empty if none or unreadable.
+
+  Args:
+    path: name of the JSON file
+    description: a string naming the file in warnings, e.g. 'naming cache'
+  """
+  try:
+    with open(path) as json_file:
+      data = json.load(json_file)
+  except (IOError, ValueError):
+    return {}
+  if not isinstance(data, dict):
+    logging.warning('Ignoring malformed %s %s.', description, path)
+    return {}
+  return data
+
+
+def SaveJson(path, data, description, mode=None):
+  """Atomically replace a JSON file, so readers never see a partial one.
+
+  data is written to a temporary file of the same directory, removed if
+  the write fails, then renamed over path.
+
+  Args:
+    path: name of the JSON file
+    data: an object json can serialize
+    description: a string naming the file in warnings, e.g. 'naming cache'
+    mode: optional, permission bits of the file
+  Returns:
+    a boolean, True when the file was replaced
+  """
+  try:
+    fd, temp_name = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.' + os.path.basename(path))
+  except (IOError, OSError):
+    logging.warning('Failed to save %s %s.', description, path)
+    return False
+  try:
+    with os.fdopen(fd, 'w') as temp_file:
+      json.dump(data, temp_file)
+    if mode is not None:
+      os.chmod(temp_name, mode)
+    os.rename(temp_name, path)
+  except (IOError, OSError, TypeError, ValueError):
+    logging.warning('Failed to save %s %s.', description, path)
+    try:
+      os.remove(temp_name)
+    except OSError:
+      pass
+    return False
+  return True
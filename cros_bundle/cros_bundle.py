@@ -12,10 +12,28 @@ import logging
 import os
 import shutil
 
+from cb_archive_hashing_lib import COMPRESS_BLOCK_SIZE, COMPRESS_JOBS, \
+    ConfigureCompression, SetDigestCache
+from cb_artifact_store import ArtifactStore, QUOTA
+from cb_catalog import ArtifactCatalog
 from cb_command_lib import IsInsideChroot, UploadToGsd
-from cb_constants import BundlingError, MOUNT_POINT, WORKDIR
-from cb_name_lib import RunWithNamingRetries
-from cros_bundle_lib import CheckParseOptions, FetchImages, MakeFactoryBundle
+from cb_constants import ARTIFACT_STORE, BundlingError, CATALOG, \
+    DIGEST_CACHE, FETCH_JOBS, LISTING_CACHE, LOCK_DIR, MD5_JOBS, \
+    MOUNT_POINT, NAMING_CACHE, WORKDIR
+from cb_digest_cache import DigestCache
+from cb_download_lib import ConfigureDownloads, DOWNLOAD_CHUNK_SIZE, \
+    DOWNLOAD_CONNECTIONS, SEGMENT_SIZE
+from cb_gs_index import GsIndex
+from cb_listing_cache import ListingCache
+from cb_lock_lib import SetLockDir
+from cb_name_lib import RunWithNamingRetries, SetNamingCache, \
+    SetParallelProbes
+from cb_naming_cache import NamingCache
+from cb_transport import HEDGE_DELAY, SetMirrors, SetRacing
+from cb_url_lib import SetArtifactStore, SetCatalog, SetGsIndex, \
+    SetListingCache
+from cros_bundle_lib import CheckParseOptions, FetchImages, ImageNamingKey, \
+    MakeFactoryBundle, ProbeImageNaming
 from optparse import OptionParser
 
 
@@ -68,6 +86,102 @@ def CreateParser():
                     help='makes full release image with stateful partition')
   parser.add_option('--chromeos_root', action='store', dest='chromeos_root',
                     help='root directory of ChromeOS source tree checkout')
+  parser.add_option('--fetch_jobs', action='store', type='int',
+                    dest='fetch_jobs', default=FETCH_JOBS,
+                    help='maximum number of images to download at once')
+  parser.add_option('--md5_jobs', action='store', type='int', dest='md5_jobs',
+                    default=MD5_JOBS,
+                    help='maximum number of bundle files to checksum at once')
+  parser.add_option('--full_verify', action='store_false', dest='digest_cache',
+                    default=True,
+                    help='ignore cached digests and re-hash every image')
+  parser.add_option('--download_chunk_kb', action='store', type='int',
+                    dest='download_chunk_kb',
+                    default=DOWNLOAD_CHUNK_SIZE / 1024,
+                    help='KB of each download held in memory at a time')
+  parser.add_option('--download_connections', action='store', type='int',
+                    dest='download_connections', default=DOWNLOAD_CONNECTIONS,
+                    help='concurrent connections used to fetch one image')
+  parser.add_option('--segment_mb', action='store', type='int',
+                    dest='segment_mb', default=SEGMENT_SIZE / (1024 * 1024),
+                    help='MB fetched per range request of a segmented download')
+  parser.add_option('--parallel_naming', action='store_true',
+                    dest='parallel_naming', default=False,
+                    help='probe all image naming schemes at once rather '
+                         'than one at a time')
+  parser.add_option('--naming_cache', action='store_true',
+                    dest='naming_cache', default=False,
+                    help='try first the naming scheme that resolved on the '
+                         'last run for the same board and channel')
+  parser.add_option('--listing_ttl', action='store', type='int',
+                    dest='listing_ttl', default=0,
+                    help='seconds an index page listing cached by an earlier '
+                         'run is used before checking whether it changed, 0 '
+                         'to check once per run')
+  parser.add_option('--no_listing_cache', action='store_false',
+                    dest='listing_cache', default=True,
+                    help='fetch every index page in full, without caching '
+                         'listings')
+  parser.add_option('--gs_index', action='store_true', dest='gs_index',
+                    default=False,
+                    help='list each Google Storage board/channel once, '
+                         'recursively, and resolve its releases from that')
+  parser.add_option('--catalog', action='store_true', dest='catalog',
+                    default=False,
+                    help='resolve images from the local artifact catalog '
+                         'filled by cb_catalog.py')
+  parser.add_option('--artifact_store', action='store_true',
+                    dest='artifact_store', default=False,
+                    help='reuse and keep images in the artifact store '
+                         'shared by all users of this machine')
+  parser.add_option('--store_quota_gb', action='store', type='int',
+                    dest='store_quota_gb', default=QUOTA / 1024 ** 3,
+                    help='GB of images the artifact store keeps, least '
+                         'recently used evicted first')
+  parser.add_option('--mirror', action='append', dest='mirrors', default=[],
+                    metavar='PREFIX=MIRROR',
+                    help='fetch URLs starting with PREFIX from MIRROR '
+                         'instead, e.g. an http:// cache or a file:// NFS '
+                         'mount; may be repeated')
+  parser.add_option('--hardlinks', action='store_true', dest='hardlinks',
+                    default=False,
+                    help='hardlink images into the bundle directory rather '
+                         'than copy them, where they cannot be reflinked; '
+                         'the bundle then changes if a download is rewritten')
+  parser.add_option('--stream_tar', action='store_true', dest='stream_tar',
+                    default=False,
+                    help='tar images straight from where they were fetched, '
+                         'leaving symlinks to them in the bundle directory')
+  parser.add_option('--sparse_tar', action='store_true', dest='sparse_tar',
+                    default=False,
+                    help='tar images as sparse files, skipping the '
+                         'zero-filled blocks of images not linked to the '
+                         'downloads, compressing only data')
+  parser.add_option('--elide_free_blocks', action='store_true',
+                    dest='elide_free_blocks', default=False,
+                    help='bundle release and factory images with the free '
+                         'blocks of their stateful partition zeroed')
+  parser.add_option('--verify_elision', action='store_true',
+                    dest='verify_elision', default=False,
+                    help='check images with free blocks elided differ '
+                         'from the originals in free blocks only')
+  parser.add_option('--compress_jobs', action='store', type='int',
+                    dest='compress_jobs', default=COMPRESS_JOBS,
+                    help='processes compressing the bundle tar when '
+                         'pbzip2 is not installed')
+  parser.add_option('--compress_block_kb', action='store', type='int',
+                    dest='compress_block_kb',
+                    default=COMPRESS_BLOCK_SIZE / 1000,
+                    help='KB of tar compressed into each bz2 stream when '
+                         'pbzip2 is not installed')
+  parser.add_option('--race_mirrors', action='store_true',
+                    dest='race_mirrors', default=False,
+                    help='fetch each URL from the fastest of it and its '
+                         'mirrors, asking the next one when it stalls')
+  parser.add_option('--hedge_delay', action='store', type='float',
+                    dest='hedge_delay', default=HEDGE_DELAY,
+                    help='seconds a raced request waits for an answer '
+                         'before asking the next source too')
   return parser
 
 
@@ -90,6 +204,10 @@ def HandleParseOptions():
                           'all caps')
     else:
       options.loglevel = log_level[options.loglevel]
+  for spec in options.mirrors:
+    if '=' not in spec:
+      raise BundlingError('Invalid mirror %s, please use PREFIX=MIRROR' % spec)
+  options.mirrors = [tuple(spec.split('=', 1)) for spec in options.mirrors]
   return (options, parser)
 
 
@@ -117,7 +235,32 @@ def main():
     if os.path.exists(WORKDIR):
       shutil.rmtree(WORKDIR)
       exit()
-  image_names = RunWithNamingRetries(None, FetchImages, options)
+  SetLockDir(LOCK_DIR)
+  SetMirrors(options.mirrors)
+  if options.race_mirrors:
+    SetRacing(options.hedge_delay)
+  if options.digest_cache:
+    SetDigestCache(DigestCache(DIGEST_CACHE))
+  ConfigureDownloads(chunk_size=options.download_chunk_kb * 1024,
+                     connections=options.download_connections,
+                     segment_size=options.segment_mb * 1024 * 1024)
+  ConfigureCompression(jobs=options.compress_jobs,
+                       block_size=options.compress_block_kb * 1000)
+  SetParallelProbes(options.parallel_naming)
+  if options.naming_cache:
+    SetNamingCache(NamingCache(NAMING_CACHE))
+  if options.listing_cache:
+    SetListingCache(ListingCache(LISTING_CACHE, ttl=options.listing_ttl))
+  if options.gs_index:
+    SetGsIndex(GsIndex())
+  if options.catalog:
+    SetCatalog(ArtifactCatalog(CATALOG))
+  if options.artifact_store:
+    SetArtifactStore(ArtifactStore(ARTIFACT_STORE,
+                                   quota=options.store_quota_gb * 1024 ** 3))
+  image_names = RunWithNamingRetries(None, FetchImages, options,
+                                     probe=ProbeImageNaming,
+                                     key=ImageNamingKey(options))
   if not image_names:
     raise BundlingError('Failed to determine URL at which to fetch images, '
                         'please check the logged URLs attempted.')
@@ -7,18 +7,28 @@
 
 import logging
 import os
+import Queue
 import re
 import shutil
+import stat
+import threading
+import time
 
 from cb_archive_hashing_lib import MakeTar, GenerateMd5, MakeMd5, ZipExtract
+from cb_artifact_store import PlaceFile
 from cb_command_lib import AskUserConfirmation, ExtractFirmware, \
     ConvertRecoveryToSsd
 from cb_constants import BundlingError, WORKDIR
+from cb_image_lib import ElideFreeBlocks, PunchZeroBlocks, VerifyElision
 from cb_name_lib import GetBundleDefaultName, GetReleaseName, GetRecoveryName, \
-    GetReleaseName, GetShimName, GetFactoryName
-from cb_url_lib import DetermineThenDownloadCheckMd5, DetermineUrl, Download
+    GetReleaseName, GetShimName, GetFactoryName, NamingKey
+from cb_url_lib import DetermineThenDownloadCheckMd5, DetermineUrl, \
+    NameResolutionError, ZipExtractUrl
 from cb_util import RunCommand
 
+# Bundle files smaller than this are tarred without looking for zero blocks.
+SPARSE_MIN_SIZE = 1024 * 1024
+
 
 def CheckBundleInputs(image_names, options):
   """Checks the input for making a factory bundle.
@@ -44,16 +54,29 @@ def CheckBundleInputs(image_names, options):
         board2: optional second target board
         bundle_dir: destination root directory for factory bundle files
         chromeos_root: user-provided root of ChromeOS source tree checkout
+        elide_free_blocks: a boolean, True to bundle release and factory
+                           images with the free blocks of their stateful
+                           partition zeroed
         factory: factory image version/channel
         force: a boolean, True when all existing bundle files can be deleted
         fsi: a boolean, True when processing for a Final Shipping Image
         full_ssd: a boolean, True to make release image with stateful partition
         fw: a boolean, True when script should extract firmware
+        hardlinks: a boolean, True to hardlink images into the bundle
+                   directory where they cannot be reflinked, rather than
+                   copy them
+        md5_jobs: maximum number of bundle files to checksum concurrently
         recovery: recovery image version/channel/signing_key
         recovery2: optional second recovery version/channel/signing_key
         release: release candidate version/channel/signing_key
         release2: optional second release version/channel/signing_key
+        sparse_tar: a boolean, True to tar images as sparse files, skipping
+                    the zero-filled blocks of images not linked to WORKDIR
+        stream_tar: a boolean, True to tar images from where they were
+                    fetched, leaving symlinks in the bundle directory
         tar_dir: destination directory for factory bundle tar file
+        verify_elision: a boolean, True to check images with free blocks
+                        elided against the originals
         version: key and version for bundle naming, e.g. mp9x
   Raises:
     BundlingError when a check fails.
@@ -106,6 +129,85 @@ def CheckBundleInputs(image_names, options):
     raise BundlingError('\n'.join(msg))
 
 
+def _AddToBundle(filename, directory, link=False, hardlink=False):
+  """Put an image into a bundle directory.
+
+  The image is staged the cheapest way its file systems allow, see
+  PlaceFile, keeping its permission bits as a copy would.
+
+  Args:
+    filename: path of the image
+    directory: bundle subdirectory, e.g. release
+    link: optional, True to symlink the image rather than stage it
+    hardlink: optional, True to stage the image as a hardlink where it
+              cannot be reflinked. The bundle then shares the inode of a
+              WORKDIR file, which a later conversion may rewrite in place
+  Returns:
+    a string, how the image was put: 'symlink' or a PlaceFile method
+  """
+  dest = os.path.join(directory, os.path.basename(filename))
+  if link:
+    os.symlink(os.path.abspath(filename), dest)
+    return 'symlink'
+  method = PlaceFile(filename, dest, hardlink=hardlink)
+  if method != 'hardlink':
+    shutil.copymode(filename, dest)
+  logging.debug('Staged %s in %s by %s.', filename, directory, method)
+  return method
+
+
+def _ElideImage(filename, directory, verify=False):
+  """Replace an image of a bundle directory by a copy without free blocks.
+
+  See ElideFreeBlocks, the image itself is left alone.
+
+  Args:
+    filename: path of the image
+    directory: bundle subdirectory the image was put in, e.g. release
+    verify: optional, True to check the copy against the image
+  Raises:
+    BundlingError when the copy cannot be made or fails verification
+  """
+  dest = os.path.join(directory, os.path.basename(filename))
+  try:
+    elided = ElideFreeBlocks(filename, dest)
+    if elided and verify and not VerifyElision(filename, dest):
+      raise BundlingError('Image %s without free blocks differs from %s.' %
+                          (dest, filename))
+  except (IOError, OSError) as e:
+    raise BundlingError('Could not elide free blocks of %s: %s' %
+                        (filename, e))
+  logging.info('Elided %d MB of free blocks from %s.', elided / 1024 ** 2,
+               dest)
+
+
+def _SparsifyBundle(bundle_dir):
+  """Punch the zero blocks out of the images staged privately in a bundle.
+
+  Only regular files with a single name are punched: reflinked or copied
+  images and images with free blocks elided. Symlinks and hardlinks reach
+  WORKDIR downloads or artifact store objects, which are left alone, as
+  is an image that cannot be punched.
+
+  Args:
+    bundle_dir: the bundle directory, about to be tarred with tar --sparse
+  """
+  for (dirpath, _, filenames) in os.walk(bundle_dir):
+    for filename in filenames:
+      path = os.path.join(dirpath, filename)
+      try:
+        st = os.lstat(path)
+        if (not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 or
+            st.st_size < SPARSE_MIN_SIZE):
+          continue
+        punched = PunchZeroBlocks(path)
+      except (IOError, OSError) as e:
+        logging.info('Could not punch zero blocks out of %s: %s', path, e)
+        continue
+      logging.debug('Deallocated %d MB of zeros of %s.', punched / 1024 ** 2,
+                    path)
+
+
 def MakeFactoryBundle(image_names, options):
   """Produces a factory bundle from the downloaded images.
 
@@ -116,6 +218,18 @@ def MakeFactoryBundle(image_names, options):
   Only extracts firmware from one release image.
   Assuming a second recovery image implies a second release image.
 
+  Images are staged in the bundle directory by reflink or an in-kernel
+  copy when their file systems allow, see PlaceFile, and by hardlink only
+  with options.hardlinks.
+  With options.elide_free_blocks, release and factory images are replaced
+  in the bundle directory by copies with the free blocks of their stateful
+  partition zeroed, checked against the images with options.verify_elision.
+  With options.stream_tar, the bundle directory holds symlinks to the
+  images rather than copies, and the tar is written from the images they
+  point to, so images are read once and never copied on disk.
+  With options.sparse_tar, the zero blocks of images staged privately are
+  deallocated, see _SparsifyBundle, and the tar holds their data only.
+
   Args:
     image_names: a dict, values are absolute file paths for keys:
       'ssd': release image or None
@@ -140,6 +254,8 @@ def MakeFactoryBundle(image_names, options):
   bundle_dir = options.bundle_dir
   tar_dir = options.tar_dir
   del_ok = options.force
+  link = options.stream_tar
+  hardlink = options.hardlinks
   # throws BundlingError if needed resources do not exist or options conflict
   CheckBundleInputs(image_names, options)
   ssd_name = image_names.get('ssd', None)
@@ -203,22 +319,36 @@ def MakeFactoryBundle(image_names, options):
     os.mkdir(firmware_dest)
     ExtractFirmware(ssd_name, firmware_dest, mount_point, options.board)
     logging.info('Successfully extracted firmware to %s', firmware_dest)
-  shutil.copy(ssd_name, dir_dict.get('release', None))
-  shutil.copy(rec_name, dir_dict.get('recovery', None))
+  _AddToBundle(ssd_name, dir_dict.get('release', None), link, hardlink)
+  _AddToBundle(rec_name, dir_dict.get('recovery', None), link, hardlink)
   if options.release2:
-    shutil.copy(ssd_name2, dir_dict.get('release', None))
+    _AddToBundle(ssd_name2, dir_dict.get('release', None), link, hardlink)
   if options.recovery2:
     if not options.release2:
       # converted from recovery, still need to copy file
-      shutil.copy(ssd_name2, dir_dict.get('release', None))
-    shutil.copy(rec_name2, dir_dict.get('recovery', None))
+      _AddToBundle(ssd_name2, dir_dict.get('release', None), link, hardlink)
+    _AddToBundle(rec_name2, dir_dict.get('recovery', None), link, hardlink)
   if not fsi:
-    shutil.copy(shim_name, dir_dict.get('shim', None))
-    shutil.copy(fac_name, dir_dict.get('factory', None))
-  MakeMd5Sums(bundle_dir)
-  logging.info('Completed copying factory bundle files to %s', bundle_dir)
+    _AddToBundle(shim_name, dir_dict.get('shim', None), link, hardlink)
+    _AddToBundle(fac_name, dir_dict.get('factory', None), link, hardlink)
+  if options.elide_free_blocks:
+    elide_list = [(ssd_name, 'release'), (fac_name, 'factory')]
+    if options.release2 or options.recovery2:
+      elide_list.append((ssd_name2, 'release'))
+    for (filename, dir_name) in elide_list:
+      if dir_name in dir_dict:
+        _ElideImage(filename, dir_dict[dir_name],
+                    verify=options.verify_elision)
+  if options.sparse_tar:
+    _SparsifyBundle(bundle_dir)
+  MakeMd5Sums(bundle_dir, jobs=options.md5_jobs)
+  if link:
+    logging.info('Completed linking factory bundle files in %s', bundle_dir)
+  else:
+    logging.info('Completed copying factory bundle files to %s', bundle_dir)
   logging.info('Tarring bundle files, this operation is resource-intensive.')
-  tarname = MakeTar(bundle_dir, tar_dir)
+  tarname = MakeTar(bundle_dir, tar_dir, dereference=link,
+                    sparse=options.sparse_tar)
   if not tarname:
     raise BundlingError('Failed to create tar file of bundle directory.')
   logging.info('Completed creating factory bundle tar file in %s.', WORKDIR)
@@ -226,11 +356,89 @@ def MakeFactoryBundle(image_names, options):
   return abstarname
 
 
-def MakeMd5Sums(bundle_dir):
+def _GenerateMd5WithThroughput(absfilename):
+  """Generate the MD5 checksum of a file and log the hashing throughput.
+
+  Args:
+    absfilename: absolute path name of file to hash
+  Returns:
+    a string, the hexdigest form of the MD5 checksum, empty on failure
+  """
+  start = time.time()
+  md5sum = GenerateMd5(absfilename)
+  elapsed = max(time.time() - start, 1e-6)
+  if md5sum:
+    try:
+      size_mb = os.path.getsize(absfilename) / float(1024 * 1024)
+      logging.info('Hashed %s: %.1f MB in %.2f s (%.1f MB/s)',
+                   absfilename, size_mb, elapsed, size_mb / elapsed)
+    except OSError:
+      logging.debug('Could not stat %s for hashing throughput.', absfilename)
+  return md5sum
+
+
+def _Md5Worker(work_queue, md5sums, failed):
+  """Hash files taken from a queue until it is empty or a hash fails.
+
+  Args:
+    work_queue: a Queue of (index, absolute file name) tuples
+    md5sums: a list, the checksum of each file is stored at its index
+    failed: a threading.Event, set when any checksum fails to compute
+  """
+  while not failed.is_set():
+    try:
+      index, absfilename = work_queue.get_nowait()
+    except Queue.Empty:
+      return
+    md5sums[index] = _GenerateMd5WithThroughput(absfilename)
+    if not md5sums[index]:
+      failed.set()
+
+
+def _GenerateMd5s(file_list, jobs):
+  """Generate MD5 checksums for a list of files with a bounded thread pool.
+
+  hashlib releases the GIL while hashing large buffers, so files on
+  different disks or cores are hashed concurrently. At most jobs files are
+  in flight at once; with jobs of 1 files are hashed in the calling thread.
+
+  Args:
+    file_list: a list of absolute file names to hash
+    jobs: an integer, maximum number of files to hash concurrently
+  Returns:
+    a list of checksums in file_list order, empty or None for failures
+  """
+  md5sums = [None] * len(file_list)
+  work_queue = Queue.Queue()
+  for index, absfilename in enumerate(file_list):
+    work_queue.put((index, absfilename))
+  failed = threading.Event()
+  num_workers = min(max(jobs, 1), len(file_list))
+  if num_workers <= 1:
+    _Md5Worker(work_queue, md5sums, failed)
+    return md5sums
+  workers = [threading.Thread(target=_Md5Worker,
+                              args=(work_queue, md5sums, failed))
+             for _ in range(num_workers)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return md5sums
+
+
+def MakeMd5Sums(bundle_dir, jobs=1):
   """Generate MD5 checksums for all binary components of factory bundle.
 
+  Checksum lines are written in directory listing order regardless of the
+  order in which concurrent hashing completes.
+
   Args:
     bundle_dir: absolute path to directory containing factory bundle files
+    jobs: optional, maximum number of files to hash concurrently
+  Returns:
+    a list of strings, the lines written to the checksum file
   Raises:
     BundlingError on failure
   """
@@ -245,8 +453,8 @@ def MakeMd5Sums(bundle_dir):
   lines_written = []
   try:
     with open(md5filename, 'w') as md5file:
-      for absfilename in file_list:
-        md5sum = GenerateMd5(absfilename)
+      md5sums = _GenerateMd5s(file_list, jobs)
+      for absfilename, md5sum in zip(file_list, md5sums):
         if not md5sum:
           raise BundlingError('Failed to compute MD5 checksum for file %s.' %
                               absfilename)
@@ -296,20 +504,21 @@ def _HandleFactoryImageAndShim(options, alt_naming):
     raise BundlingError('Factory image exact URL could not be determined '
                         'on page %s given pattern %s.' % (fac_url, token_list))
 
+  # only the factory image binary is needed from the archive, fetched alone
+  # unless the archive was downloaded already
   fac_name = os.path.join(WORKDIR, os.path.basename(fac_det_url))
-  if not os.path.exists(fac_name):
-    logging.info('Downloading ' + fac_det_url)
-    if not Download(fac_det_url):
-      raise BundlingError('Factory image could not be fetched.')
-  logging.info('Resource %s is present.', fac_name)
-
   factorybin = os.path.join('factory_test', 'chromiumos_factory_image.bin')
   absfactorybin = os.path.join(WORKDIR, factorybin)
   if not os.path.exists(absfactorybin):
     logging.info('Extracting factory image binary')
-    if not ZipExtract(fac_name, factorybin, path=WORKDIR):
-      raise BundlingError('Could not find chromiumos_factory_image.bin '
-                          'in factory image.')
+    if os.path.exists(fac_name):
+      extracted = ZipExtract(fac_name, factorybin, path=WORKDIR)
+    else:
+      logging.info('Fetching %s from %s', factorybin, fac_det_url)
+      extracted = ZipExtractUrl(fac_det_url, factorybin, path=WORKDIR)
+    if not extracted:
+      raise BundlingError('Could not fetch chromiumos_factory_image.bin '
+                          'from factory image.')
   logging.info('Resource %s is present.', absfactorybin)
 
   # Factory Install Shim
@@ -321,6 +530,81 @@ def _HandleFactoryImageAndShim(options, alt_naming):
   return (absfactorybin, shim_name)
 
 
+def _FetchWorker(work_queue, results, errors):
+  """Run fetch tasks taken from a queue until it is empty or a task fails.
+
+  A failing task empties the queue, so tasks not yet started are cancelled.
+
+  Args:
+    work_queue: a Queue of functions taking no arguments and returning a dict
+    results: a dict, updated with the dict returned by each task
+    errors: a list, exceptions raised by any task are appended to it
+  """
+  while not errors:
+    try:
+      task = work_queue.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      results.update(task())
+    except Exception as e:
+      errors.append(e)
+      _DrainQueue(work_queue)
+
+
+def _DrainQueue(work_queue):
+  """Discard every item left in a queue.
+
+  Args:
+    work_queue: a Queue
+  """
+  while True:
+    try:
+      work_queue.get_nowait()
+    except Queue.Empty:
+      return
+
+
+def _RunFetchTasks(tasks, jobs):
+  """Run independent fetch tasks with a bounded thread pool.
+
+  At most jobs tasks are in flight at once; with jobs of 1 tasks run in the
+  calling thread in the order given. Once a task fails no new task starts,
+  and a failure is raised after the running tasks finish. A naming failure
+  takes precedence over any other, whichever task failed first, so that
+  RunWithNamingRetries still moves on to the next naming scheme.
+
+  Args:
+    tasks: a list of functions taking no arguments and returning a dict
+    jobs: an integer, maximum number of tasks to run concurrently
+  Returns:
+    a dict, the union of the dicts returned by the tasks
+  Raises:
+    the first NameResolutionError raised by a task, else the first exception
+  """
+  results = {}
+  errors = []
+  work_queue = Queue.Queue()
+  for task in tasks:
+    work_queue.put(task)
+  num_workers = min(max(jobs, 1), len(tasks))
+  if num_workers <= 1:
+    _FetchWorker(work_queue, results, errors)
+  else:
+    workers = [threading.Thread(target=_FetchWorker,
+                                args=(work_queue, results, errors))
+               for _ in range(num_workers)]
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+    for worker in workers:
+      worker.join()
+  if errors:
+    naming_errors = [e for e in errors if isinstance(e, NameResolutionError)]
+    raise (naming_errors or errors)[0]
+  return results
+
+
 def FetchImages(options, alt_naming=0):
   """Fetches images for factory bundle specified by args input
 
@@ -329,6 +613,11 @@ def FetchImages(options, alt_naming=0):
   Default ssd conversion requires chroot setup and that this method be used
     in current directory <ChromeOS_root>/src/scripts
 
+  Independent images are resolved and downloaded concurrently, at most
+  options.fetch_jobs at once. A recovery image needing conversion to an SSD
+  image is converted as soon as it lands, while other downloads continue;
+  conversions themselves run one at a time as they share tools in WORKDIR.
+
   Args:
     options: an object containing inputs to the script
       please see CheckBundleInputs above for possibilities
@@ -344,49 +633,102 @@ def FetchImages(options, alt_naming=0):
   Raises:
     BundlingError when resources cannot be fetched.
   """
-  # Recovery
-  rec_url, rec_name = _GetResourceUrlAndPath(
-      'Recovery image', GetRecoveryName, options.board, options.recovery,
-      alt_naming)
+  conversion_lock = threading.Lock()
 
-  # Release
-  if options.release:
-    rel_url, rel_name = _GetResourceUrlAndPath(
+  def _FetchRecovery():
+    """Recovery, and release converted from it if none is given."""
+    _, rec_name = _GetResourceUrlAndPath(
+        'Recovery image', GetRecoveryName, options.board, options.recovery,
+        alt_naming)
+    fetched = dict(recovery=rec_name)
+    if not options.release:
+      # run recovery to ssd conversion now that we have recovery image
+      with conversion_lock:
+        rel_name = ConvertRecoveryToSsd(rec_name, options)
+      if not MakeMd5(rel_name, rel_name + '.md5'):
+        raise BundlingError('Failed to create md5 checksum for %s' % rel_name)
+      fetched['ssd'] = rel_name
+    return fetched
+
+  def _FetchRelease():
+    """Release image."""
+    _, rel_name = _GetResourceUrlAndPath(
         'Release image', GetReleaseName, options.board, options.release,
         alt_naming)
-  else:
-    # if needed, run recovery to ssd conversion now that we have recovery image
-    rel_name = ConvertRecoveryToSsd(rec_name, options)
-    if not MakeMd5(rel_name, rel_name + '.md5'):
-      raise BundlingError('Failed to create md5 checksum for %s' % rel_name)
+    return dict(ssd=rel_name)
 
-  # Optional Extra Release
-  rel_name2 = None
-  if options.release2:
-    rel_url2, rel_name2 = _GetResourceUrlAndPath(
+  def _FetchRelease2():
+    """Optional extra release image."""
+    _, rel_name2 = _GetResourceUrlAndPath(
         'Second release image', GetReleaseName, options.board2,
         options.release2, alt_naming)
+    return dict(ssd2=rel_name2)
 
-  # Optional Extra Recovery
-  rec_name2 = None
-  if options.recovery2:
-    rec_url2, rec_name2 = _GetResourceUrlAndPath(
+  def _FetchRecovery2():
+    """Optional extra recovery, and release converted from it if needed."""
+    _, rec_name2 = _GetResourceUrlAndPath(
         'Second recovery image', GetRecoveryName, options.board2,
         options.recovery2, alt_naming)
+    fetched = dict(recovery2=rec_name2)
     # if provided a second recovery image but no matching ssd, run conversion
     if not options.release2:
-      rel_name2 = ConvertRecoveryToSsd(rec_name2, options)
+      with conversion_lock:
+        fetched['ssd2'] = ConvertRecoveryToSsd(rec_name2, options)
+    return fetched
 
-  image_names = dict(ssd=rel_name, ssd2=rel_name2, recovery=rec_name,
-                     recovery2=rec_name2)
-  # Factory and Shim
-  if not options.fsi:
+  def _FetchFactoryAndShim():
+    """Factory image binary and install shim."""
     (absfactorybin, shim_name) = _HandleFactoryImageAndShim(options, alt_naming)
-    image_names.update(dict(factorybin=absfactorybin, shim=shim_name))
+    return dict(factorybin=absfactorybin, shim=shim_name)
+
+  tasks = [_FetchRecovery]
+  if options.release:
+    tasks.append(_FetchRelease)
+  if options.release2:
+    tasks.append(_FetchRelease2)
+  if options.recovery2:
+    tasks.append(_FetchRecovery2)
+  if not options.fsi:
+    tasks.append(_FetchFactoryAndShim)
 
+  image_names = dict(ssd2=None, recovery2=None)
+  image_names.update(_RunFetchTasks(tasks, options.fetch_jobs))
   return image_names
 
 
+def ImageNamingKey(options):
+  """Returns the key the naming scheme of FetchImages is remembered under.
+
+  Args:
+    options: an object containing inputs to the script
+      please see CheckBundleInputs above for possibilities
+  Returns:
+    a string, the board/channel of each recovery image, comma separated
+  """
+  keys = [NamingKey(options.board, options.recovery)]
+  if options.recovery2:
+    keys.append(NamingKey(options.board2, options.recovery2))
+  return ','.join(keys)
+
+
+def ProbeImageNaming(options, alt_naming=0):
+  """Checks whether images for the bundle resolve under a naming scheme.
+
+  Only the recovery image index page is fetched, FetchImages fails for any
+  scheme under which the recovery image URL cannot be determined.
+
+  Args:
+    options: an object containing inputs to the script
+      please see CheckBundleInputs above for possibilities
+    alt_naming: optional, see docstring for GetNameComponents in cb_name_lib.py
+  Returns:
+    a string, the recovery image URL, or None if it cannot be determined
+  """
+  rec_url, token_list = GetRecoveryName(options.board, options.recovery,
+                                        alt_naming)
+  return DetermineUrl(rec_url, token_list)
+
+
 def CheckParseOptions(options, parser):
   """Checks parse options input to the factory bundle script.
 
@@ -6,15 +6,22 @@
 """Unit tests for the cros_bundle_lib module."""
 
 import __builtin__
+import bz2
 import cros_bundle_lib
+import hashlib
 import mox
 import optparse
 import os
+import shutil
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
+from cb_archive_hashing_lib import MakeTar
 from cb_constants import BundlingError, WORKDIR
+from cb_url_lib import NameResolutionError
 from cros_bundle import CreateParser
 
 
@@ -103,6 +110,162 @@ class TestMakeMd5Sums(mox.MoxTestBase):
                       cros_bundle_lib.MakeMd5Sums, self.bundle_dir)
 
 
+class TestMakeMd5SumsConcurrent(unittest.TestCase):
+  """Tests related to MakeMd5Sums hashing several files at once."""
+
+  def setUp(self):
+    self.bundle_dir = tempfile.mkdtemp()
+    for dirname in ['release', 'recovery', 'firmware']:
+      os.mkdir(os.path.join(self.bundle_dir, dirname))
+      for filename in ['a.bin', 'b.fd', 'c.txt', 'd.bin']:
+        with open(os.path.join(self.bundle_dir, dirname, filename), 'w') as f:
+          f.write(dirname + filename)
+
+  def tearDown(self):
+    shutil.rmtree(self.bundle_dir)
+
+  def _ReadChecksumFile(self):
+    # MakeMd5Sums expects only directories at the top of the bundle
+    md5filename = os.path.join(self.bundle_dir, 'file_checksum.md5')
+    with open(md5filename) as f:
+      contents = f.read()
+    os.remove(md5filename)
+    return contents
+
+  def testOutputMatchesSerial(self):
+    """Verify concurrent hashing writes the same file as serial hashing."""
+    serial = cros_bundle_lib.MakeMd5Sums(self.bundle_dir, jobs=1)
+    serial_file = self._ReadChecksumFile()
+    concurrent = cros_bundle_lib.MakeMd5Sums(self.bundle_dir, jobs=3)
+    self.assertEqual(serial, concurrent)
+    self.assertEqual(serial_file, self._ReadChecksumFile())
+    self.assertEqual(9, len(concurrent))
+
+  def testUnreadableFileRaisesError(self):
+    """Error when any concurrently hashed file cannot be read."""
+    os.symlink(os.path.join(self.bundle_dir, 'missing'),
+               os.path.join(self.bundle_dir, 'recovery', 'e.bin'))
+    self.assertRaises(BundlingError,
+                      cros_bundle_lib.MakeMd5Sums, self.bundle_dir, jobs=3)
+
+
+class TestAddToBundle(unittest.TestCase):
+  """Tests related to _AddToBundle."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.image = os.path.join(self.test_dir, 'image.bin')
+    with open(self.image, 'w') as f:
+      f.write('image')
+    self.bundle_dir = os.path.join(self.test_dir, 'bundle')
+    os.makedirs(os.path.join(self.bundle_dir, 'release'))
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testStaged(self):
+    """Verify an image is staged by default."""
+    method = cros_bundle_lib._AddToBundle(
+        self.image, os.path.join(self.bundle_dir, 'release'))
+    self.assertNotEqual('hardlink', method)
+    added = os.path.join(self.bundle_dir, 'release', 'image.bin')
+    self.assertFalse(os.path.islink(added))
+    with open(added) as f:
+      self.assertEqual('image', f.read())
+
+  def testNoHardlinkByDefault(self):
+    """Verify an image is not hardlinked unless asked, keeping its mode."""
+    os.chmod(self.image, 0640)
+    cros_bundle_lib._AddToBundle(self.image,
+                                 os.path.join(self.bundle_dir, 'release'))
+    added = os.path.join(self.bundle_dir, 'release', 'image.bin')
+    self.assertEqual(1, os.stat(self.image).st_nlink)
+    self.assertEqual(0640, os.stat(added).st_mode & 0777)
+    # rewriting the download in place leaves the bundle alone
+    with open(self.image, 'r+') as f:
+      f.write('IMAGE')
+    with open(added) as f:
+      self.assertEqual('image', f.read())
+
+  def testHardlink(self):
+    """Verify an image is hardlinked when asked, if it cannot be reflinked."""
+    method = cros_bundle_lib._AddToBundle(
+        self.image, os.path.join(self.bundle_dir, 'release'), hardlink=True)
+    self.assertTrue(method in ('reflink', 'hardlink'))
+
+  def testLinkedAndHashed(self):
+    """Verify a linked image is checksummed under its bundle path."""
+    cros_bundle_lib._AddToBundle(self.image,
+                                 os.path.join(self.bundle_dir, 'release'),
+                                 link=True)
+    added = os.path.join(self.bundle_dir, 'release', 'image.bin')
+    self.assertEqual(self.image, os.readlink(added))
+    lines = cros_bundle_lib.MakeMd5Sums(self.bundle_dir)
+    self.assertEqual([hashlib.md5('image').hexdigest() +
+                      '  ./release/image.bin\n'], lines)
+
+
+class TestSparsifyBundle(unittest.TestCase):
+  """Tests related to _SparsifyBundle and tarring a dense image sparsely."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    # a dense image: data, a 16MB run of written zeros, data
+    self.image = os.path.join(self.test_dir, 'image.bin')
+    self.data = os.urandom(64 * 1024)
+    with open(self.image, 'wb') as f:
+      f.write(self.data + '\0' * (16 * 1024 * 1024) + self.data)
+    self.bundle_dir = os.path.join(self.test_dir, 'bundle')
+    self.release_dir = os.path.join(self.bundle_dir, 'release')
+    os.makedirs(self.release_dir)
+    self.staged = os.path.join(self.release_dir, 'image.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Blocks(self, path):
+    return os.stat(path).st_blocks
+
+  def _TarSize(self, tarname):
+    """Returns the size of a tar once decompressed, of every bz2 stream."""
+    with open(tarname, 'rb') as tar:
+      compressed = tar.read()
+    size = 0
+    while compressed:
+      decompressor = bz2.BZ2Decompressor()
+      size += len(decompressor.decompress(compressed))
+      compressed = decompressor.unused_data
+    return size
+
+  def testPrivateCopyArchivedSparsely(self):
+    """Verify the zeros of a copied image stay out of the sparse tar."""
+    cros_bundle_lib._AddToBundle(self.image, self.release_dir)
+    dense_blocks = self._Blocks(self.image)
+    cros_bundle_lib._SparsifyBundle(self.bundle_dir)
+    if self._Blocks(self.staged) >= dense_blocks:
+      self.skipTest('file system cannot punch holes')
+    self.assertEqual(dense_blocks, self._Blocks(self.image))
+    with open(self.staged, 'rb') as f:
+      self.assertEqual(self.data + '\0' * (16 * 1024 * 1024) + self.data,
+                       f.read())
+    tarname = MakeTar(self.bundle_dir, self.test_dir, sparse=True)
+    self.assertTrue(self._TarSize(tarname) < 1024 * 1024)
+
+  def testDenseImageArchivedInFull(self):
+    """Verify tar --sparse alone does not shrink a dense image."""
+    cros_bundle_lib._AddToBundle(self.image, self.release_dir)
+    tarname = MakeTar(self.bundle_dir, self.test_dir, sparse=True)
+    self.assertTrue(self._TarSize(tarname) > 16 * 1024 * 1024)
+
+  def testSharedImagesLeftAlone(self):
+    """Verify hardlinked and symlinked images are not punched."""
+    os.link(self.image, self.staged)
+    os.symlink(self.image, os.path.join(self.release_dir, 'linked.bin'))
+    blocks = self._Blocks(self.image)
+    cros_bundle_lib._SparsifyBundle(self.bundle_dir)
+    self.assertEqual(blocks, self._Blocks(self.image))
+
+
 class TestGetResourceUrlAndPath(mox.MoxTestBase):
   """Tests related to _GetResourceUrlAndPath."""
 
@@ -137,10 +300,10 @@ class TestHandleFactoryImageAndShim(mox.MoxTestBase):
     self.mox.StubOutWithMock(cros_bundle_lib, 'ConvertRecoveryToSsd')
     self.mox.StubOutWithMock(cros_bundle_lib, 'DetermineThenDownloadCheckMd5')
     self.mox.StubOutWithMock(cros_bundle_lib, 'DetermineUrl')
-    self.mox.StubOutWithMock(cros_bundle_lib, 'Download')
     self.mox.StubOutWithMock(cros_bundle_lib, 'GetFactoryName')
     self.mox.StubOutWithMock(cros_bundle_lib, 'GetShimName')
     self.mox.StubOutWithMock(cros_bundle_lib, 'ZipExtract')
+    self.mox.StubOutWithMock(cros_bundle_lib, 'ZipExtractUrl')
     self.mox.StubOutWithMock(os.path, 'exists')
 
     self.options = self.mox.CreateMock(optparse.Values)
@@ -172,11 +335,13 @@ class TestHandleFactoryImageAndShim(mox.MoxTestBase):
         self.options, self.alt_naming)
 
   def testHandleFactoryImageAndShimDownloadFailRaisesError(self):
-    """Error downloading factory image."""
+    """Error fetching factory image binary."""
     cros_bundle_lib.DetermineUrl(
         self.fac_url, self.fac_pat).AndReturn(self.fac_det_url)
+    os.path.exists(self.absfactorybin).AndReturn(False)
     os.path.exists(self.fac_name).AndReturn(False)
-    cros_bundle_lib.Download(self.fac_det_url).AndReturn(False)
+    cros_bundle_lib.ZipExtractUrl(
+        self.fac_det_url, self.factorybin, path=WORKDIR).AndReturn(False)
     self.mox.ReplayAll()
     self.assertRaises(
         BundlingError, cros_bundle_lib._HandleFactoryImageAndShim,
@@ -186,8 +351,8 @@ class TestHandleFactoryImageAndShim(mox.MoxTestBase):
     """Error extracting factory image."""
     cros_bundle_lib.DetermineUrl(
         self.fac_url, self.fac_pat).AndReturn(self.fac_det_url)
-    os.path.exists(self.fac_name).AndReturn(True)
     os.path.exists(self.absfactorybin).AndReturn(False)
+    os.path.exists(self.fac_name).AndReturn(True)
     cros_bundle_lib.ZipExtract(
         self.fac_name, self.factorybin, path=WORKDIR).AndReturn(False)
     self.mox.ReplayAll()
@@ -201,7 +366,6 @@ class TestHandleFactoryImageAndShim(mox.MoxTestBase):
 
     cros_bundle_lib.DetermineUrl(
         self.fac_url, self.fac_pat).AndReturn(self.fac_det_url)
-    os.path.exists(self.fac_name).AndReturn(True)
     os.path.exists(self.absfactorybin).AndReturn(True)
     cros_bundle_lib.GetShimName(
         self.options.board, self.options.shim, self.alt_naming).AndReturn(
@@ -215,16 +379,15 @@ class TestHandleFactoryImageAndShim(mox.MoxTestBase):
     self.assertEqual(expected, actual)
 
   def testHandleFactoryImageAndShimGoodDownloadAndExtract(self):
-    """Verify success with image download and extraction."""
+    """Verify success with image binary fetched from the remote archive."""
     expected = (self.absfactorybin, self.shim_name)
 
     cros_bundle_lib.DetermineUrl(
         self.fac_url, self.fac_pat).AndReturn(self.fac_det_url)
-    os.path.exists(self.fac_name).AndReturn(False)
-    cros_bundle_lib.Download(self.fac_det_url).AndReturn(True)
     os.path.exists(self.absfactorybin).AndReturn(False)
-    cros_bundle_lib.ZipExtract(
-        self.fac_name, self.factorybin, path=WORKDIR).AndReturn(True)
+    os.path.exists(self.fac_name).AndReturn(False)
+    cros_bundle_lib.ZipExtractUrl(
+        self.fac_det_url, self.factorybin, path=WORKDIR).AndReturn(True)
     cros_bundle_lib.GetShimName(
         self.options.board, self.options.shim, self.alt_naming).AndReturn(
         (None, self.shim_pat))
@@ -257,6 +420,7 @@ class TestFetchImages(mox.MoxTestBase):
     self.options.release = 'release'
     self.options.release2 = 'release2'
     self.options.shim = 'shim'
+    self.options.fetch_jobs = 1
 
     self.rec_name = 'rec_name'
     self.rec_name2 = 'rec_name2'
@@ -358,6 +522,109 @@ class TestFetchImages(mox.MoxTestBase):
     self.assertEqual(expected, cros_bundle_lib.FetchImages(self.options))
 
 
+class TestFetchImagesConcurrent(mox.MoxTestBase):
+  """Tests related to FetchImages fetching several images at once."""
+
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.options = optparse.Values(dict(
+        board='board', board2='board2', factory='factory', fsi=False,
+        recovery='recovery', recovery2='recovery2', release=None,
+        release2=None, shim='shim', fetch_jobs=5))
+    self.latency = 0.2
+    self.lock = threading.Lock()
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.events = []
+    self.mox.stubs.Set(cros_bundle_lib, '_GetResourceUrlAndPath', self._Fetch)
+    self.mox.stubs.Set(cros_bundle_lib, '_HandleFactoryImageAndShim',
+                       self._FetchFactory)
+    self.mox.stubs.Set(cros_bundle_lib, 'ConvertRecoveryToSsd', self._Convert)
+    self.mox.stubs.Set(cros_bundle_lib, 'MakeMd5', lambda *args: True)
+
+  def _Sleep(self, name, latency):
+    with self.lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    time.sleep(latency)
+    with self.lock:
+      self.in_flight -= 1
+      self.events.append(name)
+
+  def _Fetch(self, desc, get_func, board, version, alt_naming):
+    self._Sleep(version, self.latency)
+    return ('url', version + '_name')
+
+  def _FetchFactory(self, options, alt_naming):
+    self._Sleep('factory', 3 * self.latency)
+    return ('factorybin', 'shim_name')
+
+  def _Convert(self, image_name, options):
+    self.events.append('convert ' + image_name)
+    return image_name.replace('recovery', 'ssd')
+
+  def testResultsMatchSerial(self):
+    """Verify concurrent fetching returns the same names as serial."""
+    concurrent = cros_bundle_lib.FetchImages(self.options)
+    self.options.fetch_jobs = 1
+    self.assertEqual(cros_bundle_lib.FetchImages(self.options), concurrent)
+    self.assertEqual(dict(ssd='ssd_name', ssd2='ssd2_name',
+                          recovery='recovery_name',
+                          recovery2='recovery2_name', factorybin='factorybin',
+                          shim='shim_name'), concurrent)
+
+  def testConversionStartsWhenRecoveryLands(self):
+    """Verify SSD conversion does not wait for unrelated downloads."""
+    start = time.time()
+    cros_bundle_lib.FetchImages(self.options)
+    elapsed = time.time() - start
+    self.assertTrue(self.events.index('convert recovery2_name') <
+                    self.events.index('factory'))
+    self.assertTrue(elapsed < 5 * self.latency, elapsed)
+
+  def testConcurrencyCapped(self):
+    """Verify no more than fetch_jobs images are fetched at once."""
+    self.options.fetch_jobs = 2
+    cros_bundle_lib.FetchImages(self.options)
+    self.assertEqual(2, self.max_in_flight)
+
+  def testNameResolutionErrorPropagated(self):
+    """Verify a failed fetch raises its own error for naming retries."""
+    def _Fail(*args):
+      raise NameResolutionError('no such image')
+    self.mox.stubs.Set(cros_bundle_lib, '_HandleFactoryImageAndShim', _Fail)
+    self.assertRaises(NameResolutionError, cros_bundle_lib.FetchImages,
+                      self.options)
+
+  def testNameResolutionErrorPreferred(self):
+    """Verify a naming failure wins over an earlier bundling failure."""
+    def _FailNaming(*args):
+      time.sleep(self.latency)
+      raise NameResolutionError('no such image')
+    def _FailFactory(*args):
+      raise BundlingError('factory image URL could not be determined')
+    self.mox.stubs.Set(cros_bundle_lib, '_GetResourceUrlAndPath', _FailNaming)
+    self.mox.stubs.Set(cros_bundle_lib, '_HandleFactoryImageAndShim',
+                       _FailFactory)
+    self.assertRaises(NameResolutionError, cros_bundle_lib.FetchImages,
+                      self.options)
+
+  def testPendingTasksCancelledOnFailure(self):
+    """Verify tasks not yet started are dropped once one fails."""
+    started = []
+    def _Task(name, fail=False):
+      def _Run():
+        started.append(name)
+        if fail:
+          raise BundlingError(name)
+        time.sleep(self.latency)
+        return {name: name}
+      return _Run
+    tasks = [_Task('a', fail=True), _Task('b'), _Task('c'), _Task('d')]
+    self.assertRaises(BundlingError, cros_bundle_lib._RunFetchTasks, tasks, 2)
+    self.assertFalse(set(['c', 'd']) & set(started), started)
+
+
 class TestCheckParseOptions(mox.MoxTestBase):
   """Tests related to CheckParseOptions."""
 